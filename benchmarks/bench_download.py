@@ -0,0 +1,210 @@
+"""
+End-to-end throughput benchmark: runs download_tracks against fake Last.fm and Spotify APIs (see fake_apis) and a real
+database, and reports scrobbles/sec, API calls per scrobble and database round trips per scrobble.
+
+    python -m benchmarks.bench_download --latency-ms 50
+    python -m benchmarks.bench_download --db-url sqlite:// --db-url postgresql://bench@localhost/bench --reset-db
+    python -m benchmarks.bench_download --fixtures benchmarks/fixtures --engine async --json results.json
+    python -m benchmarks.bench_download --compare baseline.json
+
+--compare fails (exit code 1) if throughput dropped, or calls or round trips per scrobble went up, by more than the
+tolerance - so it can run in CI before a deploy.  Only point --reset-db at a scratch database, it drops every table.
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+from unittest.mock import patch
+
+import requests
+import spotipy
+from sqlalchemy import event
+
+from benchmarks.fake_apis import FakeAPIs, Recording
+from scrobbledownload import database
+from scrobbledownload.download import download_tracks
+from scrobbledownload.enrichment import AsyncEnrichmentEngine, SyncEnrichmentEngine
+from scrobbledownload.models import Base, Listen, UnfoundTracks
+from scrobbledownload.services.spotify import Spotify
+from scrobbledownload.services.spotify_async import AsyncSpotify, TokenBucket
+
+
+def run(
+    recording: Recording,
+    db_url: str = "sqlite://",
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    engine: str = "sync",
+    fetch_concurrency: int = 4,
+    enrich_concurrency: int = 8,
+    queue_depth: int = 2,
+    reset_db: bool = False,
+) -> Dict[str, float]:
+    """
+    Download a recording into a database, and measure it.
+    Args:
+        recording (Recording): the API responses to replay
+        db_url (str): a SQLAlchemy connection string
+        latency (float): how long each API call takes, in seconds
+        jitter (float): up to how much longer, at random, each API call takes, in seconds
+        engine (str): the enrichment engine, sync or async
+        fetch_concurrency (int): how many Last.fm pages to fetch at the same time
+        enrich_concurrency (int): how many tracks the async engine searches for at the same time
+        queue_depth (int): how many pages can wait between pipeline stages
+        reset_db (bool): drop every table first
+
+    Returns:
+        dict(str, float) - the measurements
+    """
+    apis = FakeAPIs(recording, latency, jitter)
+    if reset_db:
+        database.create_sessionmaker(db_url)
+        Base.metadata.drop_all(database.get_engine())
+    session = database.create_sql_session(db_url)
+    round_trips = {"execute": 0, "commit": 0}
+
+    def count(name):
+        def listener(*args, **kwargs):
+            round_trips[name] += 1
+
+        return listener
+
+    event.listen(database.get_engine(), "before_cursor_execute", count("execute"))
+    event.listen(database.get_engine(), "commit", count("commit"))
+
+    spotify_session = requests.Session()
+    spotify_session.mount("https://", apis.spotify_adapter())
+    Spotify._spotify_api = spotipy.Spotify(auth="benchmark", requests_session=spotify_session)
+    Spotify._replacements = {}
+    Spotify._search_cache.clear()
+    Spotify.set_response_cache(None)
+    if engine == "async":
+        import httpx
+
+        client = httpx.AsyncClient(transport=apis.spotify_transport())
+        spotify_async = AsyncSpotify("benchmark", "benchmark", TokenBucket(10000), client=client)
+        enrichment_engine = AsyncEnrichmentEngine(spotify_async, enrich_concurrency)
+    else:
+        enrichment_engine = SyncEnrichmentEngine()
+
+    secrets = SimpleNamespace(
+        lastfm_username="benchmark", lastfm_api_key="benchmark", scrobbles_per_page=1000
+    )
+    start = time.perf_counter()
+    try:
+        with patch("scrobbledownload.services.lastfm.HTTPAdapter", lambda **kwargs: apis.lastfm_adapter()):
+            download_tracks(session, secrets, fetch_concurrency, enrichment_engine, queue_depth)
+    finally:
+        enrichment_engine.close()
+    elapsed = time.perf_counter() - start
+
+    scrobbles = session.query(Listen).count() + session.query(UnfoundTracks).count()
+    session.close()
+    database.dispose()
+    per = max(scrobbles, 1)
+    return {
+        "scrobbles": scrobbles,
+        "seconds": elapsed,
+        "scrobbles_per_sec": scrobbles / elapsed,
+        "lastfm_calls_per_scrobble": apis.calls["lastfm"] / per,
+        "spotify_calls_per_scrobble": apis.calls["spotify"] / per,
+        "api_calls_per_scrobble": sum(apis.calls.values()) / per,
+        "db_round_trips_per_scrobble": (round_trips["execute"] + round_trips["commit"]) / per,
+    }
+
+
+def compare(
+    results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float
+) -> List[str]:
+    """
+    Find the regressions against a baseline
+    Args:
+        results (dict): this run's results, by database URL
+        baseline (dict): the baseline's results, by database URL
+        tolerance (float): how much worse a measurement can get, e.g. 0.2 for 20%
+
+    Returns:
+        list(str) - a description of each regression
+    """
+    regressions = []
+    for db_url, result in results.items():
+        base = baseline.get(db_url)
+        if base is None:
+            continue
+        if result["scrobbles_per_sec"] < base["scrobbles_per_sec"] * (1 - tolerance):
+            regressions.append(
+                f"{db_url}: {result['scrobbles_per_sec']:.1f} scrobbles/sec, was {base['scrobbles_per_sec']:.1f}"
+            )
+        for key in ("api_calls_per_scrobble", "db_round_trips_per_scrobble"):
+            if result[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{db_url}: {result[key]:.3f} {key}, was {base[key]:.3f}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--fixtures", help="a recording directory to replay, instead of a synthetic history")
+    parser.add_argument("--scrobbles", type=int, default=5000, help="size of the synthetic history")
+    parser.add_argument(
+        "--db-url", action="append", help="database to run against, can be given more than once"
+    )
+    parser.add_argument(
+        "--reset-db", action="store_true", help="drop every table first - scratch databases only!"
+    )
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="injected latency per API call")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="extra random latency per API call")
+    parser.add_argument("--engine", choices=["sync", "async"], default="sync")
+    parser.add_argument("--fetch-concurrency", type=int, default=4)
+    parser.add_argument("--enrich-concurrency", type=int, default=8)
+    parser.add_argument("--queue-depth", type=int, default=2)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="a previous --json file to check for regressions against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression, e.g. 0.2 for 20%%")
+    parser.add_argument("--verbose", action="store_true", help="show the downloader's logging")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    recording = Recording.load(args.fixtures) if args.fixtures else Recording.synthetic(args.scrobbles)
+    results = {}
+    for db_url in args.db_url or ["sqlite://"]:
+        result = run(
+            recording,
+            db_url,
+            args.latency_ms / 1000,
+            args.jitter_ms / 1000,
+            args.engine,
+            args.fetch_concurrency,
+            args.enrich_concurrency,
+            args.queue_depth,
+            args.reset_db,
+        )
+        results[db_url] = result
+        print(
+            f"{db_url}: {result['scrobbles']} scrobbles in {result['seconds']:.2f}s\n"
+            f"  {result['scrobbles_per_sec']:10.1f} scrobbles/sec\n"
+            f"  {result['api_calls_per_scrobble']:10.3f} API calls/scrobble "
+            f"(Last.fm {result['lastfm_calls_per_scrobble']:.3f}, "
+            f"Spotify {result['spotify_calls_per_scrobble']:.3f})\n"
+            f"  {result['db_round_trips_per_scrobble']:10.3f} DB round trips/scrobble"
+        )
+
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(results, fh, indent=2)
+    if args.compare:
+        with open(args.compare) as fh:
+            regressions = compare(results, json.load(fh), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
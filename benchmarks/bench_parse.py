@@ -0,0 +1,101 @@
+"""
+Micro-benchmark for parsing a Last.fm user.getRecentTracks page: decoding the JSON and building the ScrobbleTracks.
+
+"before" is the original path - stdlib json, and a parser building dict-backed dataclasses with keyword arguments and
+a .get() chain per row.  "after" is what LastFM.download_scrobbles does now.
+
+    python -m benchmarks.bench_parse --rows 1000 --repeat 200
+"""
+
+import argparse
+import json
+import timeit
+from dataclasses import dataclass
+from datetime import datetime
+
+from scrobbledownload import fastjson
+from scrobbledownload.services.lastfm import LastFM
+
+
+@dataclass
+class _DictScrobbleTrack(object):
+    track_name: str
+    track_mbid: str
+    listen_dt: datetime
+    artist: str
+    artist_mbid: str
+    album: str
+    album_mbid: str
+
+
+def _before(raw: bytes):
+    tracks = []
+    for t in json.loads(raw)["recenttracks"]["track"]:
+        if t.get("@attr", {}).get("nowplaying"):
+            continue
+        tracks.append(
+            _DictScrobbleTrack(
+                track_name=t["name"],
+                track_mbid=t["mbid"],
+                listen_dt=datetime.utcfromtimestamp(int(t["date"]["uts"])),
+                artist=t["artist"]["#text"],
+                artist_mbid=t["artist"]["mbid"],
+                album=t["album"]["#text"],
+                album_mbid=t["album"]["mbid"],
+            )
+        )
+    return tracks
+
+
+def _after(raw: bytes):
+    return LastFM._handle_lastfm_response(fastjson.loads(raw)).tracks
+
+
+def make_page(rows: int) -> bytes:
+    """
+    Build a raw page of scrobbles that looks like Last.fm's, images and all, with the nowplaying row on top.
+    """
+    tracks = []
+    for i in range(rows):
+        uts = 1581873452 - i * 200
+        tracks.append(
+            {
+                "artist": {"mbid": "", "#text": f"Artist {i % 50}"},
+                "album": {"mbid": "02ac7ce7-4f21-4010-8210-e682085c58ab", "#text": f"Album {i % 80}"},
+                "image": [
+                    {"size": size, "#text": f"https://lastfm.freetls.fastly.net/i/u/{size}/{i}.png"}
+                    for size in ("small", "medium", "large", "extralarge")
+                ],
+                "streamable": "0",
+                "date": {"uts": str(uts), "#text": "16 Feb 2020, 17:17"},
+                "url": f"https://www.last.fm/music/Artist+{i % 50}/_/Track+{i}",
+                "name": f"Track {i}",
+                "mbid": "",
+            }
+        )
+    tracks[0]["@attr"] = {"nowplaying": "true"}
+    attr = {"page": "1", "total": str(rows * 100), "user": "RJ", "perPage": str(rows), "totalPages": "100"}
+    return json.dumps({"recenttracks": {"@attr": attr, "track": tracks}}).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--rows", type=int, default=1000, help="scrobbles per page")
+    parser.add_argument("--repeat", type=int, default=200, help="how many pages to parse per measurement")
+    args = parser.parse_args()
+
+    raw = make_page(args.rows)
+    assert len(_before(raw)) == len(_after(raw)) == args.rows - 1
+    print(f"JSON backend: {fastjson.BACKEND}")
+    results = {}
+    for name, fn in (("before", _before), ("after", _after)):
+        best = min(timeit.repeat(lambda: fn(raw), number=args.repeat, repeat=5)) / args.repeat
+        results[name] = best
+        print(f"{name:>6}: {best * 1000 * 1000 / args.rows:8.3f} ms per 1000 rows")
+    print(f"speedup: {results['before'] / results['after']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+CLI startup benchmark: runs the download-scrobbles entry point under `python -X importtime` in a fresh interpreter, and
+reports how long its imports took and which modules were the slowest.
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --budget-ms 100 --top 20
+
+It fails (exit code 1) if startup imports take longer than the budget, or pull in one of the heavy dependencies that
+should only load once a command runs - so it can run in CI like bench_download.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, List, Optional, Tuple
+
+# Dependencies that --help mustn't import - every one of them is for a command to import when it runs
+HEAVY = (
+    "sqlalchemy",
+    "spotipy",
+    "requests",
+    "yaml",
+    "dateutil",
+    "httpx",
+    "orjson",
+    "scrobbledownload.models",
+    "cProfile",
+    "pstats",
+)
+
+# What to time: importing the CLI, and running --help for the group and for a command
+STATEMENTS = {
+    "import": "import scrobbledownload.cli",
+    "--help": "from scrobbledownload.cli import cli\ntry:\n    cli(['--help'])\nexcept SystemExit:\n    pass",
+    "download --help": (
+        "from scrobbledownload.cli import cli\ntry:\n"
+        f"    cli(['--secrets-path', {os.devnull!r}, 'download', '--help'])\n"
+        "except SystemExit:\n    pass"
+    ),
+}
+
+Timings = Dict[str, Tuple[int, int, int]]
+
+
+def importtime(statement: str) -> Timings:
+    """
+    Run a statement in a fresh interpreter with -X importtime
+    Args:
+        statement (str): the Python to run
+
+    Returns:
+        dict - module -> (self microseconds, cumulative microseconds, nesting depth), in import order
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        timings[name.strip()] = (int(self_us), int(cumulative_us), depth)
+    return timings
+
+
+def measure(statement: str) -> Tuple[float, Timings]:
+    """
+    Time the imports a statement makes, leaving out the ones every interpreter makes at startup
+    Args:
+        statement (str): the Python to run
+
+    Returns:
+        (float, dict) - milliseconds spent importing, and the timings of just the statement's imports
+    """
+    baseline = importtime("pass")
+    timings = {name: t for name, t in importtime(statement).items() if name not in baseline}
+    total_us = sum(cumulative for _, cumulative, depth in timings.values() if depth == 0)
+    return total_us / 1000, timings
+
+
+def heavy_imports(timings: Timings) -> List[str]:
+    """
+    Find the heavy dependencies among some imports
+    Args:
+        timings (dict): as from measure
+
+    Returns:
+        list(str) - the heavy modules that were imported, without their submodules
+    """
+    return sorted(
+        {heavy for name in timings for heavy in HEAVY if name == heavy or name.startswith(f"{heavy}.")}
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--budget-ms", type=float, default=150.0, help="most milliseconds each may spend importing"
+    )
+    parser.add_argument("--top", type=int, default=10, help="how many of the slowest modules to show")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for label, statement in STATEMENTS.items():
+        total_ms, timings = measure(statement)
+        heavy = heavy_imports(timings)
+        print(f"{label}: {total_ms:.1f}ms importing {len(timings)} modules")
+        for name, (self_us, _, _) in sorted(timings.items(), key=lambda item: -item[1][0])[: args.top]:
+            print(f"  {self_us / 1000:8.1f}ms  {name}")
+        if heavy:
+            print(f"  imports {', '.join(heavy)}, which should wait until a command runs")
+        if heavy or total_ms > args.budget_ms:
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,352 @@
+"""
+Fake Last.fm and Spotify APIs for benchmarking, replaying recorded responses with some injected latency.
+
+A recording is a directory laid out like:
+
+    lastfm/page_0001.json   user.getRecentTracks responses, one per page
+    spotify/search.json     {search string: search response}
+    spotify/artists.json    {spotify id: artist}
+    spotify/albums.json     {spotify id: album}
+
+Recordings can be captured from the real APIs, or made up with `Recording.synthetic` - or from the command line:
+
+    python -m benchmarks.fake_apis --out benchmarks/fixtures --scrobbles 5000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover - only when the async extra isn't installed
+    httpx = None
+
+from scrobbledownload.services.spotify import Spotify
+
+
+class Recording(object):
+    """
+    Recorded Last.fm pages and Spotify responses.
+    """
+
+    def __init__(
+        self,
+        lastfm_pages: List[dict],
+        searches: Dict[str, dict],
+        artists: Dict[str, dict],
+        albums: Dict[str, dict],
+    ):
+        """
+        Args:
+            lastfm_pages (list(dict)): user.getRecentTracks responses, page 1 first
+            searches (dict(str, dict)): search responses, by search string
+            artists (dict(str, dict)): artists, by Spotify ID
+            albums (dict(str, dict)): albums, by Spotify ID
+        """
+        self.lastfm_pages = lastfm_pages
+        self.searches = {Spotify._search_cache_key(q): response for q, response in searches.items()}
+        self.artists = artists
+        self.albums = albums
+
+    @property
+    def scrobbles(self) -> int:
+        """
+        How many scrobbles there are across every page, not counting nowplaying rows
+        """
+        return sum(
+            1
+            for page in self.lastfm_pages
+            for t in page["recenttracks"]["track"]
+            if not t.get("@attr", {}).get("nowplaying")
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "Recording":
+        """
+        Load a recording from a directory
+        Args:
+            path (str): the recording's directory
+
+        Returns:
+            Recording
+        """
+        lastfm_dir = os.path.join(path, "lastfm")
+        pages = []
+        for name in sorted(os.listdir(lastfm_dir)):
+            with open(os.path.join(lastfm_dir, name)) as fh:
+                pages.append(json.load(fh))
+        spotify = {}
+        for kind in ("search", "artists", "albums"):
+            with open(os.path.join(path, "spotify", f"{kind}.json")) as fh:
+                spotify[kind] = json.load(fh)
+        return cls(pages, spotify["search"], spotify["artists"], spotify["albums"])
+
+    def save(self, path: str):
+        """
+        Write the recording to a directory
+        Args:
+            path (str): the recording's directory
+        """
+        os.makedirs(os.path.join(path, "lastfm"), exist_ok=True)
+        os.makedirs(os.path.join(path, "spotify"), exist_ok=True)
+        for i, page in enumerate(self.lastfm_pages, 1):
+            with open(os.path.join(path, "lastfm", f"page_{i:04d}.json"), "w") as fh:
+                json.dump(page, fh)
+        for kind, responses in (
+            ("search", self.searches),
+            ("artists", self.artists),
+            ("albums", self.albums),
+        ):
+            with open(os.path.join(path, "spotify", f"{kind}.json"), "w") as fh:
+                json.dump(responses, fh)
+
+    @classmethod
+    def synthetic(
+        cls,
+        scrobbles: int = 5000,
+        per_page: int = 1000,
+        distinct_tracks: int = 1500,
+        miss_rate: float = 0.05,
+        seed: int = 1,
+    ) -> "Recording":
+        """
+        Make up a recording that looks like a real listening history - a long tail of tracks, listened to in a skewed
+        way, across a few hundred artists and albums, with some tracks Spotify can't find.
+        Args:
+            scrobbles (int): how many scrobbles in the history
+            per_page (int): scrobbles per Last.fm page
+            distinct_tracks (int): how many different tracks were listened to
+            miss_rate (float): the share of tracks that Spotify can't find
+            seed (int): the random seed, so recordings are repeatable
+
+        Returns:
+            Recording
+        """
+        rng = random.Random(seed)
+        catalogue = []
+        searches, artists, albums = {}, {}, {}
+        for i in range(distinct_tracks):
+            artist_id, album_id = f"artist{i % 300:05d}", f"album{i % 700:05d}"
+            track = {
+                "name": f"Track {i}",
+                "artist": f"Artist {i % 300}",
+                "album": f"Album {i % 700}",
+                "artist_id": artist_id,
+                "album_id": album_id,
+            }
+            catalogue.append(track)
+            artists[artist_id] = {
+                "id": artist_id,
+                "name": track["artist"],
+                "genres": [f"genre {i % 17}"],
+                "popularity": i % 100,
+            }
+            albums[album_id] = {
+                "id": album_id,
+                "name": track["album"],
+                "release_date": f"{1970 + i % 50}-01-01",
+                "release_date_precision": "day",
+                "genres": [],
+                "popularity": i % 100,
+            }
+            items = []
+            if rng.random() >= miss_rate:
+                items.append(
+                    {
+                        "id": f"track{i:06d}",
+                        "name": track["name"],
+                        "duration_ms": 180000 + i,
+                        "popularity": i % 100,
+                        "album": {"id": album_id, "name": track["album"]},
+                        "artists": [{"id": artist_id, "name": track["artist"]}],
+                    }
+                )
+            searches[f"{track['name']} artist:{track['artist']}"] = {"tracks": {"items": items}}
+
+        uts = 1600000000
+        rows = []
+        for _ in range(scrobbles):
+            # Half the listens go to a few favourites, the rest are spread over everything
+            if rng.random() < 0.5:
+                track = catalogue[min(int(rng.paretovariate(1.2)) - 1, distinct_tracks - 1)]
+            else:
+                track = catalogue[rng.randrange(distinct_tracks)]
+            rows.append(
+                {
+                    "artist": {"mbid": "", "#text": track["artist"]},
+                    "album": {"mbid": "", "#text": track["album"]},
+                    "streamable": "0",
+                    "date": {"uts": str(uts), "#text": ""},
+                    "name": track["name"],
+                    "mbid": "",
+                }
+            )
+            uts -= rng.randint(120, 400)
+
+        total_pages = max((scrobbles + per_page - 1) // per_page, 1)
+        pages = []
+        for page in range(total_pages):
+            attr = {
+                "page": str(page + 1),
+                "perPage": str(per_page),
+                "totalPages": str(total_pages),
+                "total": str(scrobbles),
+                "user": "benchmark",
+            }
+            pages.append(
+                {"recenttracks": {"@attr": attr, "track": rows[page * per_page : (page + 1) * per_page]}}
+            )
+        return cls(pages, searches, artists, albums)
+
+
+class FakeAPIs(object):
+    """
+    Answers Last.fm and Spotify requests from a recording, sleeping for the injected latency first, and counting
+    every call.  Use `lastfm_adapter`/`spotify_adapter` with requests, and `spotify_transport` with httpx.
+    """
+
+    def __init__(self, recording: Recording, latency: float = 0.0, jitter: float = 0.0, seed: int = 1):
+        """
+        Args:
+            recording (Recording): the responses to replay
+            latency (float): how long each call takes, in seconds
+            jitter (float): up to how much longer, at random, each call takes, in seconds
+            seed (int): the random seed for the jitter
+        """
+        self.recording = recording
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _delay(self, api: str) -> float:
+        with self._lock:
+            self.calls[api] += 1
+            return self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    def lastfm(self, params: Dict[str, str]) -> Tuple[int, dict]:
+        """
+        Answer a user.getRecentTracks request
+        Args:
+            params (dict(str, str)): the query string parameters
+
+        Returns:
+            tuple(int, dict) - the status code and JSON body
+        """
+        page = int(params.get("page", 1))
+        pages = self.recording.lastfm_pages
+        if page <= len(pages):
+            return 200, pages[page - 1]
+        attr = dict(pages[0]["recenttracks"]["@attr"], page=str(page)) if pages else {}
+        return 200, {"recenttracks": {"@attr": attr, "track": []}}
+
+    def spotify(self, path: str, params: Dict[str, str]) -> Tuple[int, dict]:
+        """
+        Answer a Spotify Web API request
+        Args:
+            path (str): the URL path, e.g. /v1/search
+            params (dict(str, str)): the query string parameters
+
+        Returns:
+            tuple(int, dict) - the status code and JSON body
+        """
+        parts = [p for p in path.split("/") if p][1:]
+        if parts == ["search"]:
+            key = Spotify._search_cache_key(params["q"])
+            return 200, self.recording.searches.get(key, {"tracks": {"items": []}})
+        if parts and parts[0] in ("artists", "albums"):
+            recorded = self.recording.artists if parts[0] == "artists" else self.recording.albums
+            if len(parts) > 1:
+                return (
+                    (200, recorded[parts[1]]) if parts[1] in recorded else (404, {"error": {"status": 404}})
+                )
+            return 200, {parts[0]: [recorded.get(i) for i in params["ids"].split(",")]}
+        return 404, {"error": {"status": 404, "message": f"no fake for {path}"}}
+
+    def lastfm_adapter(self) -> "FakeAdapter":
+        """
+        A requests transport adapter for Last.fm
+        """
+        return FakeAdapter(self, "lastfm", lambda url: self.lastfm(_params(url)))
+
+    def spotify_adapter(self) -> "FakeAdapter":
+        """
+        A requests transport adapter for the Spotify Web API
+        """
+        return FakeAdapter(self, "spotify", lambda url: self.spotify(urlparse(url).path, _params(url)))
+
+    def spotify_transport(self) -> "httpx.MockTransport":
+        """
+        An httpx transport for the Spotify Web API, and its token endpoint
+        """
+
+        async def handle(request: "httpx.Request") -> "httpx.Response":
+            if request.url.host == "accounts.spotify.com":
+                return httpx.Response(200, json={"access_token": "benchmark", "expires_in": 3600})
+            await asyncio.sleep(self._delay("spotify"))
+            status, body = self.spotify(request.url.path, dict(request.url.params))
+            return httpx.Response(status, json=body)
+
+        return httpx.MockTransport(handle)
+
+
+class FakeAdapter(BaseAdapter):
+    """
+    A requests transport adapter that answers from a FakeAPIs instead of the network.
+    """
+
+    def __init__(self, apis: FakeAPIs, api: str, handle):
+        super().__init__()
+        self._apis = apis
+        self._api = api
+        self._handle = handle
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        time.sleep(self._apis._delay(self._api))
+        status, body = self._handle(request.url)
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(body).encode()
+        response.headers = CaseInsensitiveDict({"Content-Type": "application/json"})
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+def _params(url: str) -> Dict[str, str]:
+    return {k: v[0] for k, v in parse_qs(urlparse(url).query).items()}
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Write a synthetic recording for the benchmarks")
+    parser.add_argument("--out", required=True, help="directory to write the recording to")
+    parser.add_argument("--scrobbles", type=int, default=5000)
+    parser.add_argument("--per-page", type=int, default=1000)
+    parser.add_argument("--distinct-tracks", type=int, default=1500)
+    parser.add_argument("--miss-rate", type=float, default=0.05)
+    args = parser.parse_args(argv)
+    recording = Recording.synthetic(args.scrobbles, args.per_page, args.distinct_tracks, args.miss_rate)
+    recording.save(args.out)
+    print(f"Wrote {recording.scrobbles} scrobbles over {len(recording.lastfm_pages)} pages to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
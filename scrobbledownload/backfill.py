@@ -0,0 +1,328 @@
+"""
+Backfilling a users history in parallel, with a pool of worker processes.
+
+A download walks back through the history one page after another, and however its stages overlap, parsing, matching
+and writing all share one interpreter.  backfill splits the history into disjoint time windows instead, and hands
+them out to worker processes.  Each worker sets itself up once - its own Last.fm client, Spotify client and search
+cache, and its own SQLAlchemy engine from create_sessionmaker - and then downloads windows through a
+WindowDownloader, just like download does.  Workers are spawned rather than forked, so no connection is shared.
+
+Workers don't talk to each other.  They share the artists, albums and tracks, which is safe because every one of
+those is written with an upsert on its unique key (see scrobbledownload.upsert): two workers creating the same track
+at once both end up with the one row.  Listens don't need that, as no two windows overlap.
+
+Every window is a SyncState of kind "backfill", planned and committed before any worker starts, and checkpointed by
+its worker as each page is written, so a backfill that dies part way through resumes its unfinished windows when it's
+run again.  Windows are only planned for time no other download has covered, and only before the oldest listen we
+have - the history after that is download's to fetch, and any holes in it fill_gaps'.
+"""
+
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import List, Optional, Sequence, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from scrobbledownload import database, initialize_logger, metrics
+from scrobbledownload.download import PageEnricher, WindowDownloader
+from scrobbledownload.enrichment import SyncEnrichmentEngine
+from scrobbledownload.models import Listen, SyncState
+from scrobbledownload.secrets import Secrets
+from scrobbledownload.services.lastfm import LastFM
+from scrobbledownload.services.spotify import Spotify
+from scrobbledownload.services.track import TrackIndex
+
+logger = logging.getLogger(__name__)
+
+KIND = "backfill"
+
+Range = Tuple[datetime, datetime]
+
+_SECOND = timedelta(seconds=1)
+
+# The worker's session, clients and downloader, set up once per process by _start_worker
+_worker: Optional["_Worker"] = None
+
+
+@dataclass
+class WorkerSettings(object):
+    """
+    What a worker process needs to set itself up.  It's pickled across to each worker, so it's only paths and numbers.
+    """
+
+    secrets_path: str
+    replacements_file: str
+    fetch_concurrency: int = 2
+    queue_depth: int = 2
+    lastfm_timeout: float = 30
+    log_level: int = logging.INFO
+
+
+def split_range(since: datetime, until: datetime, windows: int) -> List[Range]:
+    """
+    Split a stretch of time into about equal windows, on whole seconds
+    Args:
+        since (datetime): the start, included
+        until (datetime): the end, excluded
+        windows (int): how many windows to split it into
+
+    Returns:
+        list((datetime, datetime)) - [start, end) ranges, oldest first
+    """
+    total = int((until - since).total_seconds())
+    windows = max(1, min(windows, total))
+    bounds = [since + timedelta(seconds=total * i // windows) for i in range(windows + 1)]
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def subtract_ranges(ranges: Sequence[Range], covered: Sequence[Range]) -> List[Range]:
+    """
+    Cut the covered time out of some ranges
+    Args:
+        ranges (list((datetime, datetime))): [start, end) ranges
+        covered (list((datetime, datetime))): [start, end) ranges that are already covered, in any order
+
+    Returns:
+        list((datetime, datetime)) - what's left of the ranges, in order
+    """
+    covered = sorted(covered)
+    left = []
+    for start, end in ranges:
+        for covered_start, covered_end in covered:
+            if covered_end <= start or covered_start >= end:
+                continue
+            if covered_start > start:
+                left.append((start, covered_start))
+            start = max(start, covered_end)
+            if start >= end:
+                break
+        if start < end:
+            left.append((start, end))
+    return left
+
+
+def _covered_range(state: SyncState) -> Range:
+    # A window downloads the scrobbles strictly between its from_dt and to_dt, which in Last.fm's whole seconds is
+    # [from_dt + 1s, to_dt)
+    return (state.from_dt + _SECOND if state.from_dt else datetime.min, state.to_dt)
+
+
+def plan_windows(session: Session, since: datetime, until: datetime, windows: int) -> List[SyncState]:
+    """
+    Work out the windows a backfill needs: any earlier backfill's unfinished windows, then the time between `since`
+    and `until` that no download has covered, split into about `windows` windows.  The new windows are committed
+    straight away.
+    Args:
+        session (Session): The SQLAlchemy Session
+        since (datetime): the start of the history to backfill
+        until (datetime): the end of it - it's brought back to the oldest listen we have, if that's earlier
+        windows (int): how many windows to split the time into
+
+    Returns:
+        list(SyncState) - the unfinished windows first, then the new ones, oldest first
+    """
+    resumed = SyncState.incomplete(session, [KIND])
+    oldest_listen = session.query(func.min(Listen.dt)).scalar()
+    if oldest_listen is not None and oldest_listen < until:
+        until = oldest_listen
+    if since >= until:
+        return resumed
+
+    covered = [
+        _covered_range(state) for state in session.query(SyncState).filter(SyncState.to_dt.isnot(None))
+    ]
+    ranges = subtract_ranges(split_range(since, until, windows), covered)
+    # Each [start, end) range becomes a window strictly between start - 1s and end, so one window's end is the next
+    # window's start without a scrobble on the boundary being downloaded twice, or not at all
+    new = [SyncState.start(KIND, start - _SECOND, end, session) for start, end in ranges]
+    return resumed + new
+
+
+@dataclass
+class _Worker(object):
+    """
+    A worker process's session and Last.fm client, and the downloader that's built on them.
+    """
+
+    session: Session
+    lastfm: LastFM
+    settings: WorkerSettings
+    scrobbles_per_page: int
+    downloader: Optional[WindowDownloader] = None
+
+    def load(self):
+        """
+        Build the downloader from what's in the database now: the known tracks, artists and albums.  Tracks the other
+        workers create after this are found again on Spotify, and the upsert gives back their ids.
+        """
+        track_index = TrackIndex.load(self.session)
+        enricher = PageEnricher.load(self.session, SyncEnrichmentEngine(), track_index)
+        self.downloader = WindowDownloader(
+            self.session,
+            self.lastfm,
+            enricher,
+            track_index,
+            self.scrobbles_per_page,
+            self.settings.fetch_concurrency,
+            self.settings.queue_depth,
+        )
+
+
+def _start_worker(settings: WorkerSettings, in_process: bool = False):
+    """
+    Set a worker process up to download windows: secrets, database engine, Spotify, Last.fm and the known tracks.
+    Args:
+        settings (WorkerSettings): what the worker needs
+        in_process (bool): whether the worker is this process, which already has logging and a database engine -
+            replacing the engine would close the connections the caller's session is using
+    """
+    global _worker
+    if not in_process:
+        initialize_logger(settings.log_level)
+    Secrets.set_filepath(settings.secrets_path)
+    secrets = Secrets()
+    if not in_process:
+        database.create_sessionmaker(secrets.db_connection_string, secrets.db_pool)
+    session = database.get_session()
+    Spotify.connect(secrets.spotify_credentials)
+    Spotify.set_replacements(settings.replacements_file)
+    lastfm = LastFM(
+        secrets.lastfm_username,
+        secrets.lastfm_api_key,
+        timeout=(5, settings.lastfm_timeout),
+        pool_size=settings.fetch_concurrency,
+    )
+    _worker = _Worker(session, lastfm, settings, secrets.scrobbles_per_page)
+    _worker.load()
+
+
+def _download_window(state_id: int) -> dict:
+    """
+    Download one window, in a worker.  If it fails, its pages are rolled back, and the worker's known tracks and
+    claims are loaded again from the database - the tracks the window created went with the rollback, and the
+    tracks on its unwritten pages still need searching for.
+    Args:
+        state_id (int): the window's SyncState id
+
+    Returns:
+        dict - the window's metrics snapshot
+    """
+    session = _worker.session
+    metrics.reset()
+    try:
+        with metrics.timer("backfill.window"):
+            _worker.downloader.download(session.get(SyncState, state_id))
+    except BaseException:
+        # Leave the worker usable for its next window
+        session.rollback()
+        _worker.load()
+        raise
+    return metrics.snapshot()
+
+
+def run_windows(
+    state_ids: List[int], settings: WorkerSettings, workers: int
+) -> Tuple[metrics.Metrics, List[int]]:
+    """
+    Download windows with a pool of worker processes, or in this process if there's only one worker.  A window that
+    fails is logged and left for the next backfill to resume, and the rest carry on.
+    Args:
+        state_ids (list(int)): the windows' SyncState ids
+        settings (WorkerSettings): what each worker needs
+        workers (int): how many worker processes
+
+    Returns:
+        (Metrics, list(int)) - every window's metrics added up, and the ids of the windows that failed
+    """
+    totals = metrics.Metrics()
+    failed = []
+    if workers == 1:
+        _start_worker(settings, in_process=True)
+        for state_id in state_ids:
+            try:
+                totals.merge(_download_window(state_id))
+            except Exception:
+                logger.exception(f"Backfilling window {state_id} failed")
+                failed.append(state_id)
+        return totals, failed
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=context, initializer=_start_worker, initargs=(settings,)
+    ) as executor:
+        futures = {executor.submit(_download_window, state_id): state_id for state_id in state_ids}
+        for future in as_completed(futures):
+            try:
+                totals.merge(future.result())
+            except Exception:
+                logger.exception(f"Backfilling window {futures[future]} failed")
+                failed.append(futures[future])
+    return totals, failed
+
+
+def backfill(
+    session: Session,
+    lastfm: LastFM,
+    settings: WorkerSettings,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    workers: int = 4,
+    windows: Optional[int] = None,
+) -> List[int]:
+    """
+    Backfill a users history between two times, in parallel.
+
+    The time's split into more windows than there are workers, as some stretches of a history are busier than
+    others - that way a worker that gets a quiet window just takes another one.  Stage timings and counts are
+    gathered from every worker into scrobbledownload.metrics.
+
+    SQLite only lets one process write at a time, so there the workers mostly wait on each other - backfill a big
+    history into Postgres.
+    Args:
+        session (Session): The SQLAlchemy Session
+        lastfm (LastFM): The Last.fm API, to find the first scrobble if there's no `since`
+        settings (WorkerSettings): what each worker needs
+        since (datetime): the start of the history to backfill.  Defaults to the users first scrobble.
+        until (datetime): the end of the history to backfill.  Defaults to now, and is brought back to the oldest
+            listen we have.
+        workers (int): how many worker processes
+        windows (int): how many windows to split the history into.  Defaults to four per worker.
+
+    Returns:
+        list(int) - the SyncState ids of the windows that failed, to be resumed by the next backfill
+    """
+    metrics.reset()
+    start = time.perf_counter()
+    until = (until or datetime.utcnow()).replace(microsecond=0)
+    if since is None:
+        since = lastfm.first_scrobble_dt(to_dt=until)
+        if since is None:
+            logger.info("There are no scrobbles to backfill")
+            return []
+    since = since.replace(microsecond=0)
+    if workers > 1 and session.get_bind().dialect.name == "sqlite":
+        logger.warning(
+            "SQLite allows one writer at a time, so the workers will mostly be waiting on each other"
+        )
+
+    states = plan_windows(session, since, until, windows or workers * 4)
+    state_ids = [state.id for state in states]
+    logger.info(f"Backfilling {len(state_ids)} windows from {since} to {until} with {workers} workers")
+    totals, failed = run_windows(state_ids, settings, workers)
+
+    metrics.reset()
+    metrics.merge(totals.snapshot())
+    metrics.observe("run", time.perf_counter() - start)
+    metrics.incr("backfill.windows", len(state_ids) - len(failed))
+    metrics.incr("backfill.windows.failed", len(failed))
+    if failed:
+        logger.warning(
+            f"{len(failed)} of {len(state_ids)} windows failed, run the backfill again to resume them"
+        )
+    logger.info(f"Stage timings and counts:\n{metrics.summary()}")
+    return failed
@@ -0,0 +1,207 @@
+"""
+Caches for responses from the APIs we talk to, so we don't ask them the same question twice.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class LRUCache(object):
+    """
+    A thread-safe, in-memory least-recently-used cache where every entry also expires after a time-to-live.
+
+    Falsy values (an empty search result, say) are cached too, as negative entries, and can be given their own
+    shorter time-to-live so a track that doesn't exist today gets looked up again eventually.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 10000,
+        ttl: float = 3600,
+        negative_ttl: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Args:
+            max_size (int): How many entries to hold before evicting the least recently used
+            ttl (float): How many seconds an entry lives for
+            negative_ttl (float): How many seconds a falsy entry lives for.  Defaults to the ttl.
+            clock (callable): Where the time comes from, in seconds
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Get a value from the cache, counting the hit or miss.
+        Args:
+            key (Hashable): the cache key
+            default: what to return on a miss
+
+        Returns:
+            The cached value, or the default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self._clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any):
+        """
+        Put a value in the cache, evicting the least recently used entry if we're full.
+        Args:
+            key (Hashable): the cache key
+            value: the value to cache
+        """
+        ttl = self._ttl if value else self._negative_ttl
+        with self._lock:
+            self._entries[key] = (self._clock() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Empty the cache and reset the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the hit/miss counters for the cache
+        Returns:
+            dict
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class PersistentCache(object):
+    """
+    A cache of raw API responses kept in a local SQLite file, so they survive from one run (or container) to the
+    next.  Every entry belongs to a kind ("artist", "album", "search", ...) and each kind has its own time-to-live,
+    since artist genres and album release dates hardly ever change but search results might.
+    """
+
+    DEFAULT_TTLS = {
+        "artist": 30 * 24 * 3600,
+        "album": 90 * 24 * 3600,
+        "search": 14 * 24 * 3600,
+        "search_miss": 2 * 24 * 3600,
+    }
+
+    def __init__(
+        self, path: str, ttls: Optional[Dict[str, float]] = None, clock: Callable[[], float] = time.time
+    ):
+        """
+        Args:
+            path (str): Path to the SQLite file.  It's created if it doesn't exist.
+            ttls (dict): Time-to-live, in seconds, by kind.  Merged over the defaults.
+            clock (callable): Where the time comes from, in seconds since the epoch
+        """
+        self._ttls = dict(self.DEFAULT_TTLS)
+        self._ttls.update(ttls or {})
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "kind TEXT NOT NULL, key TEXT NOT NULL, expires_at REAL NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (kind, key))"
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def ttl_for(self, kind: str) -> float:
+        """
+        Get the time-to-live for a kind of entry.  Kinds without a configured ttl aren't cached at all.
+        Args:
+            kind (str): the kind of entry
+
+        Returns:
+            float
+        """
+        return self._ttls.get(kind, 0)
+
+    def get(self, kind: str, key: str) -> Any:
+        """
+        Get an unexpired response from the cache.
+        Args:
+            kind (str): the kind of entry
+            key (str): the key within that kind
+
+        Returns:
+            The decoded response, or None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM responses WHERE kind = ? AND key = ? AND expires_at > ?",
+                (kind, key, self._clock()),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, kind: str, key: str, value: Any, ttl_kind: Optional[str] = None):
+        """
+        Store a response in the cache.
+        Args:
+            kind (str): the kind of entry
+            key (str): the key within that kind
+            value: a JSON-serializable response
+            ttl_kind (str): Use the time-to-live of this kind instead, e.g. a shorter one for empty search results
+        """
+        ttl = self.ttl_for(ttl_kind or kind)
+        if ttl <= 0:
+            return
+        encoded = json.dumps(value, separators=(",", ":"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (kind, key, expires_at, value) VALUES (?, ?, ?, ?)",
+                (kind, key, self._clock() + ttl, encoded),
+            )
+
+    def purge_expired(self) -> int:
+        """
+        Delete every expired entry, so the file doesn't grow forever.
+        Returns:
+            int - how many entries were deleted
+        """
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM responses WHERE expires_at <= ?", (self._clock(),)
+            ).rowcount
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the hit/miss counters for the cache
+        Returns:
+            dict
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        self._conn.close()
@@ -1,15 +1,25 @@
 """
 THe comand line interface for the scrobble downloader.
+
+It's run from cron every few minutes, and `--help` should be instant, so only the standard library and click are
+imported up front.  Each command imports what it needs - SQLAlchemy, spotipy, requests and the models - when it runs.
+tests/test_startup.py keeps it that way.
 """
 import logging
+from contextlib import nullcontext
+from datetime import timedelta
+from typing import TYPE_CHECKING, Optional
 
 import click
 
-from scrobbledownload import initialize_logger
-from scrobbledownload.database import create_sql_session
-from scrobbledownload.download import download_tracks, test_downloading
+from scrobbledownload import initialize_logger, metrics
 from scrobbledownload.secrets import Secrets
-from scrobbledownload.services.spotify import Spotify
+
+if TYPE_CHECKING:
+    from scrobbledownload.cache import PersistentCache
+
+# profiling.MODES, which would otherwise bring cProfile and pstats in on every run
+PROFILE_MODES = ("cprofile", "sample")
 
 
 @click.group()
@@ -35,32 +45,402 @@ def cli(debug, secrets_path):
     Secrets.set_filepath(secrets_path)
 
 
+@cli.command()
+def migrate():
+    """
+    Bring a database created by an older version up to date: new columns, indexes and unique constraints.
+    """
+    from scrobbledownload import migrations
+    from scrobbledownload.database import build_engine
+
+    secrets = Secrets()
+    engine = build_engine(secrets.db_connection_string, secrets.db_pool)
+    done = migrations.migrate(engine)
+    engine.dispose()
+    logging.getLogger(__name__).info(f"Migrated: {', '.join(done)}" if done else "Already up to date")
+
+
 @cli.command()
 def download_test():
     """
     shoundt exist
     todo remove me
     """
+    from scrobbledownload.database import create_sql_session
+    from scrobbledownload.download import test_downloading
+
     secrets = Secrets()
-    session = create_sql_session(secrets.db_connection_string)
+    session = create_sql_session(secrets.db_connection_string, secrets.db_pool)
     test_downloading(session, secrets)
 
 
 @cli.command()
-@cli.option(
+@click.option(
     "--replacements-file",
     type=click.Path(exists=True, dir_okay=False),
     envvar="REPLACEMENTS_FILE",
     required=True,
     default="/run/replacements.json",
 )
-def download(replacements_file):
+@click.option(
+    "--fetch-concurrency",
+    type=click.IntRange(min=1),
+    envvar="FETCH_CONCURRENCY",
+    default=4,
+    help="How many Last.fm pages to fetch at the same time",
+)
+@click.option(
+    "--spotify-cache-path",
+    type=click.Path(dir_okay=False),
+    envvar="SPOTIFY_CACHE_PATH",
+    default=None,
+    help="SQLite file to cache Spotify responses in across runs, e.g. /run/spotify_cache.sqlite",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["sync", "async"]),
+    envvar="ENRICHMENT_ENGINE",
+    default="sync",
+    help="Search Spotify one track at a time, or many at once with asyncio (needs the async extra)",
+)
+@click.option(
+    "--enrich-concurrency",
+    type=click.IntRange(min=1),
+    envvar="ENRICH_CONCURRENCY",
+    default=8,
+    help="How many tracks the async engine searches for at the same time",
+)
+@click.option(
+    "--spotify-rate-limit",
+    type=click.FloatRange(min=0, min_open=True),
+    envvar="SPOTIFY_RATE_LIMIT",
+    default=10.0,
+    help="Most Spotify requests per second the async engine will make",
+)
+@click.option(
+    "--queue-depth",
+    type=click.IntRange(min=1),
+    envvar="QUEUE_DEPTH",
+    default=2,
+    help="How many pages can wait between pipeline stages - lower it to use less memory",
+)
+@click.option(
+    "--lastfm-timeout",
+    type=click.FloatRange(min=0, min_open=True),
+    envvar="LASTFM_TIMEOUT",
+    default=30.0,
+    help="Seconds to wait for a Last.fm page before retrying it",
+)
+@click.option(
+    "--fill-gaps-days",
+    type=click.FloatRange(min=0, min_open=True),
+    envvar="FILL_GAPS_DAYS",
+    default=None,
+    help="Afterwards, look for stretches of this many days without a listen, and download just those",
+)
+@click.option(
+    "--metrics-file",
+    type=click.Path(dir_okay=False),
+    envvar="METRICS_FILE",
+    default=None,
+    help="Write stage timings and counts here at the end - a Prometheus textfile if it's .prom, else JSON",
+)
+@click.option(
+    "--profile",
+    type=click.Path(dir_okay=False),
+    envvar="PROFILE_PATH",
+    default=None,
+    help="Profile the run, writing the stats here and a summary of the hot functions to stderr",
+)
+@click.option(
+    "--profile-mode",
+    type=click.Choice(PROFILE_MODES),
+    envvar="PROFILE_MODE",
+    default="cprofile",
+    help="cprofile for exact call counts and .prof stats, sample for low overhead and collapsed stacks",
+)
+@click.option(
+    "--profile-top",
+    type=click.IntRange(min=1),
+    envvar="PROFILE_TOP",
+    default=30,
+    help="How many functions to show in the profile summary",
+)
+def download(
+    replacements_file,
+    fetch_concurrency,
+    spotify_cache_path,
+    engine,
+    enrich_concurrency,
+    spotify_rate_limit,
+    queue_depth,
+    lastfm_timeout,
+    fill_gaps_days,
+    metrics_file,
+    profile,
+    profile_mode,
+    profile_top,
+):
     """
     Download new scrobbles.
     """
+    from scrobbledownload.database import create_sql_session
+    from scrobbledownload.download import download_tracks
+
+    profiler = nullcontext()
+    if profile:
+        from scrobbledownload import profiling
+
+        profiler = profiling.profile(profile, profile_mode, profile_top)
+    with profiler:
+        secrets = Secrets()
+        session = create_sql_session(secrets.db_connection_string, secrets.db_pool)
+        response_cache = _connect_spotify(secrets, replacements_file, spotify_cache_path)
+        enrichment_engine = _enrichment_engine(secrets, engine, enrich_concurrency, spotify_rate_limit)
+        try:
+            min_gap = timedelta(days=fill_gaps_days) if fill_gaps_days else None
+            download_tracks(
+                session, secrets, fetch_concurrency, enrichment_engine, queue_depth, lastfm_timeout, min_gap
+            )
+        finally:
+            enrichment_engine.close()
+            if metrics_file:
+                metrics.write(metrics_file)
+        _close_response_cache(response_cache)
+
+
+@cli.command()
+@click.option(
+    "--replacements-file",
+    type=click.Path(exists=True, dir_okay=False),
+    envvar="REPLACEMENTS_FILE",
+    required=True,
+    default="/run/replacements.json",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    envvar="BACKFILL_WORKERS",
+    default=4,
+    help="How many processes to download with",
+)
+@click.option(
+    "--since",
+    type=click.DateTime(),
+    envvar="BACKFILL_SINCE",
+    default=None,
+    help="The start of the history to backfill, in UTC.  Defaults to the first scrobble.",
+)
+@click.option(
+    "--until",
+    type=click.DateTime(),
+    envvar="BACKFILL_UNTIL",
+    default=None,
+    help="The end of the history to backfill, in UTC.  Defaults to the oldest listen we have, or now.",
+)
+@click.option(
+    "--windows",
+    type=click.IntRange(min=1),
+    envvar="BACKFILL_WINDOWS",
+    default=None,
+    help="How many time windows to split the history into.  Defaults to four per worker.",
+)
+@click.option(
+    "--fetch-concurrency",
+    type=click.IntRange(min=1),
+    envvar="FETCH_CONCURRENCY",
+    default=2,
+    help="How many Last.fm pages each worker fetches at the same time",
+)
+@click.option(
+    "--queue-depth",
+    type=click.IntRange(min=1),
+    envvar="QUEUE_DEPTH",
+    default=2,
+    help="How many pages can wait between pipeline stages - lower it to use less memory",
+)
+@click.option(
+    "--lastfm-timeout",
+    type=click.FloatRange(min=0, min_open=True),
+    envvar="LASTFM_TIMEOUT",
+    default=30.0,
+    help="Seconds to wait for a Last.fm page before retrying it",
+)
+@click.option(
+    "--metrics-file",
+    type=click.Path(dir_okay=False),
+    envvar="METRICS_FILE",
+    default=None,
+    help="Write stage timings and counts here at the end - a Prometheus textfile if it's .prom, else JSON",
+)
+def backfill(
+    replacements_file,
+    workers,
+    since,
+    until,
+    windows,
+    fetch_concurrency,
+    queue_depth,
+    lastfm_timeout,
+    metrics_file,
+):
+    """
+    Download a users history in parallel, split into time windows across worker processes.
+    """
+    from scrobbledownload.backfill import WorkerSettings, backfill as run_backfill
+    from scrobbledownload.database import create_sql_session
+    from scrobbledownload.services.lastfm import LastFM
+
+    secrets = Secrets()
+    session = create_sql_session(secrets.db_connection_string, secrets.db_pool)
+    lastfm = LastFM(secrets.lastfm_username, secrets.lastfm_api_key, timeout=(5, lastfm_timeout))
+    settings = WorkerSettings(
+        Secrets.get_filepath(),
+        replacements_file,
+        fetch_concurrency,
+        queue_depth,
+        lastfm_timeout,
+        logging.getLogger("scrobbledownload").level,
+    )
+    try:
+        failed = run_backfill(session, lastfm, settings, since, until, workers, windows)
+    finally:
+        if metrics_file:
+            metrics.write(metrics_file)
+    if failed:
+        raise click.ClickException(f"{len(failed)} windows failed - run the backfill again to resume them")
+
+
+@cli.command()
+@click.option(
+    "--replacements-file",
+    type=click.Path(exists=True, dir_okay=False),
+    envvar="REPLACEMENTS_FILE",
+    required=True,
+    default="/run/replacements.json",
+)
+@click.option(
+    "--spotify-cache-path",
+    type=click.Path(dir_okay=False),
+    envvar="SPOTIFY_CACHE_PATH",
+    default=None,
+    help="SQLite file to cache Spotify responses in across runs, e.g. /run/spotify_cache.sqlite",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["sync", "async"]),
+    envvar="ENRICHMENT_ENGINE",
+    default="sync",
+    help="Search Spotify one track at a time, or many at once with asyncio (needs the async extra)",
+)
+@click.option(
+    "--enrich-concurrency",
+    type=click.IntRange(min=1),
+    envvar="ENRICH_CONCURRENCY",
+    default=8,
+    help="How many tracks the async engine searches for at the same time",
+)
+@click.option(
+    "--spotify-rate-limit",
+    type=click.FloatRange(min=0, min_open=True),
+    envvar="SPOTIFY_RATE_LIMIT",
+    default=10.0,
+    help="Most Spotify requests per second the async engine will make",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    envvar="RETRY_BATCH_SIZE",
+    default=200,
+    help="How many distinct tracks to retry between commits",
+)
+@click.option(
+    "--retry-after-hours",
+    type=click.FloatRange(min=0),
+    envvar="RETRY_AFTER_HOURS",
+    default=24.0,
+    help="How long after its first retry a track is tried again - the wait doubles after every retry",
+)
+@click.option(
+    "--max-retry-after-days",
+    type=click.FloatRange(min=0),
+    envvar="MAX_RETRY_AFTER_DAYS",
+    default=90.0,
+    help="The longest wait between retries of a track",
+)
+@click.option(
+    "--metrics-file",
+    type=click.Path(dir_okay=False),
+    envvar="METRICS_FILE",
+    default=None,
+    help="Write stage timings and counts here at the end - a Prometheus textfile if it's .prom, else JSON",
+)
+def retry_unfound(
+    replacements_file,
+    spotify_cache_path,
+    engine,
+    enrich_concurrency,
+    spotify_rate_limit,
+    batch_size,
+    retry_after_hours,
+    max_retry_after_days,
+    metrics_file,
+):
+    """
+    Search Spotify again for the scrobbles that couldn't be found, with the current replacements.
+    """
+    from scrobbledownload import retry
+    from scrobbledownload.database import create_sql_session
+
     secrets = Secrets()
-    session = create_sql_session(secrets.db_connection_string)
-    spotify = Spotify.connect(secrets.spotify_credentials)
-    spotify.set_replacements(replacements_file)
+    session = create_sql_session(secrets.db_connection_string, secrets.db_pool)
+    response_cache = _connect_spotify(secrets, replacements_file, spotify_cache_path)
+    enrichment_engine = _enrichment_engine(secrets, engine, enrich_concurrency, spotify_rate_limit)
+    try:
+        retry.retry_unfound(
+            session,
+            enrichment_engine,
+            batch_size,
+            timedelta(hours=retry_after_hours),
+            timedelta(days=max_retry_after_days),
+        )
+    finally:
+        enrichment_engine.close()
+        if metrics_file:
+            metrics.write(metrics_file)
+    _close_response_cache(response_cache)
+
+
+def _connect_spotify(
+    secrets: Secrets, replacements_file: str, spotify_cache_path: Optional[str]
+) -> Optional["PersistentCache"]:
+    from scrobbledownload.cache import PersistentCache
+    from scrobbledownload.services.spotify import Spotify
+
+    Spotify.connect(secrets.spotify_credentials)
+    Spotify.set_replacements(replacements_file)
+    response_cache = None
+    if spotify_cache_path:
+        response_cache = PersistentCache(spotify_cache_path, secrets.spotify_cache_ttls)
+        Spotify.set_response_cache(response_cache)
+    return response_cache
+
+
+def _enrichment_engine(secrets: Secrets, engine: str, enrich_concurrency: int, spotify_rate_limit: float):
+    from scrobbledownload.enrichment import AsyncEnrichmentEngine, SyncEnrichmentEngine
+
+    if engine == "async":
+        from scrobbledownload.services.spotify_async import AsyncSpotify, TokenBucket
+
+        spotify_async = AsyncSpotify(
+            secrets.spotify_client_id, secrets.spotify_client_secret, TokenBucket(spotify_rate_limit)
+        )
+        return AsyncEnrichmentEngine(spotify_async, enrich_concurrency)
+    return SyncEnrichmentEngine()
+
 
-    download_tracks(session, secrets)
+def _close_response_cache(response_cache: Optional["PersistentCache"]):
+    if response_cache is not None:
+        response_cache.purge_expired()
+        logging.getLogger(__name__).info(f"Spotify response cache: {response_cache.stats()}")
+        response_cache.close()
@@ -1,11 +1,76 @@
+"""
+The database engine, and the sessions that are built from it.
+
+Each process has one engine, built by create_sessionmaker with its connection pool configured.  A session is a unit of
+work: whoever creates it hands it down to everything that needs the database, and commits once the unit - a page of
+scrobbles, say - is written, so everything in it lands in one transaction on one connection.
+"""
+from typing import Optional
+
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
 from sqlalchemy.engine.base import Engine
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import Session, sessionmaker
+
+from scrobbledownload import migrations
+
+# Connection pool settings, which the secrets file's db_pool can override
+DEFAULT_POOL = {"pool_size": 5, "max_overflow": 10, "pool_pre_ping": True, "pool_recycle": 1800}
+
+# Only pools that keep a queue of connections can be sized - an in-memory SQLite database has one connection per thread
+_QUEUE_POOL_SETTINGS = ("pool_size", "max_overflow")
+
+_engine: Optional[Engine] = None
+_sessionmaker: Optional[sessionmaker] = None
+
+
+def build_engine(db_string: str, pool: Optional[dict] = None) -> Engine:
+    """
+    Build an engine with a configured connection pool.  Connections are checked with a ping before they're handed
+    out, so one the database dropped while we were busy with the APIs is replaced rather than failing a page.
+
+    On psycopg2, executemany goes through multi-row VALUES and batched statements rather than one round trip per
+    row.  psycopg (3) and SQLite already batch inserts of many rows.
+    Args:
+        db_string (str): a SQLAlchemy connection string
+        pool (dict): settings to override DEFAULT_POOL with, e.g. {"pool_size": 10}
+
+    Returns:
+        Engine
+    """
+    url = make_url(db_string)
+    kwargs = dict(DEFAULT_POOL, **(pool or {}))
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        for setting in _QUEUE_POOL_SETTINGS:
+            kwargs.pop(setting, None)
+    if url.get_backend_name() == "postgresql" and url.get_driver_name() == "psycopg2":
+        kwargs["executemany_mode"] = "values_plus_batch"
+    return create_engine(url, **kwargs)
+
+
+def create_sessionmaker(db_string: str, pool: Optional[dict] = None):
+    """
+    Build this process's engine, and the sessionmaker that new sessions come from.  Any engine built before is
+    disposed of first.
+    Args:
+        db_string (str): a SQLAlchemy connection string
+        pool (dict): settings to override DEFAULT_POOL with
+    """
+    global _engine, _sessionmaker
+    dispose()
+    _engine = build_engine(db_string, pool)
+    _sessionmaker = sessionmaker(bind=_engine)
 
-from scrobbledownload.models import create_all
 
-_engine: Engine
-_sessionmaker: sessionmaker
+def get_engine() -> Engine:
+    """
+    Get this process's engine, from create_sessionmaker
+    Returns:
+        Engine
+    """
+    if _engine is None:
+        raise RuntimeError("The database hasn't been set up - call create_sessionmaker first")
+    return _engine
 
 
 def get_session() -> Session:
@@ -14,24 +79,31 @@ def get_session() -> Session:
     Returns:
         Session
     """
+    if _sessionmaker is None:
+        raise RuntimeError("The database hasn't been set up - call create_sessionmaker first")
     return _sessionmaker()
 
 
-def create_sessionmaker(db_string):
-    global engine, _sessionmaker
-    engine = create_engine(db_string)
-    _sessionmaker = sessionmaker(bind=engine)
+def dispose():
+    """
+    Close every pooled connection of this process's engine, if it has one
+    """
+    global _engine, _sessionmaker
+    if _engine is not None:
+        _engine.dispose()
+    _engine = _sessionmaker = None
 
 
-def create_sql_session(db_string: str):
+def create_sql_session(db_string: str, pool: Optional[dict] = None) -> Session:
     """
-    Creates a sql session
+    Creates a sql session, after checking the database is at the current schema version and migrating it if not
     Args:
         db_string (str): a SQLAlchemy connection string.
+        pool (dict): settings to override DEFAULT_POOL with
 
     Returns:
         Session
     """
-    create_sessionmaker(db_string)
-    create_all(engine)
+    create_sessionmaker(db_string, pool)
+    migrations.ensure_schema(_engine)
     return _sessionmaker()
@@ -4,56 +4,278 @@ Downloads and processes tracks
 TODO make this a downloader object
 """
 import logging
-from datetime import datetime
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from itertools import takewhile
+from typing import Dict, List, Optional, Set, Tuple
 
 from sqlalchemy.orm import Session
-from sqlalchemy.sql import func
 
-from scrobbledownload.models import Listen, UnfoundTracks
-from scrobbledownload.models.scrobbles import ScrobbleDownloader, ScrobbleTrack
-from scrobbledownload.secrets import spotify_creds, Secrets
-from scrobbledownload.services.track import TrackMetadata
+from scrobbledownload import metrics, models, upsert
+from scrobbledownload.enrichment import EnrichmentEngine, SyncEnrichmentEngine
+from scrobbledownload.models import Listen, SyncState, UnfoundTracks
+from scrobbledownload.models.scrobbles import ScrobbleDownloader, Scrobbles, ScrobbleTrack
+from scrobbledownload.models.spotify_models import SpotifyAlbum, SpotifyArtist, SpotifyTrack
+from scrobbledownload.pipeline import Pipeline, StopPipeline
+from scrobbledownload.secrets import Secrets
+from scrobbledownload.services.album import Album
+from scrobbledownload.services.artist import Artist
+from scrobbledownload.services.lastfm import LastFM
+from scrobbledownload.services.spotify import Spotify
+from scrobbledownload.services.track import Track, TrackIndex
 
 logger = logging.getLogger(__name__)
 
+# The kinds of SyncState that download_tracks makes, and so resumes - a backfill's windows are the backfill's to resume
+KINDS = ("sync", "gap")
 
-def process_track(track: ScrobbleTrack, session: Session):
+
+def group_by_track(tracks: List[ScrobbleTrack]) -> Dict[str, List[ScrobbleTrack]]:
+    """
+    Collapse a page of scrobbles by Track.hash, so a song played on repeat is only looked up once.
+    Args:
+        tracks (list(ScrobbleTrack)): the page of track objects
+
+    Returns:
+        dict(str, list(ScrobbleTrack)) - the scrobbles of each distinct track, in the order they were first seen
+    """
+    groups: Dict[str, List[ScrobbleTrack]] = {}
+    for t in tracks:
+        groups.setdefault(Track.generate_id(t.track_name, t.artist, t.album), []).append(t)
+    return groups
+
+
+@dataclass
+class PagePlan(object):
+    """
+    A page of scrobbles on its way through the pipeline: grouped by track, with whatever had to be fetched from
+    Spotify for the tracks this page is responsible for creating.
+    """
+
+    page: int
+    groups: Dict[str, List[ScrobbleTrack]]
+    unknown: List[str]
+    total_pages: int = 0
+    found: Dict[str, SpotifyTrack] = field(default_factory=dict)
+    artists: Dict[str, SpotifyArtist] = field(default_factory=dict)
+    albums: Dict[str, SpotifyAlbum] = field(default_factory=dict)
+
+
+class PageEnricher(object):
+    """
+    Works out what each page needs from Spotify, and fetches it, without touching the database - so it can run in its
+    own pipeline stage while the previous page is being written.
+
+    Every track this enricher hands out for searching is claimed, so a track that turns up again on a later page (even
+    one planned before the first is written) is only searched for and created once.
+    """
+
+    def __init__(
+        self,
+        engine: EnrichmentEngine,
+        track_index: TrackIndex,
+        artist_ids: Optional[Set[str]] = None,
+        album_ids: Optional[Set[str]] = None,
+    ):
+        """
+        Args:
+            engine (EnrichmentEngine): How tracks are searched for on Spotify
+            track_index (TrackIndex): Known track ids
+            artist_ids (set(str)): Spotify IDs of every artist we have.  Without them, artists are left to write_page.
+            album_ids (set(str)): Spotify IDs of every album we have.  Without them, albums are left to write_page.
+        """
+        self._engine = engine
+        self._track_index = track_index
+        self._artist_ids = artist_ids
+        self._album_ids = album_ids
+        self._claimed: Set[str] = set()
+
+    @classmethod
+    def load(
+        cls, session: Session, engine: EnrichmentEngine, track_index: TrackIndex = None
+    ) -> "PageEnricher":
+        """
+        Build an enricher that knows every track, artist and album in the database, so no stage but the writer needs a
+        database connection.
+        Args:
+            session (Session): The sqlalchemy session
+            engine (EnrichmentEngine): How tracks are searched for on Spotify
+            track_index (TrackIndex): A complete track index, if one's already loaded
+
+        Returns:
+            PageEnricher
+        """
+        return cls(
+            engine,
+            track_index or TrackIndex.load(session),
+            {x for x, in session.query(models.Artist.spotify_id)},
+            {x for x, in session.query(models.Album.spotify_id)},
+        )
+
+    def plan(
+        self, tracks: List[ScrobbleTrack], page: int = 0, session: Session = None, total_pages: int = 0
+    ) -> PagePlan:
+        """
+        Group a page by track, and claim the tracks nobody has created or claimed yet.
+        Args:
+            tracks (list(ScrobbleTrack)): the page of track objects
+            page (int): the page number
+            session (Session): Only needed if the track index isn't complete, to look the page's tracks up
+            total_pages (int): how many pages there are
+
+        Returns:
+            PagePlan
+        """
+        with metrics.timer("track.lookup"):
+            groups = group_by_track(tracks)
+            if session is not None and not self._track_index.complete:
+                self._track_index.resolve(groups, session)
+            unknown = [g for g in groups if g not in self._track_index and g not in self._claimed]
+            self._claimed.update(unknown)
+        metrics.incr("tracks.distinct", len(groups))
+        metrics.incr("tracks.unknown", len(unknown))
+        return PagePlan(page=page, groups=groups, unknown=unknown, total_pages=total_pages)
+
+    def enrich(self, plan: PagePlan) -> PagePlan:
+        """
+        Search Spotify for the tracks the page has claimed, and fetch any of their artists and albums we don't have
+        in a handful of batched calls.
+        Args:
+            plan (PagePlan): the planned page
+
+        Returns:
+            PagePlan
+        """
+        unknown = {}
+        for generated_id in plan.unknown:
+            first = plan.groups[generated_id][0]
+            unknown[generated_id] = Track(None, first.track_name, first.artist, first.album, first.track_mbid)
+        with metrics.timer("spotify.search"):
+            plan.found = self._engine.search_tracks(unknown)
+
+        if self._artist_ids is not None:
+            missing = {t.artist_id for t in plan.found.values()} - self._artist_ids
+            plan.artists = {a.spotify_id: a for a in Spotify.get_artists(sorted(missing))} if missing else {}
+            self._artist_ids.update(plan.artists)
+        if self._album_ids is not None:
+            missing = {t.album_id for t in plan.found.values()} - self._album_ids
+            plan.albums = {a.spotify_id: a for a in Spotify.get_albums(sorted(missing))} if missing else {}
+            self._album_ids.update(plan.albums)
+        return plan
+
+
+def create_tracks(plan: PagePlan, session: Session, track_index: TrackIndex):
+    """
+    Create the tracks a page found on Spotify, along with any of their artists and albums we don't have, and add them
+    to the track index once they have ids.  Nothing is committed here.
+    Args:
+        plan (PagePlan): the enriched page
+        session (Session): The sqlalchemy session
+        track_index (TrackIndex): Known track ids
+    """
+    with metrics.timer("db.artists_albums"):
+        artist_ids = Artist.get_artist_ids((t.artist_id for t in plan.found.values()), session, plan.artists)
+        album_ids = Album.get_album_ids((t.album_id for t in plan.found.values()), session, plan.albums)
+
+    rows = []
+    for generated_id, spotify_track in plan.found.items():
+        first = plan.groups[generated_id][0]
+        artist_id = artist_ids.get(spotify_track.artist_id)
+        album_id = album_ids.get(spotify_track.album_id)
+        if artist_id is None or album_id is None:
+            logger.warning(f"Spotify had no artist or album for {first.track_name} by {first.artist}")
+            continue
+        track = Track(session, first.track_name, first.artist, first.album, first.track_mbid)
+        rows.append(track.to_row(spotify_track, artist_id, album_id))
+
+    # New tracks need their ids before their listens can be written, so they come back from the upsert
+    with metrics.timer("db.upsert_tracks"):
+        ids, created = upsert.insert_missing(session, models.Track.__table__, rows, "generated_id")
+    metrics.incr("tracks.created", len(created))
+    for generated_id, track_id in ids.items():
+        track_index.add(generated_id, track_id)
+
+
+def write_page(plan: PagePlan, session: Session, track_index: TrackIndex):
+    """
+    Write a planned page to the database: the tracks it found (and their artists and albums), then every listen.
+
+    Once the new tracks have ids, they're fanned back out to every listen, and the page's listens are written with one
+    multi-row insert.  Any listen whose track we still can't resolve is written to the unfound tracks instead.
+    Nothing is committed here.
+    Args:
+        plan (PagePlan): the enriched page
+        session (Session): The sqlalchemy session
+        track_index (TrackIndex): Known track ids
     """
-    Processes a single track, adding it to the database
+    create_tracks(plan, session, track_index)
+    known = track_index.resolve(plan.groups, session)
+    listens = [
+        {"dt": scrobble.listen_dt, "track_id": known[generated_id]}
+        for generated_id, scrobbles in plan.groups.items()
+        if generated_id in known
+        for scrobble in scrobbles
+    ]
+    unfound = [
+        scrobble
+        for generated_id, scrobbles in plan.groups.items()
+        if generated_id not in known
+        for scrobble in scrobbles
+    ]
+    with metrics.timer("db.insert"):
+        Listen.insert_many(listens, session)
+        save_unfound_tracks(unfound, session)
+    metrics.incr("listens.saved", len(listens))
+    metrics.incr("listens.unfound", len(unfound))
+
+
+def process_page(
+    tracks: List[ScrobbleTrack],
+    session: Session,
+    track_index: TrackIndex = None,
+    engine: EnrichmentEngine = None,
+):
+    """
+    Processes a page of tracks, adding them to the database, one step after another.
+
+    The page is grouped by track, and each distinct track is resolved against the track index up front.  Only the
+    tracks we don't already have are searched for on Spotify, once each, and their artists and albums are then fetched
+    in a handful of batched calls before everything is written.
     Args:
-        track (ScrobbleTrack): a single track object
+        tracks (list(ScrobbleTrack)): the page of track objects
         session (Session): The sqlalchemy session
+        track_index (TrackIndex): Known track ids.  Without one, they're looked up with a query for this page.
+        engine (EnrichmentEngine): How tracks are searched for on Spotify.  Defaults to one at a time.
     """
-    track_metadata = TrackMetadata(
-        track_name=track.track_name,
-        track_artist=track.artist,
-        track_album=track.album,
-        mbid=track.track_mbid,
-        session=session,
-        spotify_credentials=spotify_creds,
-    ).get_or_create_track()
-    session.add(track_metadata)
-    listen = Listen(dt=track.listen_dt, track=track_metadata)
-    session.add(listen)
+    if track_index is None:
+        track_index = TrackIndex()
+    enricher = PageEnricher(engine or SyncEnrichmentEngine(), track_index)
+    plan = enricher.enrich(enricher.plan(tracks, session=session))
+    write_page(plan, session, track_index)
 
 
-def save_unfound_track(track: ScrobbleTrack, session: Session):
+def save_unfound_tracks(tracks: List[ScrobbleTrack], session: Session):
     """
     If a Track can't be gathered from the requisite sources, we just shove it in a secondary table for later processing.
     Args:
-        track (ScrobbleTrack): a single track object
+        tracks (list(ScrobbleTrack)): the track objects we couldn't find
         session (Session): The sqlalchemy session
     """
-    t = UnfoundTracks(
-        track_name=track.track_name,
-        track_mbid=track.track_mbid,
-        dt=track.listen_dt,
-        artist=track.artist,
-        artist_mbid=track.artist_mbid,
-        album=track.album,
-        album_mbid=track.album_mbid,
+    UnfoundTracks.insert_many(
+        [
+            {
+                "track_name": track.track_name,
+                "track_mbid": track.track_mbid,
+                "dt": track.listen_dt,
+                "artist": track.artist,
+                "artist_mbid": track.artist_mbid,
+                "album": track.album,
+                "album_mbid": track.album_mbid,
+            }
+            for track in tracks
+        ],
+        session,
     )
-    session.add(t)
 
 
 def get_last_downloaded_listen(session: Session) -> datetime:
@@ -65,46 +287,198 @@ def get_last_downloaded_listen(session: Session) -> datetime:
     Returns:
         datetime
     """
-    last_listen_downloaded = session.query(func.max(Listen.dt)).scalar()
-    if last_listen_downloaded is None:
-        last_listen_downloaded = datetime(1970, 1, 1)
-    return last_listen_downloaded
+    return Listen.get_last_listen(session)
 
 
-def download_tracks(session: Session, secrets: Secrets):
+class WindowDownloader(object):
+    """
+    Downloads windows of a users history through the pipeline, checkpointing each one's progress in a SyncState as
+    its pages are written, so an interrupted window resumes from the page after the last one written.
     """
-    Downloads and processes tracks.  It does so a page at a time, breaking if has caught up or run out of data.
+
+    def __init__(
+        self,
+        session: Session,
+        lastfm: LastFM,
+        enricher: PageEnricher,
+        track_index: TrackIndex,
+        scrobbles_per_page: int = 1000,
+        fetch_concurrency: int = 1,
+        queue_depth: int = 2,
+    ):
+        """
+        Args:
+            session (Session): The SQLAlchemy Session
+            lastfm (LastFM): The Last.fm API
+            enricher (PageEnricher): Finds each page's new tracks on Spotify
+            track_index (TrackIndex): Known track ids
+            scrobbles_per_page (int): How many scrobbles to ask Last.fm for per page
+            fetch_concurrency (int): How many Last.fm pages can be fetched at the same time
+            queue_depth (int): How many pages can wait between any two stages
+        """
+        self._session = session
+        self._lastfm = lastfm
+        self._enricher = enricher
+        self._track_index = track_index
+        self._scrobbles_per_page = scrobbles_per_page
+        self._fetch_concurrency = fetch_concurrency
+        self._queue_depth = queue_depth
+
+    def download(self, state: SyncState):
+        """
+        Download a window, from the page after its last written one, and mark it complete.  A resumed window is
+        downloaded in the page size its last page was counted in, whatever ours is now.
+        Args:
+            state (SyncState): the window
+        """
+        start_page = state.last_page + 1
+        if state.page_size is None:
+            # A window that was planned ahead, or is from before page sizes were recorded, goes by ours
+            state.page_size = self._scrobbles_per_page
+        if state.last_page:
+            logger.info(
+                f"Resuming the download of {state.from_dt} to {state.to_dt} from page {start_page}, "
+                f"at {state.page_size} scrobbles per page"
+            )
+        else:
+            logger.info(f"Downloading scrobbles from {state.to_dt} back to {state.from_dt}")
+        pages = self._lastfm.download_pages(
+            state.page_size,
+            self._fetch_concurrency,
+            from_dt=state.from_dt,
+            to_dt=state.to_dt,
+            start_page=start_page,
+        )
+        from_dt = state.from_dt or datetime(1970, 1, 1)
+
+        def plan(scrobbles: Scrobbles) -> PagePlan:
+            logger.info(
+                f"\n\nGot {len(scrobbles.tracks)} scrobbles\nPage {scrobbles.page} of {scrobbles.totalPages}"
+            )
+            new_tracks = list(takewhile(lambda t: t.listen_dt > from_dt, scrobbles.tracks))
+            in_window = [t for t in new_tracks if t.listen_dt < state.to_dt]
+            page_plan = self._enricher.plan(in_window, scrobbles.page, total_pages=scrobbles.totalPages)
+            if len(new_tracks) < len(scrobbles.tracks):
+                logger.info("Caught up, breaking")
+                raise StopPipeline(page_plan)
+            return page_plan
+
+        def write(page_plan: PagePlan):
+            with metrics.timer("db.write"):
+                write_page(page_plan, self._session, self._track_index)
+            oldest = min((s.listen_dt for g in page_plan.groups.values() for s in g), default=None)
+            # The checkpoint lands in the same transaction as the page
+            state.checkpoint(page_plan.page, page_plan.total_pages, oldest)
+            with metrics.timer("db.commit"):
+                self._session.commit()
+
+        Pipeline(self._queue_depth).run(pages, [plan, self._enricher.enrich], write)
+        state.complete()
+        self._session.commit()
+
+
+def download_tracks(
+    session: Session,
+    secrets: Secrets,
+    fetch_concurrency: int = 1,
+    engine: EnrichmentEngine = None,
+    queue_depth: int = 2,
+    lastfm_timeout: float = 30,
+    min_gap: Optional[timedelta] = None,
+):
+    """
+    Downloads and processes tracks, breaking if has caught up or run out of data.
+
+    Only scrobbles after the last listen we already have are requested from Last.fm, so an incremental run is usually
+    a single small page.  Pages stream through a pipeline - fetch and parse, dedupe and look up, enrich from Spotify,
+    write - with every stage in its own thread, so fetching, enrichment and database writes overlap.  The queues
+    between stages hold at most `queue_depth` pages, which keeps memory flat however big the history is.
+
+    Each run's window is recorded in the sync_state table, with its progress committed along with every page.  Any
+    earlier run that didn't finish - say a first download that crashed part way back through the history - is resumed
+    from the page after its last written one before anything else.  Unfinished backfill windows are left alone, as
+    their backfill might still be running.  Once this run's window is done, it's merged with the earlier ones it
+    overlaps, so there's one row for everything synced rather than one per run.  With `min_gap`, holes in the listens
+    timeline are then looked for and filled, see fill_gaps.
+
+    Each stage is timed in scrobbledownload.metrics, which is reset at the start and logged at the end.
     Args:
         session (Session): The SQLAlchemy Session
         secrets (Secrets): The secrets model
+        fetch_concurrency (int): How many Last.fm pages can be fetched at the same time
+        engine (EnrichmentEngine): How tracks are searched for on Spotify.  Defaults to one at a time.
+        queue_depth (int): How many pages can wait between any two stages
+        lastfm_timeout (float): How long to wait for a Last.fm page, in seconds, before retrying it
+        min_gap (timedelta): Fill holes in the listens timeline longer than this
     """
-    last_listen_downloaded = get_last_downloaded_listen(session)
+    metrics.reset()
+    lastfm = LastFM(
+        secrets.lastfm_username, secrets.lastfm_api_key, timeout=(5, lastfm_timeout), pool_size=fetch_concurrency
+    )
+    with metrics.timer("db.load_index"):
+        track_index = TrackIndex.load(session)
+        enricher = PageEnricher.load(session, engine or SyncEnrichmentEngine(), track_index)
+    logger.info(f"Loaded {len(track_index)} known tracks")
+    downloader = WindowDownloader(
+        session, lastfm, enricher, track_index, secrets.scrobbles_per_page, fetch_concurrency, queue_depth
+    )
 
-    logger.info(f"Downloading scrobbles from now back to {last_listen_downloaded}")
-    sd = ScrobbleDownloader(secrets)
+    with metrics.timer("run"):
+        for state in SyncState.incomplete(session, KINDS):
+            downloader.download(state)
 
-    page = 1
-    keep_going = True
-    while keep_going:
-        scrobbles = sd.get(page)
-        logger.info(f"\n\nGot {len(scrobbles.tracks)} scrobbles\nPage {page} of {scrobbles.totalPages}")
+        last_listen_downloaded = get_last_downloaded_listen(session)
+        from_dt = last_listen_downloaded if last_listen_downloaded > datetime(1970, 1, 1) else None
+        # Last.fm's windows are in whole seconds
+        to_dt = datetime.utcnow().replace(microsecond=0)
+        downloader.download(SyncState.start("sync", from_dt, to_dt, session, secrets.scrobbles_per_page))
+        SyncState.merge_completed(session, "sync")
+        session.commit()
 
-        for t in scrobbles.tracks:
-            if t.listen_dt < last_listen_downloaded:
-                logger.info("Caught up, breaking")
-                keep_going = False
-                break
-            try:
-                process_track(t, session)
-            except Exception as e:
-                logger.exception("Unable to find track!", exc_info=e)
-                save_unfound_track(t, session)
+        if min_gap is not None:
+            fill_gaps(session, downloader, min_gap)
+
+    logger.info(f"Spotify search cache: {Spotify.search_cache_stats()}")
+    logger.info(f"Stage timings and counts:\n{metrics.summary()}")
 
-        session.commit()
 
-        if page == scrobbles.totalPages or len(scrobbles.tracks) == 0:
-            break
-        page += 1
+def find_gaps(session: Session, min_gap: timedelta) -> List[Tuple[datetime, datetime]]:
+    """
+    Find the holes in the listens timeline: stretches longer than `min_gap` without a listen, that no completed
+    download has covered.  A gap might just be a quiet month, but checking one costs a single Last.fm request, and
+    once it's been checked it's covered.
+    Args:
+        session (Session): The SQLAlchemy Session
+        min_gap (timedelta): The shortest stretch without a listen that counts
+
+    Returns:
+        list((datetime, datetime)) - the listens either side of each gap, oldest first
+    """
+    covered = SyncState.completed_windows(session)
+    gaps = []
+    previous = None
+    # A streamed scan of the listens(dt) index, which is simpler than a window function that works everywhere
+    for (dt,) in session.query(Listen.dt).filter(Listen.dt.isnot(None)).order_by(Listen.dt).yield_per(10000):
+        if previous is not None and dt - previous > min_gap:
+            if not any((start is None or start <= previous) and dt <= end for start, end in covered):
+                gaps.append((previous, dt))
+        previous = dt
+    return gaps
+
+
+def fill_gaps(session: Session, downloader: WindowDownloader, min_gap: timedelta):
+    """
+    Download just the holes in the listens timeline, each as a window of its own
+    Args:
+        session (Session): The SQLAlchemy Session
+        downloader (WindowDownloader): Downloads the windows
+        min_gap (timedelta): The shortest stretch without a listen that counts
+    """
+    gaps = find_gaps(session, min_gap)
+    logger.info(f"Found {len(gaps)} gaps in the listens longer than {min_gap}")
+    metrics.incr("sync.gaps", len(gaps))
+    for from_dt, to_dt in gaps:
+        downloader.download(SyncState.start("gap", from_dt, to_dt, session))
 
 
 def test_downloading(session, secrets):
@@ -0,0 +1,92 @@
+"""
+Enrichment engines - how the distinct, unknown tracks on a page get found on Spotify.
+
+The sync engine searches one track at a time through the Spotify class.  The async engine runs many searches at once
+on an event loop, rate limited against Spotify's 429s, which is the biggest wall-clock win for large backfills.
+"""
+import asyncio
+import logging
+from typing import Dict, Optional, Union
+
+from scrobbledownload.models.spotify_models import SpotifyTrack
+from scrobbledownload.services.spotify import SpotifyNotFoundExcecption
+from scrobbledownload.services.track import Track
+
+logger = logging.getLogger(__name__)
+
+
+class SyncEnrichmentEngine(object):
+    """
+    Searches for tracks one after another.
+    """
+
+    def search_tracks(self, tracks: Dict[str, Track]) -> Dict[str, SpotifyTrack]:
+        """
+        Find tracks on Spotify.
+        Args:
+            tracks (dict(str, Track)): the tracks to find, by Track.hash
+
+        Returns:
+            dict(str, SpotifyTrack) - the tracks that were found, by Track.hash
+        """
+        found = {}
+        for generated_id, track in tracks.items():
+            try:
+                found[generated_id] = track.search()
+            except (Exception, SpotifyNotFoundExcecption) as e:
+                logger.exception("Unable to find track!", exc_info=e)
+        return found
+
+    def close(self):
+        pass
+
+
+class AsyncEnrichmentEngine(object):
+    """
+    Searches for up to `concurrency` tracks at a time, on an event loop the engine keeps for its whole life so the
+    HTTP client's connections are reused from one page to the next.
+    """
+
+    def __init__(self, spotify, concurrency: int = 8):
+        """
+        Args:
+            spotify (AsyncSpotify): the async Spotify client
+            concurrency (int): how many tracks to search for at the same time
+        """
+        self._spotify = spotify
+        self._concurrency = concurrency
+        self._loop = asyncio.new_event_loop()
+
+    def search_tracks(self, tracks: Dict[str, Track]) -> Dict[str, SpotifyTrack]:
+        """
+        Find tracks on Spotify.
+        Args:
+            tracks (dict(str, Track)): the tracks to find, by Track.hash
+
+        Returns:
+            dict(str, SpotifyTrack) - the tracks that were found, by Track.hash
+        """
+        return self._loop.run_until_complete(self._search_tracks(tracks))
+
+    async def _search_tracks(self, tracks: Dict[str, Track]) -> Dict[str, SpotifyTrack]:
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def search(track: Track) -> Optional[SpotifyTrack]:
+            # SpotifyNotFoundExcecption is a BaseException, which asyncio re-raises out of the loop on 3.7 rather
+            # than handing it to gather, so it's caught here for every track
+            try:
+                async with semaphore:
+                    return await self._spotify.get_track(track.track_name, track.track_artist, track.track_album)
+            except (Exception, SpotifyNotFoundExcecption) as e:
+                logger.error(f"Unable to find track! {e!r}")
+                return None
+
+        results = await asyncio.gather(*(search(t) for t in tracks.values()))
+        return {generated_id: result for generated_id, result in zip(tracks, results) if result is not None}
+
+    def close(self):
+        self._loop.run_until_complete(self._spotify.close())
+        self._loop.close()
+
+
+EnrichmentEngine = Union[SyncEnrichmentEngine, AsyncEnrichmentEngine]
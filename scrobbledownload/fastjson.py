@@ -0,0 +1,29 @@
+"""
+JSON decoding, through orjson when it's installed and the standard library otherwise.  Last.fm pages of 1000 scrobbles
+are big enough that decoding them shows up in profiles, and orjson is several times faster.
+
+orjson is an optional dependency: pip install scrobbledownloader[fast]
+"""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - only when the fast extra isn't installed
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """
+    Decode a JSON document
+    Args:
+        data (bytes or str): the raw JSON, e.g. a response's content
+
+    Returns:
+        The decoded object
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,172 @@
+"""
+Matching Last.fm scrobbles to Spotify search results.
+
+Rather than taking the first result of ever-shorter searches, we ask Spotify for a page of candidates and score each
+one locally, on how similar its title and artist are to the scrobble's (with and without decorations like
+"(Remastered)" and "feat. ..."), with the album and duration, when we have them, to settle close calls.
+"""
+import re
+from difflib import SequenceMatcher
+from typing import List, Optional, Sequence
+
+from scrobbledownload.models.spotify_models import SpotifyTrack
+from scrobbledownload.normalization import fold
+
+# Decorations that don't change which recording a title refers to, as far as finding it is concerned
+_DECORATION_WORDS = (
+    r"remaster(?:ed)?|live|version|edit|mono|stereo|deluxe|bonus|explicit|single|anniversary|acoustic|demo"
+)
+_FEATURING = r"feat\.?|ft\.?|featuring"
+# Spotify writes featured artists as "(with ...)", but "with" anywhere else in brackets is part of the title
+_BRACKETED = re.compile(
+    rf"\s*[(\[](?:\s*with\b|[^)\]]*\b(?:{_DECORATION_WORDS}|{_FEATURING})\b)[^)\]]*[)\]]", re.IGNORECASE
+)
+_DASH_SUFFIX = re.compile(rf"\s+-\s+[^-]*\b(?:{_DECORATION_WORDS})\b.*$", re.IGNORECASE)
+_FEATURING_SUFFIX = re.compile(rf"\s+(?:{_FEATURING})\s+.*$", re.IGNORECASE)
+
+MATCH_THRESHOLD = 0.75
+MIN_TITLE_SIMILARITY = 0.6
+
+
+def strip_title(title: str) -> str:
+    """
+    Strip the decorations off a track title - "Go Your Own Way - 2004 Remaster" and "Go Your Own Way (feat. Someone)"
+    both become "Go Your Own Way".
+    Args:
+        title (str): a track title
+
+    Returns:
+        str - the stripped title, or the title as it was if there'd be nothing left
+    """
+    stripped = _FEATURING_SUFFIX.sub("", _DASH_SUFFIX.sub("", _BRACKETED.sub("", title))).strip()
+    return stripped or title
+
+
+def strip_artist(artist: str) -> str:
+    """
+    Strip any featured artists off an artist name
+    Args:
+        artist (str): an artist name
+
+    Returns:
+        str
+    """
+    return _FEATURING_SUFFIX.sub("", artist).strip() or artist
+
+
+def similarity(a: str, b: str) -> float:
+    """
+    How similar two names are, from 0 to 1, once normalized
+    Args:
+        a (str):
+        b (str):
+
+    Returns:
+        float
+    """
+    a, b = fold(a), fold(b)
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def _title_similarity(wanted: str, candidate: str) -> float:
+    wanted_forms, candidate_forms = {wanted, strip_title(wanted)}, {candidate, strip_title(candidate)}
+    return max(similarity(a, b) for a in wanted_forms for b in candidate_forms)
+
+
+def _artist_similarity(wanted: str, candidate: str) -> float:
+    score = max(similarity(wanted, candidate), similarity(strip_artist(wanted), candidate))
+    # Last.fm often credits every artist ("A & B"), where Spotify's first artist is just one of them
+    wanted_words, candidate_words = set(fold(wanted).split()), set(fold(candidate).split())
+    if candidate_words and candidate_words <= wanted_words:
+        score = max(score, 0.9)
+    return score
+
+
+def score(
+    candidate: SpotifyTrack,
+    track_name: str,
+    track_artist: str,
+    track_album: Optional[str] = None,
+    duration_ms: Optional[int] = None,
+    artist_alias: Optional[str] = None,
+) -> float:
+    """
+    Score how well a search result matches a scrobble.  Title and artist similarity make up the score, the album adds
+    a little, and a duration that's well off takes a little away.
+    Args:
+        candidate (SpotifyTrack): a search result
+        track_name (str): the scrobble's track name
+        track_artist (str): the scrobble's artist
+        track_album (str): the scrobble's album, if we know it
+        duration_ms (int): the scrobble's duration, if we know it
+        artist_alias (str): another name for the artist, like the edge-case replacement we searched with
+
+    Returns:
+        float - roughly 0 to 1
+    """
+    title = _title_similarity(track_name, candidate.name)
+    if title < MIN_TITLE_SIMILARITY:
+        return 0.0
+    if candidate.artist_name:
+        artist = _artist_similarity(track_artist, candidate.artist_name)
+        if artist_alias:
+            artist = max(artist, _artist_similarity(artist_alias, candidate.artist_name))
+        result = 0.65 * title + 0.35 * artist
+    else:
+        # We searched by artist, so without a name to go on, trust the search
+        result = title
+    if track_album and candidate.album_name:
+        result += 0.05 * _title_similarity(track_album, candidate.album_name)
+    if duration_ms and candidate.duration_ms:
+        off_by = abs(duration_ms - candidate.duration_ms)
+        if off_by > 3000:
+            result -= 0.15 * min(off_by / 30000, 1.0)
+    return result
+
+
+def best_match(
+    candidates: Sequence[SpotifyTrack],
+    track_name: str,
+    track_artist: str,
+    track_album: Optional[str] = None,
+    duration_ms: Optional[int] = None,
+    threshold: float = MATCH_THRESHOLD,
+    artist_alias: Optional[str] = None,
+) -> Optional[SpotifyTrack]:
+    """
+    Pick the search result that best matches a scrobble.  Ties go to whichever Spotify ranked first.
+    Args:
+        candidates (list(SpotifyTrack)): the search results, in Spotify's order
+        track_name (str): the scrobble's track name
+        track_artist (str): the scrobble's artist
+        track_album (str): the scrobble's album, if we know it
+        duration_ms (int): the scrobble's duration, if we know it
+        threshold (float): the lowest score that counts as a match
+        artist_alias (str): another name for the artist, like the edge-case replacement we searched with
+
+    Returns:
+        SpotifyTrack, or None if nothing matches well enough
+    """
+    best, best_score = None, threshold
+    for candidate in candidates:
+        candidate_score = score(candidate, track_name, track_artist, track_album, duration_ms, artist_alias)
+        if candidate_score >= best_score and (best is None or candidate_score > best_score):
+            best, best_score = candidate, candidate_score
+    return best
+
+
+def title_variants(track_name: str) -> List[str]:
+    """
+    The forms of a title worth searching for, most likely to match first: stripped of decorations, then as it was.
+    Args:
+        track_name (str): the scrobble's track name
+
+    Returns:
+        list(str)
+    """
+    stripped = strip_title(track_name)
+    return [stripped] if stripped == track_name else [stripped, track_name]
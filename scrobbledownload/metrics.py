@@ -0,0 +1,176 @@
+"""
+Timings and counts for each stage of a run, so a slow run shows where its time went without attaching a profiler.
+
+Stages are timed with `timer` and events counted with `incr`, into one process-wide registry:
+
+    with metrics.timer("lastfm.fetch"):
+        ...
+    metrics.incr("spotify.search.fallbacks", 2)
+
+`summary` gives a table for the end of a run, and `write` saves everything as JSON or as a Prometheus textfile (for
+node_exporter's textfile collector), depending on the file extension.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator
+
+
+class Metrics(object):
+    """
+    A thread-safe registry of stage timers and event counters.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.perf_counter):
+        """
+        Args:
+            clock (callable): Where the time comes from, in seconds
+        """
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._timers: Dict[str, Dict[str, float]] = {}
+        self._counters: Dict[str, int] = {}
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """
+        Time a block of code as one call of a stage.  It's recorded even if the block raises.
+        Args:
+            name (str): the stage, e.g. "lastfm.fetch"
+        """
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.observe(name, self._clock() - start)
+
+    def observe(self, name: str, seconds: float):
+        """
+        Record one call of a stage that was timed some other way
+        Args:
+            name (str): the stage
+            seconds (float): how long it took
+        """
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                timer = self._timers[name] = {"calls": 0, "seconds": 0.0, "max": 0.0}
+            timer["calls"] += 1
+            timer["seconds"] += seconds
+            timer["max"] = max(timer["max"], seconds)
+
+    def incr(self, name: str, n: int = 1):
+        """
+        Count some events
+        Args:
+            name (str): the event, e.g. "spotify.search.requests"
+            n (int): how many
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def reset(self):
+        with self._lock:
+            self._timers.clear()
+            self._counters.clear()
+
+    def snapshot(self) -> dict:
+        """
+        Get a copy of everything recorded so far
+        Returns:
+            dict - {"timers": {stage: {"calls", "seconds", "max"}}, "counters": {event: count}}
+        """
+        with self._lock:
+            return {
+                "timers": {name: dict(timer) for name, timer in self._timers.items()},
+                "counters": dict(self._counters),
+            }
+
+    def merge(self, snapshot: dict):
+        """
+        Add a snapshot recorded somewhere else - another process, say - into this registry
+        Args:
+            snapshot (dict): as from snapshot
+        """
+        with self._lock:
+            for name, other in snapshot.get("timers", {}).items():
+                timer = self._timers.get(name)
+                if timer is None:
+                    timer = self._timers[name] = {"calls": 0, "seconds": 0.0, "max": 0.0}
+                timer["calls"] += other["calls"]
+                timer["seconds"] += other["seconds"]
+                timer["max"] = max(timer["max"], other["max"])
+            for name, count in snapshot.get("counters", {}).items():
+                self._counters[name] = self._counters.get(name, 0) + count
+
+    def summary(self) -> str:
+        """
+        A table of every stage and counter, slowest stage first
+        Returns:
+            str
+        """
+        snapshot = self.snapshot()
+        lines = [f"{'stage':<28}{'calls':>9}{'total s':>11}{'mean ms':>11}{'max ms':>11}"]
+        for name, t in sorted(snapshot["timers"].items(), key=lambda item: -item[1]["seconds"]):
+            mean = t["seconds"] / t["calls"] * 1000 if t["calls"] else 0.0
+            lines.append(
+                f"{name:<28}{t['calls']:>9}{t['seconds']:>11.3f}{mean:>11.2f}{t['max'] * 1000:>11.2f}"
+            )
+        if snapshot["counters"]:
+            lines.append(f"{'counter':<28}{'count':>9}")
+            for name, count in sorted(snapshot["counters"].items()):
+                lines.append(f"{name:<28}{count:>9}")
+        return "\n".join(lines)
+
+    def to_prometheus(self, prefix: str = "scrobbledownload") -> str:
+        """
+        Everything recorded so far, in the Prometheus text exposition format
+        Args:
+            prefix (str): prepended to every metric name
+
+        Returns:
+            str
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for suffix, key, kind in (
+            ("stage_seconds_total", "seconds", "counter"),
+            ("stage_calls_total", "calls", "counter"),
+            ("stage_seconds_max", "max", "gauge"),
+        ):
+            lines.append(f"# TYPE {prefix}_{suffix} {kind}")
+            for name, timer in sorted(snapshot["timers"].items()):
+                lines.append(f'{prefix}_{suffix}{{stage="{name}"}} {timer[key]}')
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        for name, count in sorted(snapshot["counters"].items()):
+            lines.append(f'{prefix}_events_total{{event="{name}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """
+        Write everything recorded so far to a file - a Prometheus textfile if it ends in .prom, otherwise JSON.  The
+        file is replaced in one go, so a collector never reads half of it.
+        Args:
+            path (str): where to write it
+        """
+        if path.endswith(".prom"):
+            contents = self.to_prometheus()
+        else:
+            contents = json.dumps(self.snapshot(), indent=2, sort_keys=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as fh:
+            fh.write(contents)
+        os.replace(tmp_path, path)
+
+
+registry = Metrics()
+timer = registry.timer
+observe = registry.observe
+incr = registry.incr
+reset = registry.reset
+snapshot = registry.snapshot
+merge = registry.merge
+summary = registry.summary
+write = registry.write
@@ -0,0 +1,234 @@
+"""
+Bringing databases created by older versions up to the current schema.
+
+The schema_version table records which version of the schema a database is at.  Every run checks it with a single
+query (ensure_schema), and only if it's behind SCHEMA_VERSION - or missing, on a new database or one from before it
+was versioned - is anything else done: create_all for any missing tables, then upgrade for the existing ones.
+
+create_all only creates missing tables, so columns and indexes added to existing tables since need adding here.  Every
+migration checks whether it's needed first, so upgrade can be run any number of times.
+
+Indexes are taken from the models, so a new index only needs declaring there.  Before a unique index is created, any
+duplicates are merged into the oldest row, with the rows that referenced them pointed at it instead.  On Postgres,
+indexes are built CONCURRENTLY, so a big listens table isn't locked while they build, and an index that a failed
+build left invalid is rebuilt.
+"""
+
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import Index, Table, func, inspect, select, text
+from sqlalchemy.engine.base import Connection, Engine
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+
+from scrobbledownload.models import Base, SchemaVersion, create_all
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the models change, and teach upgrade how to bring an existing database up to date
+SCHEMA_VERSION = 2
+
+# For each table that gets a unique index: the columns referencing it, and whether to repoint those rows at the row
+# that's kept or delete them
+_REFERENCES: Dict[str, List[Tuple[str, str, bool]]] = {
+    "artists": [("tracks", "artist_id", True), ("artist_genres", "artist_id", False)],
+    "albums": [("tracks", "album_id", True), ("album_genres", "album_id", False)],
+    "tracks": [("listens", "track_id", True), ("track_tags", "track_id", True)],
+}
+
+# Columns added to existing tables, as table -> [(column, DDL)]
+_COLUMNS: Dict[str, List[Tuple[str, str]]] = {
+    "unfoundtracks": [("attempts", "INTEGER NOT NULL DEFAULT 0"), ("last_attempt", "TIMESTAMP")],
+    "sync_state": [("page_size", "INTEGER")],
+}
+
+
+def current_version(engine: Engine) -> Optional[int]:
+    """
+    Get the version of the schema the database is at, with a single query
+    Args:
+        engine (Engine): A built SQLAlchemy engine
+
+    Returns:
+        int - or None if the database hasn't got a version, because it's new or from before versioning
+    """
+    try:
+        with engine.connect() as conn:
+            return conn.execute(select(func.max(SchemaVersion.version))).scalar()
+    except (OperationalError, ProgrammingError):
+        # No schema_version table
+        return None
+
+
+def ensure_schema(engine: Engine) -> List[str]:
+    """
+    Make sure the database is at the current schema version.  When it already is - every run but the first after an
+    upgrade - that's a single query.
+    Args:
+        engine (Engine): A built SQLAlchemy engine
+
+    Returns:
+        list(str) - what was done
+    """
+    version = current_version(engine)
+    if version == SCHEMA_VERSION:
+        return []
+    if version is not None and version > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"The database is at schema version {version}, which is newer than this version's {SCHEMA_VERSION}"
+        )
+    logger.info(f"Migrating the database from schema version {version} to {SCHEMA_VERSION}")
+    return migrate(engine)
+
+
+def migrate(engine: Engine) -> List[str]:
+    """
+    Create any missing tables, bring the existing ones up to date, and record the schema version.  A new database just
+    gets create_all.  Safe to run any number of times.
+    Args:
+        engine (Engine): A built SQLAlchemy engine
+
+    Returns:
+        list(str) - what was done
+    """
+    new = not inspect(engine).get_table_names()
+    create_all(engine)
+    done = ["created the schema"] if new else upgrade(engine)
+    _stamp(engine)
+    return done
+
+
+def _stamp(engine: Engine):
+    try:
+        with engine.begin() as conn:
+            conn.execute(SchemaVersion.__table__.delete())
+            conn.execute(
+                SchemaVersion.__table__.insert().values(version=SCHEMA_VERSION, migrated_at=datetime.utcnow())
+            )
+    except IntegrityError:
+        # Another run migrated it at the same time, and stamped it first
+        pass
+
+
+def upgrade(engine: Engine) -> List[str]:
+    """
+    Bring an existing database up to date with the models.  Missing tables are left to create_all.
+    Args:
+        engine (Engine): A built SQLAlchemy engine
+
+    Returns:
+        list(str) - what was done
+    """
+    done = []
+    existing = set(inspect(engine).get_table_names())
+    for table_name, columns in _COLUMNS.items():
+        if table_name in existing:
+            done += _add_columns(engine, table_name, columns)
+    # Artists and albums first, as merging their duplicates repoints tracks
+    for table_name in ("artists", "albums", "tracks", "listens"):
+        if table_name in existing:
+            for index in sorted(Base.metadata.tables[table_name].indexes, key=lambda i: i.name):
+                done += _create_index(engine, index)
+    for step in done:
+        logger.info(f"Migrated: {step}")
+    return done
+
+
+def _add_columns(engine: Engine, table_name: str, columns: List[Tuple[str, str]]) -> List[str]:
+    present = {c["name"] for c in inspect(engine).get_columns(table_name)}
+    done = []
+    with engine.begin() as conn:
+        for name, ddl in columns:
+            if name not in present:
+                conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {name} {ddl}"))
+                done.append(f"added {table_name}.{name}")
+    return done
+
+
+def _invalid_indexes(engine: Engine, table_name: str) -> Set[str]:
+    """
+    Get the names of a table's invalid indexes.  On Postgres, a CREATE INDEX CONCURRENTLY that fails leaves an invalid
+    index behind, which is never used and doesn't enforce uniqueness.  No other database has them.
+    Args:
+        engine (Engine): A built SQLAlchemy engine
+        table_name (str): the table
+
+    Returns:
+        set(str)
+    """
+    if engine.dialect.name != "postgresql":
+        return set()
+    query = text(
+        "SELECT i.relname FROM pg_index x "
+        "JOIN pg_class i ON i.oid = x.indexrelid JOIN pg_class t ON t.oid = x.indrelid "
+        "WHERE t.relname = :table_name AND pg_table_is_visible(t.oid) AND NOT x.indisvalid"
+    )
+    with engine.connect() as conn:
+        return {name for name, in conn.execute(query, {"table_name": table_name})}
+
+
+def _create_index(engine: Engine, index: Index) -> List[str]:
+    table: Table = index.table
+    existing = {i["name"]: i for i in inspect(engine).get_indexes(table.name)}
+    current = existing.get(index.name)
+    valid = index.name not in _invalid_indexes(engine, table.name)
+    if current is not None and valid and bool(current["unique"]) == bool(index.unique):
+        return []
+
+    done = []
+    if index.unique:
+        with engine.begin() as conn:
+            merged = _merge_duplicates(conn, table, index.columns[0].name)
+        if merged:
+            done.append(f"merged {merged} duplicate {table.name}")
+
+    preparer = engine.dialect.identifier_preparer
+    concurrently = engine.dialect.name == "postgresql"
+    columns = ", ".join(preparer.quote(c.name) for c in index.columns)
+    statements = []
+    if current is not None:
+        drop = f"DROP INDEX {'CONCURRENTLY ' if concurrently else ''}{preparer.quote(index.name)}"
+        if engine.dialect.name == "mysql":
+            drop += f" ON {preparer.quote(table.name)}"
+        statements.append(drop)
+    statements.append(
+        f"CREATE {'UNIQUE ' if index.unique else ''}INDEX {'CONCURRENTLY ' if concurrently else ''}"
+        f"{preparer.quote(index.name)} ON {preparer.quote(table.name)} ({columns})"
+    )
+    # CONCURRENTLY can't run inside a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for statement in statements:
+            conn.execute(text(statement))
+    done.append(f"{'rebuilt' if current is not None else 'created'} index {index.name}")
+    return done
+
+
+def _merge_duplicates(conn: Connection, table: Table, column: str) -> int:
+    """
+    Merge the rows of a table that share a value of a column into the oldest of them.
+    Args:
+        conn (Connection): A connection, in a transaction
+        table (Table): the table
+        column (str): the column that's about to be unique
+
+    Returns:
+        int - how many rows were merged away
+    """
+    key = table.c[column]
+    duplicated = (
+        select(key, func.min(table.c.id)).where(key.isnot(None)).group_by(key).having(func.count() > 1)
+    )
+    merged = 0
+    for value, keep in conn.execute(duplicated).fetchall():
+        ids = [i for i, in conn.execute(select(table.c.id).where(key == value, table.c.id != keep))]
+        for ref_table_name, ref_column, repoint in _REFERENCES.get(table.name, []):
+            ref_table = Base.metadata.tables[ref_table_name]
+            where = ref_table.c[ref_column].in_(ids)
+            if repoint:
+                conn.execute(ref_table.update().where(where).values({ref_column: keep}))
+            else:
+                conn.execute(ref_table.delete().where(where))
+        conn.execute(table.delete().where(table.c.id.in_(ids)))
+        merged += len(ids)
+    return merged
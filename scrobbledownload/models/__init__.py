@@ -2,8 +2,9 @@
 All of the SQLAlchemy models to represent the data we are saving.
 """
 from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
 
-from sqlalchemy import Column, String, Integer, ForeignKey, Date, DateTime
+from sqlalchemy import Column, String, Integer, ForeignKey, Date, DateTime, Index
 from sqlalchemy.engine.base import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session
@@ -13,7 +14,21 @@ from sqlalchemy.sql import func
 Base = declarative_base()
 
 
-class ArtistGenre(Base):
+class BulkInsertMixin(object):
+    @classmethod
+    def insert_many(cls, rows: List[dict], session: Session):
+        """
+        Insert many rows with a single multi-row INSERT, skipping the ORM unit of work entirely.  Relationships aren't
+        handled here, so foreign keys need to be set as plain ids.
+        Args:
+            rows (list(dict)): The rows, as column name -> value
+            session (Session): The SQLAlchemy ORM session
+        """
+        if rows:
+            session.execute(cls.__table__.insert(), rows)
+
+
+class ArtistGenre(BulkInsertMixin, Base):
     __tablename__ = "artist_genres"
 
     id = Column(Integer(), primary_key=True)
@@ -27,7 +42,7 @@ class Artist(Base):
     id = Column(Integer(), primary_key=True)
     name = Column(String(1000), index=True)
     popularity = Column(Integer())
-    spotify_id = Column(String(100), index=True)
+    spotify_id = Column(String(100), index=True, unique=True)
 
     genres = relationship("ArtistGenre")
 
@@ -46,7 +61,7 @@ class Artist(Base):
         return result
 
 
-class AlbumGenre(Base):
+class AlbumGenre(BulkInsertMixin, Base):
     __tablename__ = "album_genres"
 
     id = Column(Integer(), primary_key=True)
@@ -59,7 +74,7 @@ class Album(Base):
 
     id = Column(Integer(), primary_key=True)
     name = Column(String(1000))
-    spotify_id = Column(String(100), index=True)
+    spotify_id = Column(String(100), index=True, unique=True)
     release_date = Column(Date())
     popularity = Column(Integer())
     genres = relationship("AlbumGenre")
@@ -81,7 +96,7 @@ class Track(Base):
     name = Column(String(1000))
     spotify_id = Column(String(100))
     mbid = Column(String(100), index=True)
-    generated_id = Column(String(100), index=True)
+    generated_id = Column(String(100), index=True, unique=True)
     artist_id = Column(Integer(), ForeignKey("artists.id"))
     album_id = Column(Integer(), ForeignKey("albums.id"))
     artist = relationship("Artist", foreign_keys=[artist_id])
@@ -89,11 +104,13 @@ class Track(Base):
     tags = relationship("TrackTag")
 
 
-class Listen(Base):
+class Listen(BulkInsertMixin, Base):
     __tablename__ = "listens"
+    # dt for the max() at the start of every run, and (track_id, dt) for a track's listens over time
+    __table_args__ = (Index("ix_listens_track_id_dt", "track_id", "dt"),)
 
     id = Column(Integer(), primary_key=True)
-    dt = Column(DateTime())
+    dt = Column(DateTime(), index=True)
     track_id = Column(Integer(), ForeignKey("tracks.id"))
     track = relationship("Track")
 
@@ -113,7 +130,7 @@ class Listen(Base):
         return last_listen_downloaded
 
 
-class UnfoundTracks(Base):
+class UnfoundTracks(BulkInsertMixin, Base):
     __tablename__ = "unfoundtracks"
 
     id = Column(Integer(), primary_key=True)
@@ -124,6 +141,155 @@ class UnfoundTracks(Base):
     artist_mbid = Column(String(1000))
     album = Column(String(1000))
     album_mbid = Column(String(1000))
+    # How many times retry-unfound has searched for this track, and when it last did, so it can back off
+    attempts = Column(Integer(), nullable=False, server_default="0")
+    last_attempt = Column(DateTime())
+
+
+class SyncState(Base):
+    """
+    The progress of one download of a window of a users history, committed with each page, so a download that dies
+    part way through can pick up from the page after the last one written rather than starting over.
+    """
+
+    __tablename__ = "sync_state"
+
+    id = Column(Integer(), primary_key=True)
+    kind = Column(String(20))
+    # The window, fixed when the download starts so page boundaries stay put.  No from_dt means the start of the
+    # users history.
+    from_dt = Column(DateTime())
+    to_dt = Column(DateTime())
+    last_page = Column(Integer(), nullable=False, server_default="0")
+    # The scrobbles per page that last_page was counted in, so a resumed download keeps the same page boundaries
+    page_size = Column(Integer())
+    total_pages = Column(Integer())
+    oldest_dt = Column(DateTime())
+    started_at = Column(DateTime())
+    updated_at = Column(DateTime())
+    completed_at = Column(DateTime(), index=True)
+
+    @classmethod
+    def start(
+        cls,
+        kind: str,
+        from_dt: Optional[datetime],
+        to_dt: datetime,
+        session: Session,
+        page_size: Optional[int] = None,
+    ) -> "SyncState":
+        """
+        Record the start of a download, committing it straight away
+        Args:
+            kind (str): what the download is for, e.g. "sync" or "gap"
+            from_dt (datetime): the start of the window, or None for the start of the users history
+            to_dt (datetime): the end of the window
+            session (Session): The SQLAlchemy ORM session
+            page_size (int): the scrobbles per page it'll be downloaded in.  Without one, whatever downloads it first
+                records its own.
+
+        Returns:
+            SyncState
+        """
+        now = datetime.utcnow()
+        state = cls(
+            kind=kind,
+            from_dt=from_dt,
+            to_dt=to_dt,
+            last_page=0,
+            page_size=page_size,
+            started_at=now,
+            updated_at=now,
+        )
+        session.add(state)
+        session.commit()
+        return state
+
+    @classmethod
+    def incomplete(cls, session: Session, kinds: Optional[Sequence[str]] = None) -> List["SyncState"]:
+        """
+        Get the downloads that never finished, oldest first
+        Args:
+            session (Session): The SQLAlchemy ORM session
+            kinds (list(str)): only get downloads of these kinds, e.g. ["sync", "gap"]
+
+        Returns:
+            list(SyncState)
+        """
+        query = session.query(cls).filter(cls.completed_at.is_(None))
+        if kinds is not None:
+            query = query.filter(cls.kind.in_(kinds))
+        return query.order_by(cls.id).all()
+
+    @classmethod
+    def completed_windows(cls, session: Session) -> List[Tuple[Optional[datetime], datetime]]:
+        """
+        Get the windows that have been downloaded in full
+        Args:
+            session (Session): The SQLAlchemy ORM session
+
+        Returns:
+            list((datetime, datetime)) - (from_dt, to_dt), where from_dt is None for the start of the users history
+        """
+        return [tuple(w) for w in session.query(cls.from_dt, cls.to_dt).filter(cls.completed_at.isnot(None))]
+
+    @classmethod
+    def merge_completed(cls, session: Session, kind: str) -> int:
+        """
+        Merge the completed windows of a kind that overlap into one row, so the table - and every look through the
+        completed windows - doesn't grow with each run.  Every sync starts from the newest listen, which is before
+        the end of the sync before it, so they all end up as one.  Nothing is committed here.
+        Args:
+            session (Session): The SQLAlchemy ORM session
+            kind (str): the kind of window, e.g. "sync"
+
+        Returns:
+            int - how many rows were merged away
+        """
+        states = session.query(cls).filter(cls.kind == kind, cls.completed_at.isnot(None)).all()
+        states.sort(key=lambda s: (s.from_dt is not None, s.from_dt or datetime.min))
+        merged = 0
+        current = None
+        for state in states:
+            # Windows are exclusive of their ends, so they only cover each other's ends if they overlap
+            if current is not None and (state.from_dt is None or state.from_dt < current.to_dt):
+                current.to_dt = max(current.to_dt, state.to_dt)
+                current.completed_at = max(current.completed_at, state.completed_at)
+                current.oldest_dt = min(filter(None, (current.oldest_dt, state.oldest_dt)), default=None)
+                session.delete(state)
+                merged += 1
+            else:
+                current = state
+        return merged
+
+    def checkpoint(self, page: int, total_pages: int, oldest_dt: Optional[datetime]):
+        """
+        Record a page as written.  It's committed along with the page.
+        Args:
+            page (int): the page
+            total_pages (int): how many pages the window has
+            oldest_dt (datetime): the oldest scrobble on the page, if it had any
+        """
+        self.last_page = page
+        self.total_pages = total_pages
+        if oldest_dt is not None and (self.oldest_dt is None or oldest_dt < self.oldest_dt):
+            self.oldest_dt = oldest_dt
+        self.updated_at = datetime.utcnow()
+
+    def complete(self):
+        self.completed_at = self.updated_at = datetime.utcnow()
+
+
+class SchemaVersion(Base):
+    """
+    Which version of the schema the database is at, in a single row, so startup can check it with one query.  See
+    scrobbledownload.migrations.
+    """
+
+    __tablename__ = "schema_version"
+
+    version = Column(Integer(), primary_key=True, autoincrement=False)
+    migrated_at = Column(DateTime())
 
 
 def create_all(engine: Engine):
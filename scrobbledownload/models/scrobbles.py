@@ -7,18 +7,17 @@ from dataclasses import dataclass
 from datetime import datetime
 from typing import List
 
-import requests
-from dateutil.parser import parse
-
 from scrobbledownload.secrets import Secrets
 
 
 @dataclass
 class ScrobbleTrack(object):
     """
-    A single Scrobble Track
+    A single Scrobble Track.  There's one of these for every listen in a users history, so it has __slots__.
     """
 
+    __slots__ = ("track_name", "track_mbid", "listen_dt", "artist", "artist_mbid", "album", "album_mbid")
+
     track_name: str
     track_mbid: str
     listen_dt: datetime
@@ -34,6 +33,8 @@ class Scrobbles(object):
     A collection of scrobble responses
     """
 
+    __slots__ = ("page", "perPage", "totalPages", "tracks")
+
     page: int
     perPage: int
     totalPages: int
@@ -54,6 +55,10 @@ class ScrobbleDownloader(object):
             secrets (scrobbledownload.secrets.Secrets): the secrets class
         """
         self.secrets = secrets
+        # Imported here, since the LastFM service imports the models from this module
+        from scrobbledownload.services.lastfm import LastFM
+
+        self._lastfm = LastFM(secrets.lastfm_username, secrets.lastfm_api_key)
 
     def get(self, page: int = 1) -> Scrobbles:
         """Get scrobbles by page
@@ -64,43 +69,4 @@ class ScrobbleDownloader(object):
         Returns:
             Scrobbles: the scrobbles
         """
-        url = (
-            f"http://ws.audioscrobbler.com/2.0/?method=user.getrecenttracks&"
-            f"user={self.secrets.lastfm_username}&api_key={self.secrets.lastfm_api_key}"
-            f"&format=json&limit={self.secrets.scrobbles_per_page}&page={page}"
-        )
-        req = requests.get(url)
-        req.raise_for_status()
-        scrobble_json = req.json()
-        tracks = ScrobbleDownloader._get_tracks(scrobble_json["recenttracks"]["track"])
-        return Scrobbles(
-            page=scrobble_json["recenttracks"]["@attr"]["page"],
-            perPage=scrobble_json["recenttracks"]["@attr"]["perPage"],
-            totalPages=scrobble_json["recenttracks"]["@attr"]["totalPages"],
-            tracks=tracks,
-        )
-
-    @staticmethod
-    def _get_tracks(tracks_json) -> List[ScrobbleTrack]:
-        """
-        Parses the JSON-decoded object for track objects.
-        Args:
-            tracks_json (list): a decoded JSON list of objects
-
-        Returns:
-            list(ScrobbleTrack)
-        """
-        tracks = []
-        for t in tracks_json:
-            tracks.append(
-                ScrobbleTrack(
-                    track_name=t["name"],
-                    track_mbid=t["mbid"],
-                    date=parse(t["date"]["#text"]),
-                    artist=t["artist"]["#text"],
-                    artist_mbid=t["artist"]["mbid"],
-                    album=t["album"]["#text"],
-                    album_mbid=t["album"]["mbid"],
-                )
-            )
-        return tracks
+        return self._lastfm.download_scrobbles(page, self.secrets.scrobbles_per_page)
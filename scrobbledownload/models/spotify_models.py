@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from datetime import date
-from typing import List
+from typing import List, Optional
 
 from dateutil.parser import parse
 
@@ -44,7 +44,8 @@ class SpotifyAlbum(object):
 @dataclass
 class SpotifyTrack(object):
     """
-    Representation of a track from the Spotify API
+    Representation of a track from the Spotify API.  The artist and album names are only used to match search results
+    to scrobbles.
     """
 
     name: str
@@ -53,3 +54,5 @@ class SpotifyTrack(object):
     popularity: int
     album_id: str
     artist_id: str
+    artist_name: Optional[str] = None
+    album_name: Optional[str] = None
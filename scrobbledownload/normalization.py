@@ -0,0 +1,137 @@
+"""
+Normalizing artist and track names, which happens for every scrobble - so tables and patterns are built once, and
+results are memoized.
+
+- to_alphanum strips punctuation for search strings, as Spotify's search chokes on some of it.
+- fold makes a comparison key: accents and case folded away, and symbols standing in for letters ("Angel Du$t",
+  "3OH!3", "A$AP") read as the letters.
+- ReplacementIndex applies the edge case replacements file: exact whole-name rules, word rules and regex rules.
+"""
+import re
+import string
+import unicodedata
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Pattern, Tuple, Union
+
+# ASCII punctuation, and the Unicode punctuation that turns up in track names
+_PUNCTUATION = string.punctuation + "‘’‚‛“”„‟–—―…•·«»‹›¡¿"
+_ALPHANUM_TABLE = str.maketrans("", "", _PUNCTUATION)
+_FOLD_TABLE = str.maketrans({"&": " and ", "'": "", "’": "", "‘": ""})
+# Symbols used as letters, only when they're inside a word - "Help!" keeps its exclamation mark out of the way
+_SYMBOL_LETTERS = {"$": "s", "!": "i", "@": "a"}
+_SYMBOL_IN_WORD = re.compile(r"(?<=\w)[$!@](?=\w)")
+_NOT_ALPHANUM = re.compile(r"[\W_]+")
+
+_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def to_alphanum(s: str) -> str:
+    """
+    Strip the punctuation out of a string
+    Args:
+        s (str): an input string to translate
+
+    Returns:
+        str
+    """
+    return s.translate(_ALPHANUM_TABLE)
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def fold(s: str) -> str:
+    """
+    Fold a name down to a key for comparing it: accents and compatibility forms (e.g. full-width letters) folded, case
+    folded, "&" read as "and", symbols used as letters read as those letters, and punctuation dropped.
+    Args:
+        s (str): a name
+
+    Returns:
+        str
+    """
+    s = unicodedata.normalize("NFKD", s)
+    s = "".join(c for c in s if not unicodedata.combining(c)).casefold().translate(_FOLD_TABLE)
+    s = _SYMBOL_IN_WORD.sub(lambda m: _SYMBOL_LETTERS[m.group(0)], s)
+    return " ".join(_NOT_ALPHANUM.sub(" ", s).split())
+
+
+Rules = Dict[str, Union[str, Dict[str, str]]]
+
+
+class ReplacementIndex(object):
+    """
+    The edge case replacements, indexed so they're cheap to apply to every scrobble.
+
+    The replacements file maps names to replacements.  Plain entries are exact rules, matched against a whole name,
+    and a name that folds to the same key (so differs only in case, accents and such) matches too.  Two optional
+    sections add more:
+
+        {
+            "The AllAmerican Rejects": "The All American Rejects",
+            "words": {"Pg99": "Pageninetynine"},
+            "regex": {"^The ": ""}
+        }
+
+    Word rules replace single words within a name.  Regex rules are applied, in order, to every name after that.
+    """
+
+    def __init__(self, rules: Optional[Rules] = None):
+        """
+        Args:
+            rules (dict): the replacements, as loaded from the replacements file
+        """
+        self.source = rules
+        self._exact: Dict[str, str] = {}
+        self._words: Dict[str, str] = {}
+        self._regex: List[Tuple[Pattern, str]] = []
+        for key, value in (rules or {}).items():
+            if key == "words" and isinstance(value, dict):
+                self._words.update(value)
+            elif key == "regex" and isinstance(value, dict):
+                self._regex.extend((re.compile(pattern), replacement) for pattern, replacement in value.items())
+            else:
+                self._exact[key] = value
+        self._exact_folded = {fold(k): v for k, v in self._exact.items()}
+        # Single-word exact rules have always been applied to each word of a track name, so they're word rules too
+        self._words = dict({k: v for k, v in self._exact.items() if " " not in k}, **self._words)
+        self._words_folded = {fold(k): v for k, v in self._words.items()}
+        self.apply: Callable[[str], str] = lru_cache(maxsize=_CACHE_SIZE)(self._apply)
+        self.apply_words: Callable[[str], str] = lru_cache(maxsize=_CACHE_SIZE)(self._apply_words)
+
+    def _lookup(self, s: str, rules: Dict[str, str], folded: Dict[str, str]) -> Optional[str]:
+        replacement = rules.get(s)
+        if replacement is None and folded:
+            replacement = folded.get(fold(s))
+        return replacement
+
+    def _apply_regex(self, s: str) -> str:
+        for pattern, replacement in self._regex:
+            s = pattern.sub(replacement, s)
+        return s
+
+    def _apply(self, s: str) -> str:
+        """
+        Replace a whole name, e.g. an artist: an exact rule if one matches, otherwise word rules, then regex rules.
+        """
+        replacement = self._lookup(s, self._exact, self._exact_folded)
+        if replacement is not None:
+            return replacement
+        return self._apply_regex(self._replace_words(s))
+
+    def _apply_words(self, s: str) -> str:
+        """
+        Replace each word of a name, e.g. a track title, then apply the regex rules.
+        """
+        return self._apply_regex(self._replace_words(s))
+
+    def _replace_words(self, s: str) -> str:
+        if not self._words:
+            return s
+        words = s.split()
+        replaced = False
+        for i, word in enumerate(words):
+            replacement = self._lookup(word, self._words, self._words_folded)
+            if replacement is not None:
+                words[i] = replacement
+                replaced = True
+        return " ".join(words) if replaced else s
@@ -0,0 +1,140 @@
+"""
+A small streaming pipeline: a source and a chain of stages, each running in its own thread and connected by bounded
+queues, feeding a sink that runs in the calling thread.  Every stage works on a different item at the same time, and
+since no queue holds more than `queue_depth` items, memory stays flat however long the source is.
+"""
+import logging
+import queue
+import threading
+from typing import Any, Callable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class StopPipeline(Exception):
+    """
+    Raised by a stage (or the sink) to stop the pipeline early - e.g. once we've caught up.  Items already past the
+    stage still make it to the sink, the item given here is passed on as the stage's last output, and everything
+    still upstream is dropped.
+    """
+
+    def __init__(self, item: Any = None):
+        super().__init__()
+        self.item = item
+
+
+class Pipeline(object):
+    def __init__(self, queue_depth: int = 2):
+        """
+        Args:
+            queue_depth (int): How many items can wait between any two stages
+        """
+        self._queue_depth = queue_depth
+        self._abort = threading.Event()
+        self._stop_source = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    def run(self, source: Iterator, stages: List[Callable[[Any], Any]], sink: Callable[[Any], None]):
+        """
+        Run items from the source through each stage in turn, and hand the results to the sink.  A stage that returns
+        None drops the item.  If any stage fails, everything stops and the exception is raised here.
+        Args:
+            source (iterator): Where the items come from.  It's closed (if it can be) when the pipeline stops.
+            stages (list(callable)): Each takes an item and returns the item for the next stage
+            sink (callable): Takes each item that makes it through every stage
+        """
+        queues = [queue.Queue(maxsize=self._queue_depth) for _ in range(len(stages) + 1)]
+        threads = [threading.Thread(target=self._run_source, args=(source, queues[0]), daemon=True)]
+        for stage, q_in, q_out in zip(stages, queues, queues[1:]):
+            threads.append(threading.Thread(target=self._run_stage, args=(stage, q_in, q_out), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            self._run_sink(sink, queues[-1])
+        except BaseException:
+            self._abort.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _fail(self, error: BaseException):
+        if self._error is None:
+            self._error = error
+        self._abort.set()
+
+    def _put(self, q: queue.Queue, item: Any) -> bool:
+        """
+        Put an item on a queue, waiting for room unless the pipeline has been aborted.
+        Returns:
+            bool - whether the item was put on the queue
+        """
+        while not self._abort.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue) -> Any:
+        """
+        Get an item from a queue, or _DONE if the pipeline has been aborted.
+        """
+        while not self._abort.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _run_source(self, source: Iterator, q_out: queue.Queue):
+        try:
+            for item in source:
+                if self._stop_source.is_set() or not self._put(q_out, item):
+                    break
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            close = getattr(source, "close", None)
+            if close is not None:
+                close()
+            self._put(q_out, _DONE)
+
+    def _run_stage(self, stage: Callable[[Any], Any], q_in: queue.Queue, q_out: queue.Queue):
+        stopped = False
+        try:
+            while True:
+                item = self._get(q_in)
+                if item is _DONE:
+                    break
+                if stopped:
+                    continue
+                try:
+                    result = stage(item)
+                except StopPipeline as stop:
+                    stopped = True
+                    self._stop_source.set()
+                    result = stop.item
+                if result is not None and not self._put(q_out, result):
+                    break
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._put(q_out, _DONE)
+
+    def _run_sink(self, sink: Callable[[Any], None], q_in: queue.Queue):
+        while True:
+            item = self._get(q_in)
+            if item is _DONE:
+                return
+            try:
+                sink(item)
+            except StopPipeline:
+                self._abort.set()
+                return
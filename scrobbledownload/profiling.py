@@ -0,0 +1,157 @@
+"""
+Profiling for real runs, e.g. inside the container, where the hot spots can be quite different from what the tests and
+local mocks show.
+
+There are two modes:
+- cprofile: deterministic profiling with cProfile, of the calling thread and every thread started while it runs (the
+  pipeline stages).  Stats are dumped in the usual .prof format, for pstats, snakeviz and friends.
+- sample: a background thread samples every thread's stack every few milliseconds.  Much lower overhead, and the dump
+  is collapsed stacks ("frame;frame;frame count" lines), for flamegraph.pl or speedscope.
+
+Either way, a top-N summary of the hot functions is printed to stderr at the end.
+"""
+import cProfile
+import io
+import logging
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import List, TextIO
+
+logger = logging.getLogger(__name__)
+
+MODES = ("cprofile", "sample")
+
+
+@contextmanager
+def profile(path: str, mode: str = "cprofile", top: int = 30, interval: float = 0.005, stream: TextIO = None):
+    """
+    Profile a block of code, dumping the stats to a file and a summary to stderr when it's done (or fails).
+    Args:
+        path (str): where to dump the stats
+        mode (str): cprofile or sample
+        top (int): how many functions to show in the summary
+        interval (float): how often to sample, in seconds - sample mode only
+        stream (file): where the summary goes.  Defaults to stderr.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown profiling mode {mode}, expected one of {MODES}")
+    profiler = _CProfiler() if mode == "cprofile" else _SamplingProfiler(interval)
+    logger.info(f"Profiling with {mode}, stats will be written to {path}")
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        profiler.dump(path)
+        profiler.print_summary(stream or sys.stderr, top)
+
+
+class _CProfiler(object):
+    """
+    cProfile, for the calling thread and any threads started while it's running.  Before Python 3.12, cProfile only
+    sees the thread that enabled it, so every new thread gets a profiler of its own, and the stats are merged at the
+    end.  From 3.12 on, the one profiler sees every thread, and that's all we need.
+    """
+
+    def __init__(self):
+        self._profilers: List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+
+    def _start_thread(self, frame, event, arg):
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+: only one cProfile can be active, and it's already watching this thread
+            return
+        with self._lock:
+            self._profilers.append(profiler)
+
+    def start(self):
+        main = cProfile.Profile()
+        self._profilers.append(main)
+        threading.setprofile(self._start_thread)
+        main.enable()
+
+    def stop(self):
+        self._profilers[0].disable()
+        threading.setprofile(None)
+
+    def stats(self, stream: TextIO = None) -> pstats.Stats:
+        with self._lock:
+            profilers = list(self._profilers)
+        stats = pstats.Stats(profilers[0], stream=stream)
+        for profiler in profilers[1:]:
+            # A thread that's somehow still running keeps its profiler enabled, so snapshot it as it is
+            profiler.create_stats()
+            stats.add(profiler)
+        return stats
+
+    def dump(self, path: str):
+        self.stats().dump_stats(path)
+
+    def print_summary(self, stream: TextIO, top: int):
+        stats = self.stats(stream)
+        stats.sort_stats("cumulative").print_stats(top)
+        stats.sort_stats("tottime").print_stats(top)
+
+
+class _SamplingProfiler(object):
+    """
+    Samples every thread's stack at a fixed interval.  A function's "self" samples are the ones where it was running,
+    its "total" samples the ones where it was anywhere on the stack.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self._interval = interval
+        self._stacks: Counter = Counter()
+        self._samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self._interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self._stacks[tuple(reversed(stack))] += 1
+            self._samples += 1
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._elapsed = time.perf_counter() - self._started
+
+    def dump(self, path: str):
+        with open(path, "w") as fh:
+            for stack, count in self._stacks.most_common():
+                fh.write(f"{';'.join(stack)} {count}\n")
+
+    def print_summary(self, stream: TextIO, top: int):
+        own, total = Counter(), Counter()
+        for stack, count in self._stacks.items():
+            own[stack[-1]] += count
+            for frame in set(stack):
+                total[frame] += count
+        out = io.StringIO()
+        out.write(f"{self._samples} samples over {self._elapsed:.1f}s, every {self._interval * 1000:g}ms\n")
+        for title, counter in (("self", own), ("total", total)):
+            out.write(f"\nTop {top} functions by {title} samples\n{'samples':>9}  function\n")
+            for frame, count in counter.most_common(top):
+                out.write(f"{count:>9}  {frame}\n")
+        stream.write(out.getvalue())
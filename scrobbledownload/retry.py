@@ -0,0 +1,248 @@
+"""
+Retrying the scrobbles we couldn't find on Spotify.
+
+save_unfound_tracks parks them in the unfound tracks table.  Every so often (or after the replacements file gains a
+rule for them), retry_unfound searches for them again: rows are grouped by track name and artist, so each distinct
+track is searched for once however many times it was played, and the ones that are found become listens.
+
+Tracks that still can't be found back off exponentially - a track is searched for again `base_delay` after its first
+retry, then twice that, and so on up to `max_delay` - so hopeless ones aren't searched for on every run.
+"""
+
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import Session
+
+from scrobbledownload import metrics
+from scrobbledownload.download import PagePlan, create_tracks, group_by_track
+from scrobbledownload.enrichment import EnrichmentEngine, SyncEnrichmentEngine
+from scrobbledownload.models import Listen, UnfoundTracks
+from scrobbledownload.models.scrobbles import ScrobbleTrack
+from scrobbledownload.services.track import Track, TrackIndex
+
+logger = logging.getLogger(__name__)
+
+Key = Tuple[str, str]
+
+
+@dataclass
+class UnfoundGroup(object):
+    """
+    Every unfound scrobble of one track name and artist.
+    """
+
+    track_name: str
+    artist: str
+    attempts: int
+    last_attempt: Optional[datetime]
+
+    @property
+    def key(self) -> Key:
+        return self.track_name, self.artist
+
+
+def retry_delay(attempts: int, base_delay: timedelta, max_delay: timedelta) -> timedelta:
+    """
+    How long to wait before searching for a track again
+    Args:
+        attempts (int): how many times it's been retried already
+        base_delay (timedelta): the wait after the first retry
+        max_delay (timedelta): the longest wait
+
+    Returns:
+        timedelta
+    """
+    if attempts <= 0:
+        return timedelta(0)
+    # Capping the exponent first keeps a long-hopeless track from overflowing the timedelta
+    return min(base_delay * 2 ** min(attempts - 1, 32), max_delay)
+
+
+def due_groups(
+    session: Session, now: datetime, base_delay: timedelta, max_delay: timedelta
+) -> List[UnfoundGroup]:
+    """
+    Find the unfound tracks that are due a retry, with one query.
+    Args:
+        session (Session): The SQLAlchemy session
+        now (datetime): the time of this run
+        base_delay (timedelta): the wait after the first retry
+        max_delay (timedelta): the longest wait
+
+    Returns:
+        list(UnfoundGroup) - most played first
+    """
+    query = (
+        session.query(
+            UnfoundTracks.track_name,
+            UnfoundTracks.artist,
+            func.max(UnfoundTracks.attempts),
+            func.max(UnfoundTracks.last_attempt),
+        )
+        .filter(UnfoundTracks.track_name.isnot(None), UnfoundTracks.artist.isnot(None))
+        .group_by(UnfoundTracks.track_name, UnfoundTracks.artist)
+        .order_by(func.count().desc())
+    )
+    groups = []
+    for track_name, artist, attempts, last_attempt in query:
+        group = UnfoundGroup(track_name, artist, attempts or 0, last_attempt)
+        if last_attempt is None or last_attempt + retry_delay(group.attempts, base_delay, max_delay) <= now:
+            groups.append(group)
+    return groups
+
+
+def _chunks(items: Sequence, size: int) -> Iterator[Sequence]:
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def _search_unknown(plan: PagePlan, known: Dict[str, int], engine: EnrichmentEngine):
+    """
+    Search Spotify for the tracks in a plan we don't know, once per track name and artist, and put what's found in
+    plan.found for every album it was scrobbled on.
+    Args:
+        plan (PagePlan): the unfound tracks, grouped by track
+        known (dict(str, int)): the ids of the tracks we know, by Track.hash
+        engine (EnrichmentEngine): How tracks are searched for on Spotify
+    """
+    unknown_by_key: Dict[Key, List[str]] = {}
+    for generated_id, track_scrobbles in plan.groups.items():
+        if generated_id not in known:
+            first = track_scrobbles[0]
+            unknown_by_key.setdefault((first.track_name, first.artist), []).append(generated_id)
+    searches = {}
+    for generated_ids in unknown_by_key.values():
+        first = plan.groups[generated_ids[0]][0]
+        searches[generated_ids[0]] = Track(
+            None, first.track_name, first.artist, first.album, first.track_mbid
+        )
+    with metrics.timer("spotify.search"):
+        found = engine.search_tracks(searches)
+    for generated_ids in unknown_by_key.values():
+        if generated_ids[0] in found:
+            plan.found.update((generated_id, found[generated_ids[0]]) for generated_id in generated_ids)
+
+
+def retry_batch(
+    groups: List[UnfoundGroup],
+    session: Session,
+    engine: EnrichmentEngine,
+    track_index: TrackIndex,
+    now: datetime,
+    statement_batch_size: int = 500,
+) -> int:
+    """
+    Retry a batch of unfound tracks.  Tracks that have been created since their scrobbles were parked don't need a
+    search at all, and the rest are searched for once per track name and artist.  The scrobbles of every track that's
+    resolved are written as listens with one multi-row insert and deleted from the unfound tracks, and the rest have
+    their attempt counted.  Nothing is committed here.
+    Args:
+        groups (list(UnfoundGroup)): the tracks to retry
+        session (Session): The SQLAlchemy session
+        engine (EnrichmentEngine): How tracks are searched for on Spotify
+        track_index (TrackIndex): Known track ids
+        now (datetime): the time of this run
+        statement_batch_size (int): how many rows to delete or update per statement
+
+    Returns:
+        int - how many scrobbles were resolved
+    """
+    by_key = {group.key: group for group in groups}
+    rows = session.query(
+        UnfoundTracks.id,
+        UnfoundTracks.track_name,
+        UnfoundTracks.track_mbid,
+        UnfoundTracks.dt,
+        UnfoundTracks.artist,
+        UnfoundTracks.artist_mbid,
+        UnfoundTracks.album,
+        UnfoundTracks.album_mbid,
+    ).filter(tuple_(UnfoundTracks.track_name, UnfoundTracks.artist).in_(list(by_key)))
+    row_ids: Dict[int, str] = {}
+    row_keys: Dict[int, Key] = {}
+    scrobbles = []
+    for row_id, *fields in rows:
+        scrobble = ScrobbleTrack(*fields)
+        scrobbles.append(scrobble)
+        row_ids[row_id] = Track.generate_id(scrobble.track_name, scrobble.artist, scrobble.album)
+        row_keys[row_id] = (scrobble.track_name, scrobble.artist)
+
+    # The same track on different albums is a different track to us, but one search covers them all
+    plan = PagePlan(page=0, groups=group_by_track(scrobbles), unknown=[])
+    _search_unknown(plan, track_index.resolve(plan.groups, session), engine)
+    create_tracks(plan, session, track_index)
+    known = track_index.resolve(plan.groups, session)
+    listens = [
+        {"dt": scrobble.listen_dt, "track_id": known[generated_id]}
+        for generated_id, track_scrobbles in plan.groups.items()
+        if generated_id in known
+        for scrobble in track_scrobbles
+    ]
+    resolved = [row_id for row_id, generated_id in row_ids.items() if generated_id in known]
+    unresolved: Dict[int, List[int]] = {}
+    for row_id, generated_id in row_ids.items():
+        if generated_id not in known:
+            unresolved.setdefault(by_key[row_keys[row_id]].attempts + 1, []).append(row_id)
+
+    with metrics.timer("db.insert"):
+        Listen.insert_many(listens, session)
+    with metrics.timer("db.retry_update"):
+        for ids in _chunks(resolved, statement_batch_size):
+            session.query(UnfoundTracks).filter(UnfoundTracks.id.in_(ids)).delete(synchronize_session=False)
+        for attempts, unresolved_ids in unresolved.items():
+            for ids in _chunks(unresolved_ids, statement_batch_size):
+                session.query(UnfoundTracks).filter(UnfoundTracks.id.in_(ids)).update(
+                    {UnfoundTracks.attempts: attempts, UnfoundTracks.last_attempt: now},
+                    synchronize_session=False,
+                )
+    metrics.incr("retry.tracks", len(groups))
+    metrics.incr("retry.tracks.resolved", len({row_keys[row_id] for row_id in resolved}))
+    metrics.incr("listens.saved", len(listens))
+    return len(resolved)
+
+
+def retry_unfound(
+    session: Session,
+    engine: EnrichmentEngine = None,
+    batch_size: int = 200,
+    base_delay: timedelta = timedelta(days=1),
+    max_delay: timedelta = timedelta(days=90),
+    now: datetime = None,
+) -> int:
+    """
+    Retry every unfound track that's due, a batch of tracks at a time, committing after each batch.
+
+    Run it with the current replacements set on Spotify, so tracks parked before a rule was added get the benefit.
+    Args:
+        session (Session): The SQLAlchemy session
+        engine (EnrichmentEngine): How tracks are searched for on Spotify.  Defaults to one at a time.
+        batch_size (int): how many distinct tracks to retry per batch
+        base_delay (timedelta): the wait after a track's first retry, which doubles with every retry after
+        max_delay (timedelta): the longest wait between retries of a track
+        now (datetime): the time of this run.  Defaults to now, in UTC like the listens.
+
+    Returns:
+        int - how many scrobbles were resolved
+    """
+    metrics.reset()
+    now = now or datetime.utcnow()
+    engine = engine or SyncEnrichmentEngine()
+    groups = due_groups(session, now, base_delay, max_delay)
+    logger.info(f"Retrying {len(groups)} unfound tracks")
+    with metrics.timer("db.load_index"):
+        track_index = TrackIndex.load(session)
+
+    resolved = 0
+    with metrics.timer("run"):
+        for batch in _chunks(groups, batch_size):
+            resolved += retry_batch(list(batch), session, engine, track_index, now)
+            with metrics.timer("db.commit"):
+                session.commit()
+            logger.info(f"Resolved {resolved} unfound scrobbles so far")
+
+    logger.info(f"Stage timings and counts:\n{metrics.summary()}")
+    return resolved
@@ -1,10 +1,13 @@
 """
 Secrets that are loaded from a configuration file
+
+The CLI sets the path for every command, even --help, so yaml and spotipy are only imported once they're needed.
 """
 from os.path import exists
+from typing import TYPE_CHECKING
 
-import yaml
-from spotipy.oauth2 import SpotifyClientCredentials
+if TYPE_CHECKING:
+    from spotipy.oauth2 import SpotifyClientCredentials
 
 
 class Secrets(object):
@@ -27,6 +30,8 @@ class Secrets(object):
     spotify_client_secret: str
     scrobbles_per_page: int
     db_connection_string: str
+    spotify_cache_ttls: dict
+    db_pool: dict
 
     def __init__(self):
         """
@@ -41,11 +46,15 @@ class Secrets(object):
         self.spotify_client_secret = self._dict["spotify_client_secret"]
         self.scrobbles_per_page = self._dict["scrobbles_per_page"]
         self.db_connection_string = self._dict["db_connection_string"]
+        self.spotify_cache_ttls = self._dict.get("spotify_cache_ttls", {})
+        self.db_pool = self._dict.get("db_pool", {})
 
     def load(self) -> dict:
         """
         Load the configuration file and return the necessary variables
         """
+        import yaml
+
         with open(self._path) as fh:
             config_contents = fh.read()
         return yaml.load(config_contents, Loader=yaml.SafeLoader)
@@ -59,12 +68,14 @@ class Secrets(object):
             raise KeyError(f"Configuration file did not contain all necessary keys - missing {missing_keys}")
 
     @property
-    def spotify_credentials(self) -> SpotifyClientCredentials:
+    def spotify_credentials(self) -> "SpotifyClientCredentials":
         """
         Get the Spotify credentials object that is requried for interaction with the Spotify API
         Returns:
             SpotifyClientCredentials
         """
+        from spotipy.oauth2 import SpotifyClientCredentials
+
         return SpotifyClientCredentials(self.spotify_client_id, self.spotify_client_secret)
 
     @classmethod
@@ -77,3 +88,12 @@ class Secrets(object):
         if not exists(path):
             raise FileNotFoundError(f"Configuration file was missing - it was not found at {path}")
         cls._path = path
+
+    @classmethod
+    def get_filepath(cls) -> str:
+        """
+        Get the filepath to the configuration file, e.g. to hand to another process
+        Returns:
+            str
+        """
+        return cls._path
@@ -1,5 +1,10 @@
-from scrobbledownload.database import get_session
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy.orm import Session
+
+from scrobbledownload import upsert
 from scrobbledownload.models import Album as AlbumModel, AlbumGenre
+from scrobbledownload.models.spotify_models import SpotifyAlbum
 from .spotify import Spotify
 
 
@@ -9,25 +14,68 @@ class Album(object):
     """
 
     @classmethod
-    def _create(cls, session, spotify_album_id) -> AlbumModel:
-        spotify_album = Spotify.get_album(spotify_album_id)
-        genres = [AlbumGenre(genre=x) for x in spotify_album.genres]
-        a = AlbumModel(
-            name=spotify_album.name,
-            popularity=spotify_album.popularity,
-            spotify_id=spotify_album.spotify_id,
-            release_date=spotify_album.release_date,
-            genres=genres,
-        )
-        session.add(a)
-        session.commit()
-        return a
+    def get_album(cls, spotify_album_id: str, session: Session) -> AlbumModel:
+        """
+        Get one album by Spotify ID, creating it if we don't have it.  Committing is left to the caller.
+        Args:
+            spotify_album_id (str): The Spotify ID
+            session (Session): The SQLAlchemy session
+
+        Returns:
+            AlbumModel
+        """
+        album_id = cls.get_album_ids([spotify_album_id], session)[spotify_album_id]
+        return session.get(AlbumModel, album_id)
 
     @classmethod
-    def get_album(cls, spotify_album_id: str) -> AlbumModel:
-        session = get_session()
-        existing = session.query(AlbumModel).filter_by(spotify_id=spotify_album_id).first()
-        if existing:
-            return existing
-        else:
-            return cls._create(session, spotify_album_id)
+    def get_album_ids(
+        cls,
+        spotify_album_ids: Iterable[str],
+        session: Session,
+        fetched: Optional[Dict[str, SpotifyAlbum]] = None,
+    ) -> Dict[str, int]:
+        """
+        Get the ids of many albums at once, by Spotify ID.  The ones we already have come from a single query, and the
+        rest are fetched from Spotify in batches and upserted, with one statement per batch for the albums and one for
+        their genres - committing is left to the caller, so a whole page of albums lands in one transaction.
+        Args:
+            spotify_album_ids (iterable(str)): The Spotify IDs
+            session (Session): The SQLAlchemy session
+            fetched (dict(str, SpotifyAlbum)): Albums already fetched from Spotify, which won't be fetched again
+
+        Returns:
+            dict(str, int) - AlbumModel.id keyed by Spotify ID.  IDs Spotify doesn't know are left out.
+        """
+        spotify_ids = set(spotify_album_ids)
+        if not spotify_ids:
+            return {}
+        query = session.query(AlbumModel.spotify_id, AlbumModel.id)
+        found = dict(query.filter(AlbumModel.spotify_id.in_(spotify_ids)))
+        missing = spotify_ids - set(found)
+        if missing:
+            fetched = fetched or {}
+            spotify_albums = [fetched[x] for x in missing if x in fetched]
+            unfetched = sorted(x for x in missing if x not in fetched)
+            if unfetched:
+                spotify_albums += Spotify.get_albums(unfetched)
+            ids, created = upsert.insert_missing(
+                session, AlbumModel.__table__, [cls._to_row(x) for x in spotify_albums], "spotify_id"
+            )
+            genres = [
+                {"album_id": ids[x.spotify_id], "genre": genre}
+                for x in spotify_albums
+                if x.spotify_id in created
+                for genre in x.genres
+            ]
+            AlbumGenre.insert_many(genres, session)
+            found.update(ids)
+        return found
+
+    @staticmethod
+    def _to_row(spotify_album: SpotifyAlbum) -> dict:
+        return {
+            "name": spotify_album.name,
+            "popularity": spotify_album.popularity,
+            "spotify_id": spotify_album.spotify_id,
+            "release_date": spotify_album.release_date,
+        }
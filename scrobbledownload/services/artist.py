@@ -1,5 +1,10 @@
-from scrobbledownload.database import get_session
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy.orm import Session
+
+from scrobbledownload import upsert
 from scrobbledownload.models import Artist as ArtistModel, ArtistGenre
+from scrobbledownload.models.spotify_models import SpotifyArtist
 from .spotify import Spotify
 
 
@@ -9,24 +14,67 @@ class Artist(object):
     """
 
     @classmethod
-    def _create(cls, session, spotify_artist_id) -> ArtistModel:
-        spotify_artist = Spotify.get_artist(spotify_artist_id)
-        genres = [ArtistGenre(genre=x) for x in spotify_artist.genres]
-        a = ArtistModel(
-            name=spotify_artist.name,
-            popularity=spotify_artist.popularity,
-            spotify_id=spotify_artist.spotify_id,
-            genres=genres,
-        )
-        session.add(a)
-        session.commit()
-        return a
+    def get_artist(cls, spotify_artist_id: str, session: Session) -> ArtistModel:
+        """
+        Get one artist by Spotify ID, creating it if we don't have it.  Committing is left to the caller.
+        Args:
+            spotify_artist_id (str): The Spotify ID
+            session (Session): The SQLAlchemy session
+
+        Returns:
+            ArtistModel
+        """
+        artist_id = cls.get_artist_ids([spotify_artist_id], session)[spotify_artist_id]
+        return session.get(ArtistModel, artist_id)
 
     @classmethod
-    def get_artist(cls, spotify_artist_id: str) -> ArtistModel:
-        session = get_session()
-        existing = session.query(ArtistModel).filter_by(spotify_id=spotify_artist_id).first()
-        if existing:
-            return existing
-        else:
-            return cls._create(session, spotify_artist_id)
+    def get_artist_ids(
+        cls,
+        spotify_artist_ids: Iterable[str],
+        session: Session,
+        fetched: Optional[Dict[str, SpotifyArtist]] = None,
+    ) -> Dict[str, int]:
+        """
+        Get the ids of many artists at once, by Spotify ID.  The ones we already have come from a single query, and the
+        rest are fetched from Spotify in batches and upserted, with one statement per batch for the artists and one for
+        their genres - committing is left to the caller, so a whole page of artists lands in one transaction.
+        Args:
+            spotify_artist_ids (iterable(str)): The Spotify IDs
+            session (Session): The SQLAlchemy session
+            fetched (dict(str, SpotifyArtist)): Artists already fetched from Spotify, which won't be fetched again
+
+        Returns:
+            dict(str, int) - ArtistModel.id keyed by Spotify ID.  IDs Spotify doesn't know are left out.
+        """
+        spotify_ids = set(spotify_artist_ids)
+        if not spotify_ids:
+            return {}
+        query = session.query(ArtistModel.spotify_id, ArtistModel.id)
+        found = dict(query.filter(ArtistModel.spotify_id.in_(spotify_ids)))
+        missing = spotify_ids - set(found)
+        if missing:
+            fetched = fetched or {}
+            spotify_artists = [fetched[x] for x in missing if x in fetched]
+            unfetched = sorted(x for x in missing if x not in fetched)
+            if unfetched:
+                spotify_artists += Spotify.get_artists(unfetched)
+            ids, created = upsert.insert_missing(
+                session, ArtistModel.__table__, [cls._to_row(x) for x in spotify_artists], "spotify_id"
+            )
+            genres = [
+                {"artist_id": ids[x.spotify_id], "genre": genre}
+                for x in spotify_artists
+                if x.spotify_id in created
+                for genre in x.genres
+            ]
+            ArtistGenre.insert_many(genres, session)
+            found.update(ids)
+        return found
+
+    @staticmethod
+    def _to_row(spotify_artist: SpotifyArtist) -> dict:
+        return {
+            "name": spotify_artist.name,
+            "popularity": spotify_artist.popularity,
+            "spotify_id": spotify_artist.spotify_id,
+        }
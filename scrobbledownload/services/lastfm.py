@@ -1,29 +1,119 @@
+import calendar
 import logging
-from typing import List
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple, Union
 
 import requests
 from datetime import datetime
+from requests.adapters import HTTPAdapter
 
+from scrobbledownload import fastjson, metrics
 from scrobbledownload.models.scrobbles import ScrobbleTrack, Scrobbles
 
 
+class LastFMEmptyPageException(Exception):
+    """
+    Last.fm kept sending back a page with no scrobbles on it, before the last page.
+    """
+
+
 class LastFM(object):
     """
     Interactions with the Last.fm API, where we download a users listened tracks.
     """
 
-    def __init__(self, username: str, api_key: str):
+    _retry_statuses = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        username: str,
+        api_key: str,
+        timeout: Union[float, Tuple[float, float]] = (5, 30),
+        max_retries: int = 5,
+        backoff: float = 0.5,
+        pool_size: int = 4,
+        max_backoff: float = 60,
+    ):
         """
         Initialize with the username, since this interacts only with a specific users information, and the API key
         for the API.
+
+        Every request goes through one pooled requests.Session, so connections are kept alive between pages.
         Args:
             username:
             api_key:
+            timeout (float or tuple(float, float)): requests timeout, in seconds - either one, or (connect, read)
+            max_retries (int): how many times to retry a page after a connection error, timeout, 429 or 5xx
+            backoff (float): base of the exponential backoff between retries, in seconds
+            pool_size (int): how many connections to keep open - match it to the page fetch concurrency
+            max_backoff (float): the longest we'll wait before a retry, in seconds, whatever Retry-After says
         """
         self._username = username
         self._api_key = api_key
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._session.headers["Accept-Encoding"] = "gzip, deflate"
+
+    def _get(self, url: str, page: int) -> requests.Response:
+        """
+        GET a url, retrying connection errors, timeouts, 429s and 5xxs with jittered exponential backoff (or the
+        Retry-After, if Last.fm sends one, up to max_backoff).
+        Args:
+            url (str): the url to get
+            page (int): the page being fetched, for logging - the url has our API key in it
+
+        Returns:
+            requests.Response
+        """
+        logger = logging.getLogger(__name__)
+        for attempt in range(self._max_retries + 1):
+            start = time.perf_counter()
+            try:
+                resp = self._session.get(url, timeout=self._timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self._max_retries:
+                    raise
+                logger.warning(f"Fetching page {page} failed: {e!r}")
+                metrics.incr("lastfm.retries")
+                retry_after = None
+            else:
+                logger.debug(
+                    f"Fetched page {page}: HTTP {resp.status_code} in {time.perf_counter() - start:.3f}s"
+                )
+                if resp.status_code not in self._retry_statuses or attempt == self._max_retries:
+                    resp.raise_for_status()
+                    return resp
+                logger.warning(f"Fetching page {page} failed: HTTP {resp.status_code}")
+                metrics.incr("lastfm.retries")
+                retry_after = resp.headers.get("Retry-After")
+
+            if retry_after is not None and retry_after.isdigit():
+                delay = float(retry_after)
+                if delay > self._max_backoff:
+                    logger.warning(
+                        f"Last.fm asked us to wait {delay:.0f}s, waiting {self._max_backoff:.0f}s instead"
+                    )
+                    delay = self._max_backoff
+            else:
+                delay = random.uniform(0, self._backoff * 2 ** attempt)
+            time.sleep(delay)
 
-    def download_scrobbles(self, page: int, scrobbles_per_page: int = 1000) -> Scrobbles:
+    def download_scrobbles(
+        self,
+        page: int,
+        scrobbles_per_page: int = 1000,
+        from_dt: Optional[datetime] = None,
+        to_dt: Optional[datetime] = None,
+    ) -> Scrobbles:
         """
         Download a list of scrobbles - that is, individual listens to a specific track as defined by Last.fm. This uses
         the LastFM user.getrecenttracks api method as documented here: https://www.last.fm/api/show/user.getRecentTracks
@@ -35,6 +125,9 @@ class LastFM(object):
                 loop through pages, you move backwards in time
             scrobbles_per_page (int): how many scrobbles, per page, we are going to retrieve.  According to the
                 docs, you are allowed a maximum of 200 tracks per request, but 1000 definitely works.
+            from_dt (datetime): Only return scrobbles after this (naive, UTC) datetime.  Paging then only walks back
+                as far as this, rather than through the users entire history.
+            to_dt (datetime): Only return scrobbles before this (naive, UTC) datetime.
 
         Returns:
             Scrobbles
@@ -43,16 +136,143 @@ class LastFM(object):
             f"http://ws.audioscrobbler.com/2.0/?method=user.getrecenttracks&"
             f"user={self._username}&api_key={self._api_key}"
             f"&format=json&limit={scrobbles_per_page}&page={page}"
+            f"{LastFM._window_params(from_dt, to_dt)}"
         )
-        req = requests.get(url)
-        req.raise_for_status()
-        scrobble_json = req.json()
-        scrobbles = LastFM._handle_lastfm_response(scrobble_json)
+        with metrics.timer("lastfm.fetch"):
+            req = self._get(url, page)
+        with metrics.timer("lastfm.parse"):
+            scrobble_json = fastjson.loads(req.content)
+            scrobbles = LastFM._handle_lastfm_response(scrobble_json)
+        metrics.incr("lastfm.scrobbles", len(scrobbles.tracks))
         logging.getLogger(__name__).info(
             f"Retrieved {len(scrobbles.tracks)} from LastFM API on page {page} of {scrobbles.totalPages}"
         )
         return scrobbles
 
+    def _download_page(
+        self,
+        page: int,
+        scrobbles_per_page: int,
+        from_dt: Optional[datetime],
+        to_dt: Optional[datetime],
+        total_pages: Optional[int] = None,
+    ) -> Scrobbles:
+        """
+        Download a page of scrobbles, retrying it with jittered exponential backoff if it comes back empty before the
+        last page.  Last.fm does that now and then, and taking it for the end of the history would leave the rest of
+        a window unfetched for good.
+        Args:
+            page (int): What page of scrobbles to gather
+            scrobbles_per_page (int): how many scrobbles, per page, we are going to retrieve
+            from_dt (datetime): Only return scrobbles after this (naive, UTC) datetime
+            to_dt (datetime): Only return scrobbles before this (naive, UTC) datetime
+            total_pages (int): how many pages there are, if we know.  Otherwise the page's own totalPages is used.
+
+        Returns:
+            Scrobbles
+        """
+        for attempt in range(self._max_retries + 1):
+            scrobbles = self.download_scrobbles(page, scrobbles_per_page, from_dt, to_dt)
+            last_page = total_pages or scrobbles.totalPages
+            if scrobbles.tracks or page >= last_page:
+                return scrobbles
+            logging.getLogger(__name__).warning(f"Page {page} of {last_page} came back empty")
+            metrics.incr("lastfm.empty_pages")
+            if attempt < self._max_retries:
+                time.sleep(random.uniform(0, self._backoff * 2 ** attempt))
+        raise LastFMEmptyPageException(f"Page {page} of {last_page} was empty {self._max_retries + 1} times")
+
+    def download_pages(
+        self,
+        scrobbles_per_page: int = 1000,
+        concurrency: int = 1,
+        from_dt: Optional[datetime] = None,
+        to_dt: Optional[datetime] = None,
+        start_page: int = 1,
+    ) -> Iterator[Scrobbles]:
+        """
+        Download every page of scrobbles from `start_page` on, most recent first.  The first page is fetched on its own
+        so we know totalPages, and the remaining pages are fetched by a bounded pool of worker threads.  At most
+        `concurrency` pages are in flight or waiting to be consumed at any time, and pages are always yielded in page
+        order.
+
+        Closing the generator (or breaking out of a loop over it) cancels any pages that haven't been fetched yet, so
+        a consumer that has caught up stops the whole download early.
+
+        A page that comes back empty before the last page is retried, and LastFMEmptyPageException is raised if it
+        stays empty, rather than the download being taken to be done.
+        Args:
+            scrobbles_per_page (int): how many scrobbles, per page, we are going to retrieve
+            concurrency (int): how many pages may be fetched at the same time
+            from_dt (datetime): Only return scrobbles after this (naive, UTC) datetime
+            to_dt (datetime): Only return scrobbles before this (naive, UTC) datetime
+            start_page (int): the page to start from, e.g. to resume a download.  Page boundaries only stay put if
+                to_dt is set, as new scrobbles push older ones onto later pages.
+
+        Returns:
+            Iterator(Scrobbles)
+        """
+        first_page = self._download_page(start_page, scrobbles_per_page, from_dt, to_dt)
+        yield first_page
+        if first_page.totalPages <= start_page or not first_page.tracks:
+            return
+
+        def fetch(page: int) -> Scrobbles:
+            return self._download_page(page, scrobbles_per_page, from_dt, to_dt, first_page.totalPages)
+
+        next_page = start_page + 1
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+            try:
+                while next_page <= first_page.totalPages and len(pending) < max(concurrency, 1):
+                    pending.append(executor.submit(fetch, next_page))
+                    next_page += 1
+                while pending:
+                    scrobbles = pending.popleft().result()
+                    if next_page <= first_page.totalPages:
+                        pending.append(executor.submit(fetch, next_page))
+                        next_page += 1
+                    yield scrobbles
+                    if not scrobbles.tracks:
+                        return
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def first_scrobble_dt(self, to_dt: Optional[datetime] = None) -> Optional[datetime]:
+        """
+        Find when the user's first scrobble was, by asking for one scrobble per page and then for the last page.
+        Args:
+            to_dt (datetime): Only look at scrobbles before this (naive, UTC) datetime
+
+        Returns:
+            datetime - or None if there aren't any scrobbles
+        """
+        first_page = self.download_scrobbles(1, 1, to_dt=to_dt)
+        if not first_page.tracks:
+            return None
+        last_page = self.download_scrobbles(first_page.totalPages, 1, to_dt=to_dt)
+        return min((t.listen_dt for t in last_page.tracks), default=None)
+
+    @staticmethod
+    def _window_params(from_dt: Optional[datetime], to_dt: Optional[datetime]) -> str:
+        """
+        Build the from/to query string parameters for user.getrecenttracks.  Last.fm wants UNIX timestamps, and our
+        datetimes are naive UTC, so we can't use datetime.timestamp() (which would assume local time).
+        Args:
+            from_dt (datetime): the start of the window, or None
+            to_dt (datetime): the end of the window, or None
+
+        Returns:
+            str
+        """
+        params = ""
+        if from_dt is not None:
+            params += f"&from={calendar.timegm(from_dt.utctimetuple())}"
+        if to_dt is not None:
+            params += f"&to={calendar.timegm(to_dt.utctimetuple())}"
+        return params
+
     @staticmethod
     def _handle_lastfm_response(resp: dict) -> Scrobbles:
         """
@@ -75,26 +295,32 @@ class LastFM(object):
     @staticmethod
     def _get_tracks(tracks_json) -> List[ScrobbleTrack]:
         """
-        Parses the JSON-decoded object for track objects.
+        Parses the JSON-decoded object for track objects.  This runs for every scrobble in a users history, so it's
+        kept tight: the nowplaying row (the only one with an @attr) is skipped with a single lookup, each nested dict
+        is looked up once, and nothing else in the row is touched.
         Args:
             tracks_json (list): a decoded JSON list of objects
 
         Returns:
             list(ScrobbleTrack)
         """
+        utcfromtimestamp = datetime.utcfromtimestamp
         tracks = []
+        append = tracks.append
         for t in tracks_json:
-            if t.get("@attr", {}).get("nowplaying"):
+            if "@attr" in t and t["@attr"].get("nowplaying"):
                 continue
-            tracks.append(
+            artist = t["artist"]
+            album = t["album"]
+            append(
                 ScrobbleTrack(
-                    track_name=t["name"],
-                    track_mbid=t["mbid"],
-                    listen_dt=datetime.utcfromtimestamp(int(t["date"]["uts"])),
-                    artist=t["artist"]["#text"],
-                    artist_mbid=t["artist"]["mbid"],
-                    album=t["album"]["#text"],
-                    album_mbid=t["album"]["mbid"],
+                    t["name"],
+                    t["mbid"],
+                    utcfromtimestamp(int(t["date"]["uts"])),
+                    artist["#text"],
+                    artist["mbid"],
+                    album["#text"],
+                    album["mbid"],
                 )
             )
         return tracks
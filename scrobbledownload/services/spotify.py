@@ -1,12 +1,13 @@
 import os
-import string
-from typing import Dict
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
 from typing import List
 
 import yaml
 from spotipy import Spotify as _Spotify
 from spotipy.oauth2 import SpotifyClientCredentials
 
+from scrobbledownload import matching, metrics, normalization
+from scrobbledownload.cache import LRUCache, PersistentCache
 from scrobbledownload.models.spotify_models import SpotifyArtist, SpotifyAlbum, SpotifyTrack
 
 
@@ -21,12 +22,18 @@ class Spotify(object):
 
     _creds: SpotifyClientCredentials
     _spotify_api: _Spotify
-    _replacements: Dict[str, str]
+    _replacements: Dict[str, str] = {}
+    _replacement_index: Optional[normalization.ReplacementIndex] = None
+    _search_cache: LRUCache = LRUCache(max_size=20000, ttl=6 * 3600, negative_ttl=3600)
+    _response_cache: Optional[PersistentCache] = None
+    # How many candidates each search asks for, and the most searches we'll make for one track
+    _search_limit: int = 50
+    _search_budget: int = 3
 
     @classmethod
     def set_replacements(cls, path):
         """
-        Set the replacements for weirdo edgecases.
+        Set the replacements for weirdo edgecases.  See ReplacementIndex for the file's format.
         Args:
             path (str): a path to the configuration file
         """
@@ -45,6 +52,38 @@ class Spotify(object):
         cls._creds = creds
         cls._spotify_api = _Spotify(client_credentials_manager=creds)
 
+    @classmethod
+    def set_response_cache(cls, cache: Optional[PersistentCache]):
+        """
+        Use a persistent cache for raw API responses, shared across runs.  Pass None to turn it off.
+        Args:
+            cache (PersistentCache): the cache to use
+        """
+        cls._response_cache = cache
+
+    @classmethod
+    def _cached_response(
+        cls, kind: str, key: str, fetch: Callable[[], Any], ttl_kind: Callable[[Any], str] = None
+    ):
+        """
+        Get a raw API response from the persistent cache if there is one, otherwise fetch it and cache it.
+        Args:
+            kind (str): the kind of entry, e.g. "artist"
+            key (str): the key within that kind, e.g. the Spotify ID
+            fetch (callable): makes the actual API call
+            ttl_kind (callable): picks which time-to-live to store a fetched response with
+
+        Returns:
+            The raw response
+        """
+        if cls._response_cache is None:
+            return fetch()
+        response = cls._response_cache.get(kind, key)
+        if response is None:
+            response = fetch()
+            cls._response_cache.set(kind, key, response, ttl_kind(response) if ttl_kind else None)
+        return response
+
     @classmethod
     def get_artist(cls, artist_id) -> SpotifyArtist:
         """
@@ -55,10 +94,24 @@ class Spotify(object):
         Returns:
             SpotifyArtist
         """
-        a = cls._spotify_api.artist(artist_id)
-        return SpotifyArtist(
-            name=a["name"], spotify_id=artist_id, genres=a["genres"], popularity=a.get("popularity"),
+        a = cls._cached_response("artist", artist_id, lambda: cls._spotify_api.artist(artist_id))
+        return cls._handle_spotify_artist_response(a, artist_id)
+
+    @classmethod
+    def get_artists(cls, artist_ids: Iterable[str]) -> List[SpotifyArtist]:
+        """
+        Get many spotify artist objects at once, using the several-artists endpoint in batches of 50.  Artists that
+        are already in the persistent response cache aren't asked for again, and IDs Spotify doesn't know are skipped.
+        Args:
+            artist_ids (iterable(str)): The spotify IDs for the artists
+
+        Returns:
+            List(SpotifyArtist)
+        """
+        responses = cls._cached_batch(
+            "artist", artist_ids, 50, lambda ids: cls._spotify_api.artists(ids)["artists"]
         )
+        return [cls._handle_spotify_artist_response(a, a["id"]) for a in responses]
 
     @classmethod
     def get_album(cls, album_id) -> SpotifyAlbum:
@@ -70,7 +123,86 @@ class Spotify(object):
         Returns:
             SpotifyAlbum
         """
-        a = cls._spotify_api.album(album_id)
+        a = cls._cached_response("album", album_id, lambda: cls._spotify_api.album(album_id))
+        return cls._handle_spotify_album_response(a)
+
+    @classmethod
+    def get_albums(cls, album_ids: Iterable[str]) -> List[SpotifyAlbum]:
+        """
+        Get many spotify album objects at once, using the several-albums endpoint in batches of 20.  Albums that are
+        already in the persistent response cache aren't asked for again, and IDs Spotify doesn't know are skipped.
+        Args:
+            album_ids (iterable(str)): The spotify IDs for the albums
+
+        Returns:
+            List(SpotifyAlbum)
+        """
+        responses = cls._cached_batch(
+            "album", album_ids, 20, lambda ids: cls._spotify_api.albums(ids)["albums"]
+        )
+        return [cls._handle_spotify_album_response(a) for a in responses]
+
+    @classmethod
+    def _cached_batch(
+        cls, kind: str, ids: Iterable[str], batch_size: int, fetch: Callable[[List[str]], List[dict]]
+    ) -> List[dict]:
+        """
+        Get raw API responses for many IDs, serving what we can from the persistent cache and fetching the rest in
+        batches.
+        Args:
+            kind (str): the kind of entry, e.g. "artist"
+            ids (iterable(str)): the Spotify IDs
+            batch_size (int): how many IDs the endpoint accepts per call
+            fetch (callable): makes the actual API call for a batch of IDs, returning a list of responses
+
+        Returns:
+            list(dict)
+        """
+        responses = []
+        missing = []
+        for spotify_id in dict.fromkeys(ids):
+            cached = cls._response_cache.get(kind, spotify_id) if cls._response_cache is not None else None
+            if cached is None:
+                missing.append(spotify_id)
+            else:
+                responses.append(cached)
+
+        for i in range(0, len(missing), batch_size):
+            with metrics.timer(f"spotify.{kind}s.fetch"):
+                batch = fetch(missing[i : i + batch_size])
+            for response in batch:
+                if response is None:
+                    continue
+                if cls._response_cache is not None:
+                    cls._response_cache.set(kind, response["id"], response)
+                responses.append(response)
+        return responses
+
+    @staticmethod
+    def _handle_spotify_artist_response(a: dict, artist_id: str) -> SpotifyArtist:
+        """
+        Parse a Spotify artist response into a SpotifyArtist
+        Args:
+            a (dict): the artist from spotify
+            artist_id (str): The spotify ID for the artist
+
+        Returns:
+            SpotifyArtist
+        """
+        return SpotifyArtist(
+            name=a["name"], spotify_id=artist_id, genres=a["genres"], popularity=a.get("popularity"),
+        )
+
+    @staticmethod
+    def _handle_spotify_album_response(a: dict) -> SpotifyAlbum:
+        """
+        Parse a Spotify album response into a SpotifyAlbum
+        Args:
+            a (dict): the album from spotify
+
+        Returns:
+            SpotifyAlbum
+        """
         return SpotifyAlbum(
             name=a["name"],
             spotify_id=a["id"],
@@ -80,21 +212,34 @@ class Spotify(object):
             popularity=a["popularity"],
         )
 
+    @classmethod
+    def _replacements_index(cls) -> normalization.ReplacementIndex:
+        """
+        The index of the current replacements, rebuilt whenever they're replaced
+        Returns:
+            ReplacementIndex
+        """
+        index = cls._replacement_index
+        if index is None or index.source is not cls._replacements:
+            index = cls._replacement_index = normalization.ReplacementIndex(cls._replacements)
+        return index
+
     @classmethod
     def handle_replacements(self, input_str: str) -> str:
         """
-        If an edge-case replacement exists, return the replacement, else just the string
+        If an edge-case replacement exists, return the replacement, else just the string.  See ReplacementIndex for
+        the kinds of rules.
         Args:
             input_str (str):
 
         Returns:
             str
         """
-        return self._replacements.get(input_str, input_str)
+        return self._replacements_index().apply(input_str)
 
     @staticmethod
     def to_alphanum(s: str) -> str:
-        """u
+        """
         Translate a string to alpha-numeric only
         Args:
             s (str): an input string to translate
@@ -102,7 +247,7 @@ class Spotify(object):
         Returns:
             str
         """
-        return s.translate(str.maketrans("", "", string.punctuation))
+        return normalization.to_alphanum(s)
 
     @classmethod
     def _handle_spotify_track_response(cls, response) -> List[SpotifyTrack]:
@@ -124,55 +269,212 @@ class Spotify(object):
                     popularity=track["popularity"],
                     album_id=track["album"]["id"],
                     artist_id=track["artists"][0]['id'],
+                    artist_name=track["artists"][0].get("name"),
+                    album_name=track["album"].get("name"),
                 )
             )
         return results
 
+    @staticmethod
+    def _search_cache_key(search_string: str) -> str:
+        """
+        Normalize a search string for use as a cache key - Spotify search doesn't care about case or extra whitespace,
+        so neither do we.
+        Args:
+            search_string (str): the search string sent to Spotify
+
+        Returns:
+            str
+        """
+        return " ".join(search_string.lower().split())
+
+    @classmethod
+    def search_cache_stats(cls) -> Dict[str, int]:
+        """
+        Get the hit/miss counters of the in-process search cache
+        Returns:
+            dict
+        """
+        return cls._search_cache.stats()
+
     @classmethod
-    def _make_track_query(cls, track_name, track_artist):
+    def _cached_search(cls, search_string: str) -> Optional[List[SpotifyTrack]]:
         """
-        Makes a query to the Spotify API
+        Get the results of a search from the in-process cache, or failing that, the persistent response cache.
         Args:
-            track_name (str):
-            track_artist (str):
+            search_string (str): the search string sent to Spotify
 
         Returns:
-            SpotifyTrack
+            List(SpotifyTrack), or None if the search isn't cached
         """
-        search_string = f"{track_name} artist:{track_artist}"
-        response = cls._spotify_api.search(q=search_string, type="track")
-        return cls._handle_spotify_track_response(response)
+        cache_key = cls._search_cache_key(search_string)
+        results = cls._search_cache.get(cache_key)
+        if results is None and cls._response_cache is not None:
+            response = cls._response_cache.get("search", cache_key)
+            if response is not None:
+                results = cls._handle_spotify_track_response(response)
+                cls._search_cache.set(cache_key, results)
+        return results
 
     @classmethod
-    def get_track(cls, track_name: str, track_artist: str) -> SpotifyTrack:
+    def _cache_search(cls, search_string: str, response: dict) -> List[SpotifyTrack]:
         """
-        Use Spotipy search to find a track from the Spotify API.
+        Parse a fresh search response and put it in the caches.
+        Args:
+            search_string (str): the search string sent to Spotify
+            response (dict): the raw search response
+
+        Returns:
+            List(SpotifyTrack)
+        """
+        cache_key = cls._search_cache_key(search_string)
+        if cls._response_cache is not None:
+            ttl_kind = "search" if response["tracks"]["items"] else "search_miss"
+            cls._response_cache.set("search", cache_key, response, ttl_kind)
+        results = cls._handle_spotify_track_response(response)
+        cls._search_cache.set(cache_key, results)
+        return results
+
+    @classmethod
+    def _make_track_query(cls, search_string: str) -> List[SpotifyTrack]:
+        """
+        Makes a query to the Spotify API, for up to _search_limit candidates.  Results, including empty ones, are
+        cached by the normalized search string, so repeated and failed searches within a run don't go back to the
+        network.
+        Args:
+            search_string (str): the search, e.g. from _track_queries
+
+        Returns:
+            List(SpotifyTrack)
+        """
+        results = cls._cached_search(search_string)
+        if results is None:
+            with metrics.timer("spotify.search.request"):
+                response = cls._spotify_api.search(q=search_string, limit=cls._search_limit, type="track")
+            results = cls._cache_search(search_string, response)
+        return results
+
+    @classmethod
+    def _clean_query_words(cls, s: str) -> str:
+        return " ".join(cls._replacements_index().apply_words(cls.to_alphanum(s)).split())
+
+    @classmethod
+    def _search_artist(cls, track_artist: str) -> str:
+        """
+        The artist as we search for them: stripped of featured artists, alpha-numeric, and with any edge-case
+        replacement applied
+        Args:
+            track_artist (str): Name of the artist
+
+        Returns:
+            str
+        """
+        return cls.handle_replacements(cls.to_alphanum(matching.strip_artist(track_artist)))
 
-        This method has a little bit of extra magic that has to happen, due to some differences between the LastFM and
-        Spotify track/artist/ablum names, punctuation, etc.
+    @classmethod
+    def _best_match(
+        cls,
+        candidates: List[SpotifyTrack],
+        track_name: str,
+        track_artist: str,
+        track_album: Optional[str] = None,
+        duration_ms: Optional[int] = None,
+    ) -> Optional[SpotifyTrack]:
+        """
+        Pick the best candidate from a search, scoring the artist against both the Last.fm name and the name we
+        searched with - the edge-case replacements are what Spotify calls an artist, e.g. Pageninetynine for Pg99.
+        Args:
+            candidates (list(SpotifyTrack)): the search results, in Spotify's order
+            track_name (str): Name of the track
+            track_artist (str): Name of the artist
+            track_album (str): Name of the album
+            duration_ms (int): Length of the track
 
-        We loop through, chopping words off the FRONT of the track name, since (in my experience) that has better luck
-         finding the actual track we are after.
+        Returns:
+            SpotifyTrack, or None if nothing matches well enough
+        """
+        return matching.best_match(
+            candidates,
+            track_name,
+            track_artist,
+            track_album,
+            duration_ms,
+            artist_alias=cls._search_artist(track_artist),
+        )
 
+    @classmethod
+    def _track_queries(cls, track_name: str, track_artist: str) -> Iterator[str]:
+        """
+        The searches to try for a track, in order, and never more than _search_budget of them: the title stripped of
+        decorations like "(Remastered)" and "feat. ...", then the title as it was, both filtered by artist, and last a
+        free-text search for when Spotify knows the artist by a slightly different name.
         Args:
             track_name (str): Name of the track
             track_artist (str): Name of the artist
 
         Returns:
-            SpotifyTrack
+            Iterator(str)
+        """
+        artist = cls._search_artist(track_artist)
+        names = [cls._clean_query_words(name) for name in matching.title_variants(track_name)]
+        searches = [f"{name} artist:{artist}" for name in names] + [f"{names[0]} {artist}"]
+        seen = set()
+        for search_string in searches:
+            key = cls._search_cache_key(search_string)
+            if key in seen:
+                continue
+            seen.add(key)
+            yield search_string
+            if len(seen) >= cls._search_budget:
+                return
+
+    @staticmethod
+    def _record_search(attempts: int, found: bool):
+        """
+        Count a track search: how many queries it took, and how many fallback queries were needed to find the track.
+        Args:
+            attempts (int): how many queries were tried
+            found (bool): whether the track was found
+        """
+        metrics.incr("spotify.search.tracks")
+        metrics.incr("spotify.search.attempts", attempts)
+        if found:
+            metrics.incr("spotify.search.fallbacks", attempts - 1)
+        else:
+            metrics.incr("spotify.search.not_found")
+
+    @classmethod
+    def get_track(
+        cls,
+        track_name: str,
+        track_artist: str,
+        track_album: Optional[str] = None,
+        duration_ms: Optional[int] = None,
+    ) -> SpotifyTrack:
         """
-        track_artist = cls.handle_replacements(cls.to_alphanum(track_artist))
-        track_name_words = [
-            cls.handle_replacements(cls.to_alphanum(word)) for word in reversed(track_name.split())
-        ]
+        Use Spotipy search to find a track from the Spotify API.
 
-        results = cls._make_track_query(" ".join(reversed(track_name_words)), track_artist)
+        The LastFM and Spotify track/artist/album names differ in punctuation, decorations, featured artists, etc, so
+        rather than trusting the first result, every search asks for a page of candidates and the best scoring one
+        (see scrobbledownload.matching) wins.  See _track_queries for the searches we try - there's a fixed budget of
+        them, so a track that's just not on Spotify costs a bounded number of calls.
 
-        while len(track_name_words) > 1 and not len(results):
-            track_name_words.pop()
-            search_string_track_name = " ".join(list(reversed(track_name_words)))
-            results = cls._make_track_query(search_string_track_name, track_artist)
+        Args:
+            track_name (str): Name of the track
+            track_artist (str): Name of the artist
+            track_album (str): Name of the album, to help pick between close candidates
+            duration_ms (int): Length of the track, if we know it, to help pick between close candidates
 
-        if not results:
-            raise SpotifyNotFoundExcecption(f"Unable to find {track_name} by {track_artist}")
-        return results[0]
+        Returns:
+            SpotifyTrack
+        """
+        attempts = 0
+        for search_string in cls._track_queries(track_name, track_artist):
+            attempts += 1
+            candidates = cls._make_track_query(search_string)
+            match = cls._best_match(candidates, track_name, track_artist, track_album, duration_ms)
+            if match is not None:
+                cls._record_search(attempts, True)
+                return match
+        cls._record_search(attempts, False)
+        raise SpotifyNotFoundExcecption(f"Unable to find {track_name} by {track_artist}")
@@ -0,0 +1,246 @@
+"""
+An asyncio Spotify client, for running many track searches concurrently.  The Spotify class stays the synchronous
+facade for everything else - this only does searches, and shares Spotify's query building, parsing and caches.
+
+This needs httpx, which is an optional dependency: pip install scrobbledownloader[async]
+"""
+import asyncio
+import logging
+import random
+import time
+from typing import Callable, List, Optional
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover - only when the async extra isn't installed
+    httpx = None
+
+from scrobbledownload import metrics
+from scrobbledownload.models.spotify_models import SpotifyTrack
+from .spotify import Spotify, SpotifyNotFoundExcecption
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    An asyncio token-bucket rate limiter.  Tokens refill at a steady rate up to the bucket's capacity, and every request
+    takes one.  When Spotify answers with a 429, the whole bucket is paused for the Retry-After period, so every
+    in-flight task backs off together rather than each one discovering the limit for itself.
+    """
+
+    def __init__(
+        self, rate: float, capacity: Optional[int] = None, clock: Callable[[], float] = time.monotonic
+    ):
+        """
+        Args:
+            rate (float): tokens added per second
+            capacity (int): the most tokens the bucket can hold, i.e. the largest burst.  Defaults to the rate.
+            clock (callable): Where the time comes from, in seconds
+        """
+        self._rate = rate
+        self._capacity = capacity or max(int(rate), 1)
+        self._clock = clock
+        self._tokens = float(self._capacity)
+        self._updated = clock()
+        self._paused_until = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    def pause(self, seconds: float):
+        """
+        Stop handing out tokens for a while, e.g. for a 429's Retry-After.
+        Args:
+            seconds (float): how long to pause for
+        """
+        self._paused_until = max(self._paused_until, self._clock() + seconds)
+        self._tokens = 0.0
+
+    def _wait_time(self) -> float:
+        """
+        Take a token if we can.
+        Returns:
+            float - 0 if a token was taken, otherwise how long to wait before trying again
+        """
+        now = self._clock()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self._rate
+
+    async def acquire(self):
+        """
+        Wait until a token is available, and take it.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            wait = self._wait_time()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self._wait_time()
+
+
+class AsyncSpotify(object):
+    """
+    Searches the Spotify API for tracks with an async HTTP client, authenticating with the client credentials flow.
+    """
+
+    token_url = "https://accounts.spotify.com/api/token"
+    search_url = "https://api.spotify.com/v1/search"
+
+    def __init__(
+        self,
+        client_id: str,
+        client_secret: str,
+        limiter: Optional[TokenBucket] = None,
+        client: Optional["httpx.AsyncClient"] = None,
+        max_retries: int = 5,
+    ):
+        """
+        Args:
+            client_id (str): The Spotify client ID
+            client_secret (str): The Spotify client secret
+            limiter (TokenBucket): Rate limits our requests.  Defaults to 10 a second.
+            client (httpx.AsyncClient): The HTTP client to use - mostly for tests
+            max_retries (int): How many times to retry a request that got a 429, a 5xx, a connection error or a
+                timeout
+        """
+        if httpx is None:
+            raise ImportError("The async engine needs httpx - pip install scrobbledownloader[async]")
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._limiter = limiter
+        self._client = client
+        self._max_retries = max_retries
+        self._token: Optional[str] = None
+        self._token_expires = 0.0
+        self._token_lock: Optional[asyncio.Lock] = None
+
+    async def _get_token(self, refresh: bool = False) -> str:
+        """
+        Get an access token through the client credentials flow, reusing it until it's about to expire.
+        Args:
+            refresh (bool): get a new token even if the current one hasn't expired, e.g. after a 401
+
+        Returns:
+            str
+        """
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        async with self._token_lock:
+            if refresh or self._token is None or time.monotonic() >= self._token_expires:
+                resp = await self._client.post(
+                    self.token_url,
+                    data={"grant_type": "client_credentials"},
+                    auth=(self._client_id, self._client_secret),
+                )
+                resp.raise_for_status()
+                token = resp.json()
+                self._token = token["access_token"]
+                self._token_expires = time.monotonic() + token.get("expires_in", 3600) - 60
+            return self._token
+
+    async def _get(self, url: str, params: dict) -> dict:
+        """
+        Make a rate-limited GET request to the API.  429s pause the limiter for their Retry-After and are retried, as
+        are 5xx errors, connection errors and timeouts (with jittered exponential backoff), and a 401 gets a fresh
+        token.  Once the retries run out, the last error is raised.
+        Args:
+            url (str): the API url
+            params (dict): the query string parameters
+
+        Returns:
+            dict - the decoded JSON response
+        """
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=30.0)
+        if self._limiter is None:
+            self._limiter = TokenBucket(10)
+
+        refresh = False
+        for attempt in range(self._max_retries + 1):
+            retries_left = attempt < self._max_retries
+            await self._limiter.acquire()
+            try:
+                token = await self._get_token(refresh)
+                refresh = False
+                resp = await self._client.get(url, params=params, headers={"Authorization": f"Bearer {token}"})
+            except (httpx.TransportError, httpx.TimeoutException) as e:
+                if not retries_left:
+                    raise
+                logger.warning(f"Spotify request failed: {e!r}")
+                metrics.incr("spotify.retries")
+                await asyncio.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+                continue
+
+            if resp.status_code == 429 and retries_left:
+                retry_after = float(resp.headers.get("Retry-After", 1))
+                logger.warning(f"Rate limited by Spotify, backing off for {retry_after}s")
+                metrics.incr("spotify.rate_limited")
+                self._limiter.pause(retry_after)
+                continue
+            if resp.status_code == 401 and retries_left:
+                refresh = True
+                continue
+            if resp.status_code >= 500 and retries_left:
+                await asyncio.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+                continue
+            # Anything else that's not a success, including a 429 on the last attempt, is raised
+            resp.raise_for_status()
+            return resp.json()
+        raise RuntimeError(f"Gave up on {url} after {self._max_retries + 1} attempts")
+
+    async def make_track_query(self, search_string: str) -> List[SpotifyTrack]:
+        """
+        Search for a track, going through the same caches as Spotify._make_track_query
+        Args:
+            search_string (str): the search, e.g. from Spotify._track_queries
+
+        Returns:
+            List(SpotifyTrack)
+        """
+        results = Spotify._cached_search(search_string)
+        if results is None:
+            start = time.perf_counter()
+            params = {"q": search_string, "type": "track", "limit": Spotify._search_limit}
+            response = await self._get(self.search_url, params)
+            metrics.observe("spotify.search.request", time.perf_counter() - start)
+            results = Spotify._cache_search(search_string, response)
+        return results
+
+    async def get_track(
+        self,
+        track_name: str,
+        track_artist: str,
+        track_album: Optional[str] = None,
+        duration_ms: Optional[int] = None,
+    ) -> SpotifyTrack:
+        """
+        Find a track, trying the same searches and scoring the candidates the same way as Spotify.get_track
+        Args:
+            track_name (str): Name of the track
+            track_artist (str): Name of the artist
+            track_album (str): Name of the album, to help pick between close candidates
+            duration_ms (int): Length of the track, if we know it, to help pick between close candidates
+
+        Returns:
+            SpotifyTrack
+        """
+        attempts = 0
+        for search_string in Spotify._track_queries(track_name, track_artist):
+            attempts += 1
+            candidates = await self.make_track_query(search_string)
+            match = Spotify._best_match(candidates, track_name, track_artist, track_album, duration_ms)
+            if match is not None:
+                Spotify._record_search(attempts, True)
+                return match
+        Spotify._record_search(attempts, False)
+        raise SpotifyNotFoundExcecption(f"Unable to find {track_name} by {track_artist}")
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
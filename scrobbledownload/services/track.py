@@ -1,9 +1,12 @@
 import hashlib
+import threading
+from typing import Dict, Iterable, Optional
 
 from sqlalchemy.orm import Session
 
-from scrobbledownload import models
+from scrobbledownload import models, upsert
 from scrobbledownload.models.scrobbles import ScrobbleTrack
+from scrobbledownload.models.spotify_models import SpotifyTrack
 from scrobbledownload.services import Artist, Album
 from scrobbledownload.services.genius import Genius
 from scrobbledownload.services.spotify import Spotify
@@ -79,21 +82,52 @@ class Track(object):
         Returns:
             models.Track
         """
-        spotify_track = Spotify.get_track(track_name=self._track_name, track_artist=self._track_artist)
-        artist = Artist.get_artist(spotify_track.artist_id)
-        album = Album.get_album(spotify_track.album_id)
-
-        track = models.Track(
-            name=spotify_track.name,
-            spotify_id=spotify_track.spotify_id,
-            mbid=self._mbid,
-            generated_id=self.hash,
-            artist=artist,
-            album=album,
-        )
-        self._session.add(track)
+        spotify_track = self.search()
+        artist_id = Artist.get_artist_ids([spotify_track.artist_id], self._session)[spotify_track.artist_id]
+        album_id = Album.get_album_ids([spotify_track.album_id], self._session)[spotify_track.album_id]
+
+        row = self.to_row(spotify_track, artist_id, album_id)
+        ids, _ = upsert.insert_missing(self._session, models.Track.__table__, [row], "generated_id")
         self._session.commit()
-        return track
+        return self._session.get(models.Track, ids[self.hash])
+
+    def search(self) -> SpotifyTrack:
+        """
+        Find this track on Spotify
+        Returns:
+            SpotifyTrack
+        """
+        return Spotify.get_track(
+            track_name=self._track_name, track_artist=self._track_artist, track_album=self._track_album
+        )
+
+    def to_row(self, spotify_track: SpotifyTrack, artist_id: int, album_id: int) -> dict:
+        """
+        The tracks row for a Spotify search result and its already-resolved artist and album, ready to upsert.
+        Args:
+            spotify_track (SpotifyTrack): The Spotify search result for this track
+            artist_id (int): The track's artist's id
+            album_id (int): The track's album's id
+
+        Returns:
+            dict
+        """
+        return {
+            "name": spotify_track.name,
+            "spotify_id": spotify_track.spotify_id,
+            "mbid": self._mbid,
+            "generated_id": self.hash,
+            "artist_id": artist_id,
+            "album_id": album_id,
+        }
+
+    def get_existing(self) -> Optional[models.Track]:
+        """
+        Get the Track model object if we already have it
+        Returns:
+            models.Track, or None
+        """
+        return self._session.query(models.Track).filter_by(generated_id=self.hash).first()
 
     def get_model_object(self) -> models.Track:
         """
@@ -101,11 +135,23 @@ class Track(object):
         Returns:
             models.Track
         """
-        existing = self._session.query(models.Track).filter_by(generated_id=self.hash).first()
+        existing = self.get_existing()
         if existing:
             return existing
         return self._build_from_scratch()
 
+    @property
+    def track_name(self) -> str:
+        return self._track_name
+
+    @property
+    def track_artist(self) -> str:
+        return self._track_artist
+
+    @property
+    def track_album(self) -> str:
+        return self._track_album
+
     @property
     def hash(self) -> str:
         """
@@ -114,6 +160,98 @@ class Track(object):
         Returns:
             str
         """
-        return hashlib.sha1(
-            f"{self._track_name} - {self._track_artist} on {self._track_album}".encode()
-        ).hexdigest()
+        return self.generate_id(self._track_name, self._track_artist, self._track_album)
+
+    @staticmethod
+    def generate_id(track_name: str, track_artist: str, track_album: str) -> str:
+        """
+        The hash for a track, without having to build a Track first.
+        Args:
+            track_name (str): The name of the track
+            track_artist (str): The Track artist
+            track_album (str): The track album
+
+        Returns:
+            str
+        """
+        return hashlib.sha1(f"{track_name} - {track_artist} on {track_album}".encode()).hexdigest()
+
+
+class TrackIndex(object):
+    """
+    An in-memory map of Track.generated_id -> Track.id, so known tracks can be resolved without a query per scrobble.
+    It's safe to share between threads.
+
+    It can be loaded in full once at startup, in which case a hash missing from the map is a track we don't have.
+    Otherwise, hashes it hasn't seen are looked up with a single IN query per call and remembered.
+    """
+
+    _query_batch_size = 500
+
+    def __init__(self, ids: Optional[Dict[str, int]] = None, complete: bool = False):
+        """
+        Args:
+            ids (dict): generated_id -> Track.id to start with
+            complete (bool): whether the ids are every track in the database
+        """
+        self._ids = dict(ids or {})
+        self._complete = complete
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, session: Session) -> "TrackIndex":
+        """
+        Load the generated_id of every track in the database, in one query.
+        Args:
+            session (Session): The SQLAlchemy session
+
+        Returns:
+            TrackIndex
+        """
+        ids = dict(session.query(models.Track.generated_id, models.Track.id))
+        return cls(ids, complete=True)
+
+    def resolve(self, generated_ids: Iterable[str], session: Session) -> Dict[str, int]:
+        """
+        Get the Track ids for the tracks we already have.
+        Args:
+            generated_ids (iterable(str)): Track hashes, as from Track.hash
+            session (Session): The SQLAlchemy session
+
+        Returns:
+            dict(str, int) - generated_id -> Track.id, for only the known tracks
+        """
+        wanted = set(generated_ids)
+        with self._lock:
+            unseen = [] if self._complete else sorted(wanted - set(self._ids))
+        for i in range(0, len(unseen), self._query_batch_size):
+            batch = unseen[i : i + self._query_batch_size]
+            query = session.query(models.Track.generated_id, models.Track.id)
+            found = dict(query.filter(models.Track.generated_id.in_(batch)))
+            with self._lock:
+                self._ids.update(found)
+        with self._lock:
+            return {
+                generated_id: self._ids[generated_id] for generated_id in wanted if generated_id in self._ids
+            }
+
+    def add(self, generated_id: str, track_id: int):
+        """
+        Remember a track that was just created.
+        Args:
+            generated_id (str): The track's hash
+            track_id (int): The track's id
+        """
+        with self._lock:
+            self._ids[generated_id] = track_id
+
+    @property
+    def complete(self) -> bool:
+        return self._complete
+
+    def __contains__(self, generated_id: str) -> bool:
+        with self._lock:
+            return generated_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
@@ -0,0 +1,107 @@
+"""
+Inserting rows that may already exist, keyed on a unique column, in batches.
+
+On Postgres and SQLite, that's INSERT ... ON CONFLICT ... RETURNING id, so a batch of new rows costs one statement, and
+two writers racing to create the same row can't both succeed or fail - one inserts it, the other gets its id.  Other
+databases get the old select-then-insert, which is fine for one writer at a time.
+"""
+from typing import Any, Dict, List, Sequence, Set, Tuple
+
+from sqlalchemy import Table, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+_BATCH_SIZE = 500
+
+_ON_CONFLICT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def supports_on_conflict(session: Session) -> bool:
+    """
+    Whether the session's database can do INSERT ... ON CONFLICT ... RETURNING
+    Args:
+        session (Session): The SQLAlchemy session
+
+    Returns:
+        bool
+    """
+    dialect = session.get_bind().dialect
+    return dialect.name in _ON_CONFLICT_INSERTS and getattr(dialect, "insert_returning", False)
+
+
+def insert_missing(
+    session: Session,
+    table: Table,
+    rows: Sequence[Dict[str, Any]],
+    key: str,
+    update: Sequence[str] = (),
+    batch_size: int = _BATCH_SIZE,
+) -> Tuple[Dict[Any, int], Set[Any]]:
+    """
+    Insert the rows whose key isn't in the table yet, and get the id of every row, new or not.  Rows are inserted in
+    key order, so concurrent writers take their locks in the same order.  Nothing is committed here.
+    Args:
+        session (Session): The SQLAlchemy session
+        table (Table): the table, which needs an integer id primary key
+        rows (list(dict)): the rows, as column name -> value.  Only the first row for each key is used.
+        key (str): the unique column the rows are matched on
+        update (list(str)): columns to overwrite on rows that already exist - Postgres and SQLite only
+        batch_size (int): most rows per statement
+
+    Returns:
+        (dict, set) - the id of every row by key, and the keys of the rows that were inserted (which can't be told
+        apart when updating, so it's empty then)
+    """
+    unique = {}
+    for row in rows:
+        unique.setdefault(row[key], row)
+    ordered = [unique[k] for k in sorted(unique)]
+    if not ordered:
+        return {}, set()
+    if supports_on_conflict(session):
+        return _insert_on_conflict(session, table, ordered, key, update, batch_size)
+    return _select_then_insert(session, table, ordered, key, batch_size)
+
+
+def _insert_on_conflict(
+    session: Session, table: Table, rows: List[dict], key: str, update: Sequence[str], batch_size: int
+) -> Tuple[Dict[Any, int], Set[Any]]:
+    insert = _ON_CONFLICT_INSERTS[session.get_bind().dialect.name](table)
+    if update:
+        statement = insert.on_conflict_do_update(
+            index_elements=[key], set_={column: insert.excluded[column] for column in update}
+        )
+    else:
+        statement = insert.on_conflict_do_nothing(index_elements=[key])
+    statement = statement.returning(table.c[key], table.c.id)
+    ids: Dict[Any, int] = {}
+    for batch in _batches(rows, batch_size):
+        ids.update((k, i) for k, i in session.execute(statement.values(batch)))
+    # DO NOTHING doesn't return the rows that were already there, so those are looked up
+    created = set(ids) if not update else set()
+    ids.update(_select_ids(session, table, key, [row[key] for row in rows if row[key] not in ids], batch_size))
+    return ids, created
+
+
+def _select_then_insert(
+    session: Session, table: Table, rows: List[dict], key: str, batch_size: int
+) -> Tuple[Dict[Any, int], Set[Any]]:
+    ids = _select_ids(session, table, key, [row[key] for row in rows], batch_size)
+    missing = [row for row in rows if row[key] not in ids]
+    for batch in _batches(missing, batch_size):
+        session.execute(table.insert(), batch)
+    created = {row[key] for row in missing}
+    ids.update(_select_ids(session, table, key, sorted(created), batch_size))
+    return ids, created
+
+
+def _select_ids(session: Session, table: Table, key: str, keys: List[Any], batch_size: int) -> Dict[Any, int]:
+    ids = {}
+    for batch in _batches(keys, batch_size):
+        query = select(table.c[key], table.c.id).where(table.c[key].in_(batch))
+        ids.update((k, i) for k, i in session.execute(query))
+    return ids
+
+
+def _batches(items: Sequence, size: int) -> List[Sequence]:
+    return [items[i : i + size] for i in range(0, len(items), size)]
@@ -14,5 +14,6 @@ setup(
     long_description=long_desc,
     packages=find_packages(),
     install_requires=requires,
+    extras_require={"async": ["httpx"], "fast": ["orjson"]},
     entry_points={"console_scripts": ["download-scrobbles=scrobbledownload.cli:cli"]},
 )
@@ -1,75 +1,79 @@
+from datetime import date
 from unittest import TestCase
-from unittest.mock import MagicMock, patch
+from unittest.mock import patch
 from scrobbledownload.services.album import Album
-from scrobbledownload.models import Album as AlbumModel
+from scrobbledownload.models import Album as AlbumModel, AlbumGenre
 from scrobbledownload.models import create_all
 from scrobbledownload.models.spotify_models import SpotifyAlbum
-from datetime import date
 from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 
 
-class TestAlbum(TestCase):
-    @patch('scrobbledownload.services.album.get_session')
-    def test_get_album_exists(self, mock_get_session):
-        session = MagicMock()
-        mock_get_session.return_value = session
-        expected = AlbumModel(
-            name='test album',
-            spotify_id='test id',
-            release_date=date(2019, 1, 1),
-            popularity=19)
+def spotify_album(spotify_id, name='new album'):
+    return SpotifyAlbum(
+        name=name,
+        spotify_id=spotify_id,
+        release_date_str='2019-02-05',
+        release_date_precision='day',
+        genres=['genre1', 'genre2'],
+        popularity=99,
+    )
 
-        # Mock the return of the SQLAlchemy query for unit tests.
-        session.query.return_value.filter_by.return_value.first.return_value = expected
-        actual = Album.get_album('test_id')
-        assert actual == expected
 
-    @patch.object(Album, '_create')
-    @patch('scrobbledownload.services.album.get_session')
-    def test_get_album_doesnt_exist(self, mock_get_session, mock_create):
-        session = MagicMock()
-        mock_get_session.return_value = session
-        session.query.return_value.filter_by.return_value.first.return_value = False
+class TestAlbum(TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        create_all(self.engine)
+        self.session = Session(bind=self.engine)
 
-        actual = Album.get_album('test_id')
-        mock_create.assert_called()
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
 
     @patch('scrobbledownload.services.album.Spotify')
-    def test_create(self, mock_spotify):
-        session = MagicMock()
-        mock_spotify.get_album.return_value = SpotifyAlbum(
-            name='test album',
-            spotify_id='testid',
-            release_date_str='2019-02-05',
-            release_date_precision='day',
-            genres=['genre1', 'genre2'],
-            popularity=99
-        )
+    def test_get_album(self, mock_spotify):
+        mock_spotify.get_albums.return_value = [spotify_album('testid', 'test album')]
 
-        Album._create(session, 'test_id')
-        mock_spotify.get_album.assert_called_with('test_id')
-        added_model = session.add.call_args[0][0]
-        assert added_model.name == 'test album'
-        session.commit.assert_called()
+        actual = Album.get_album('testid', self.session)
+        mock_spotify.get_albums.assert_called_once_with(['testid'])
+        assert (actual.name, actual.popularity, actual.spotify_id) == ('test album', 99, 'testid')
+        assert actual.release_date == date(2019, 2, 5)
+        assert sorted(g.genre for g in actual.genres) == ['genre1', 'genre2']
+
+        # The second time, it's already there
+        mock_spotify.reset_mock()
+        assert Album.get_album('testid', self.session).id == actual.id
+        mock_spotify.get_albums.assert_not_called()
 
     @patch('scrobbledownload.services.album.Spotify')
-    def test_create_with_backend(self, mock_spotify):
-        mock_spotify.get_album.return_value = SpotifyAlbum(
-            name='test album',
-            spotify_id='testid',
-            release_date_str='2019-02-05',
-            release_date_precision='day',
-            genres=['genre1', 'genre2'],
-            popularity=99
-        )
+    def test_get_album_ids(self, mock_spotify):
+        mock_spotify.get_albums.return_value = [spotify_album('new id')]
+        existing = AlbumModel(name='existing album', spotify_id='existing id')
+        self.session.add(existing)
+        self.session.commit()
+
+        actual = Album.get_album_ids(['existing id', 'new id', 'new id', 'fetched id'], self.session, {
+            'fetched id': spotify_album('fetched id', 'fetched album')
+        })
+        mock_spotify.get_albums.assert_called_once_with(['new id'])
+        self.session.commit()
+        by_spotify_id = {a.spotify_id: a for a in self.session.query(AlbumModel)}
+        assert actual == {k: a.id for k, a in by_spotify_id.items()}
+        assert actual['existing id'] == existing.id
+        assert by_spotify_id['fetched id'].name == 'fetched album'
+        assert self.session.query(AlbumGenre).count() == 4
+        assert Album.get_album_ids([], self.session) == {}
 
-        engine = create_engine('sqlite://')
-        create_all(engine)
-        s = Session(bind=engine)
-        Album._create(s, 'test_id')
+    @patch('scrobbledownload.services.album.Spotify')
+    def test_get_album_ids_race(self, mock_spotify):
+        # Someone else creates the album while we're fetching it from Spotify
+        def get_albums(ids):
+            with self.engine.begin() as conn:
+                conn.execute(AlbumModel.__table__.insert(), [{'name': 'theirs', 'spotify_id': 'new id'}])
+            return [spotify_album('new id')]
 
-        cxn = engine.raw_connection()
-        curs = cxn.cursor()
-        results = curs.execute("select * from albums").fetchall()
-        assert results[0] == (1, 'test album', 'testid', '2019-02-05', 99)
\ No newline at end of file
+        mock_spotify.get_albums.side_effect = get_albums
+        actual = Album.get_album_ids(['new id'], self.session)
+        self.session.commit()
+        assert self.session.query(AlbumModel).one().id == actual['new id']
+        assert self.session.query(AlbumGenre).count() == 0
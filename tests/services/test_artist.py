@@ -1,70 +1,70 @@
 from unittest import TestCase
-from unittest.mock import MagicMock, patch
+from unittest.mock import patch
 from scrobbledownload.services.artist import Artist
-from scrobbledownload.models import Artist as ArtistModel
+from scrobbledownload.models import Artist as ArtistModel, ArtistGenre
 from scrobbledownload.models import create_all
 from scrobbledownload.models.spotify_models import SpotifyArtist
-from datetime import date
 from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 
 
-class TestArtist(TestCase):
-    @patch('scrobbledownload.services.artist.get_session')
-    def test_get_artist_exists(self, mock_get_session):
-        session = MagicMock()
-        mock_get_session.return_value = session
-        expected = ArtistModel(
-            name='test artist',
-            spotify_id='test id',
-            popularity=19)
+def spotify_artist(spotify_id, name='new artist'):
+    return SpotifyArtist(name=name, spotify_id=spotify_id, genres=['genre1', 'genre2'], popularity=99)
 
-        # Mock the return of the SQLAlchemy query for unit tests.
-        session.query.return_value.filter_by.return_value.first.return_value = expected
-        actual = Artist.get_artist('test_id')
-        assert actual == expected
 
-    @patch.object(Artist, '_create')
-    @patch('scrobbledownload.services.artist.get_session')
-    def test_get_artist_doesnt_exist(self, mock_get_session, mock_create):
-        session = MagicMock()
-        mock_get_session.return_value = session
-        session.query.return_value.filter_by.return_value.first.return_value = False
+class TestArtist(TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        create_all(self.engine)
+        self.session = Session(bind=self.engine)
 
-        actual = Artist.get_artist('test_id')
-        mock_create.assert_called()
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
 
     @patch('scrobbledownload.services.artist.Spotify')
-    def test_create(self, mock_spotify):
-        session = MagicMock()
-        mock_spotify.get_artist.return_value = SpotifyArtist(
-            name='test artist',
-            spotify_id='testid',
-            genres=['genre1', 'genre2'],
-            popularity=99
-        )
+    def test_get_artist(self, mock_spotify):
+        mock_spotify.get_artists.return_value = [spotify_artist('testid', 'test artist')]
+
+        actual = Artist.get_artist('testid', self.session)
+        mock_spotify.get_artists.assert_called_once_with(['testid'])
+        assert (actual.name, actual.popularity, actual.spotify_id) == ('test artist', 99, 'testid')
+        assert sorted(g.genre for g in actual.genres) == ['genre1', 'genre2']
 
-        Artist._create(session, 'test_id')
-        mock_spotify.get_artist.assert_called_with('test_id')
-        added_model = session.add.call_args[0][0]
-        assert added_model.name == 'test artist'
-        session.commit.assert_called()
+        # The second time, it's already there
+        mock_spotify.reset_mock()
+        assert Artist.get_artist('testid', self.session).id == actual.id
+        mock_spotify.get_artists.assert_not_called()
 
     @patch('scrobbledownload.services.artist.Spotify')
-    def test_create_with_backend(self, mock_spotify):
-        mock_spotify.get_artist.return_value = SpotifyArtist(
-            name='test artist',
-            spotify_id='testid',
-            genres=['genre1', 'genre2'],
-            popularity=99
-        )
+    def test_get_artist_ids(self, mock_spotify):
+        mock_spotify.get_artists.return_value = [spotify_artist('new id')]
+        existing = ArtistModel(name='existing artist', spotify_id='existing id')
+        self.session.add(existing)
+        self.session.commit()
 
-        engine = create_engine('sqlite://')
-        create_all(engine)
-        s = Session(bind=engine)
-        Artist._create(s, 'test_id')
+        actual = Artist.get_artist_ids(['existing id', 'new id', 'new id', 'fetched id'], self.session, {
+            'fetched id': spotify_artist('fetched id', 'fetched artist')
+        })
+        mock_spotify.get_artists.assert_called_once_with(['new id'])
+        self.session.commit()
+        by_spotify_id = {a.spotify_id: a for a in self.session.query(ArtistModel)}
+        assert actual == {k: a.id for k, a in by_spotify_id.items()}
+        assert actual['existing id'] == existing.id
+        assert by_spotify_id['fetched id'].name == 'fetched artist'
+        assert self.session.query(ArtistGenre).count() == 4
+        assert Artist.get_artist_ids([], self.session) == {}
+
+    @patch('scrobbledownload.services.artist.Spotify')
+    def test_get_artist_ids_race(self, mock_spotify):
+        # Someone else creates the artist while we're fetching it from Spotify
+        def get_artists(ids):
+            with self.engine.begin() as conn:
+                conn.execute(ArtistModel.__table__.insert(), [{'name': 'theirs', 'spotify_id': 'new id'}])
+            return [spotify_artist('new id')]
 
-        cxn = engine.raw_connection()
-        curs = cxn.cursor()
-        results = curs.execute("select * from artists").fetchall()
-        assert results[0] == (1, 'test artist', 99, 'testid')
\ No newline at end of file
+        mock_spotify.get_artists.side_effect = get_artists
+        actual = Artist.get_artist_ids(['new id'], self.session)
+        self.session.commit()
+        assert self.session.query(ArtistModel).one().id == actual['new id']
+        assert self.session.query(ArtistGenre).count() == 0
@@ -1,8 +1,10 @@
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from scrobbledownload.services import LastFM
+from scrobbledownload.services.lastfm import LastFMEmptyPageException
 from scrobbledownload.models.scrobbles import Scrobbles, ScrobbleTrack
 import datetime
+import requests
 
 # This is a sample scrobble downloaded from
 # http://ws.audioscrobbler.com/2.0/?method=user.getrecenttracks&user=rj&api_key=YOUR KEY&format=json&limit=1
@@ -48,9 +50,9 @@ class TestLastFm(TestCase):
     @patch.object(LastFM, '_handle_lastfm_response')
     @patch('scrobbledownload.services.lastfm.requests')
     def test_download_scrobbles(self, mock_requests, mock_handle):
-        response = MagicMock()
-        mock_requests.get.return_value = response
-        response.json.return_value = [{'test': 'thing'}]
+        response = MagicMock(status_code=200)
+        mock_requests.Session.return_value.get.return_value = response
+        response.content = b'[{"test": "thing"}]'
         track = ScrobbleTrack(
             track_name='test track',
             track_mbid='test mbid',
@@ -71,6 +73,7 @@ class TestLastFm(TestCase):
         l = LastFM('test_user', 'test_key')
         actual = l.download_scrobbles(1, 10)
         assert actual == scrobbles
+        mock_handle.assert_called_with([{'test': 'thing'}])
 
     @patch.object(LastFM, '_get_tracks')
     def test_handle_lastfm_response(self, mock_get_tracks):
@@ -110,4 +113,171 @@ class TestLastFm(TestCase):
 
         tracks[0]['@attr'] = {'nowplaying': True}
         actual = LastFM._get_tracks(tracks)
-        assert actual == []
\ No newline at end of file
+        assert actual == []
+        assert not hasattr(expected, '__dict__')
+
+    @patch.object(LastFM, 'download_scrobbles')
+    def test_download_pages(self, mock_download):
+        track = ScrobbleTrack(
+            track_name='test track',
+            track_mbid='test mbid',
+            listen_dt=datetime.datetime(2019, 2, 3, 4, 5, 6),
+            artist='test artist',
+            artist_mbid='artist mbd',
+            album='test album',
+            album_mbid='album mbid'
+        )
+        mock_download.side_effect = lambda page, per_page, from_dt, to_dt: Scrobbles(
+            page=page, perPage=per_page, totalPages=5, tracks=[track]
+        )
+
+        l = LastFM('test_user', 'test_key')
+        actual = [s.page for s in l.download_pages(10, concurrency=3)]
+        assert actual == [1, 2, 3, 4, 5]
+        assert mock_download.call_count == 5
+
+        # Resuming from a page
+        mock_download.reset_mock()
+        actual = [s.page for s in l.download_pages(10, concurrency=3, start_page=4)]
+        assert actual == [4, 5]
+        assert mock_download.call_count == 2
+
+    @patch.object(LastFM, 'download_scrobbles')
+    def test_first_scrobble_dt(self, mock_download):
+        def fake_download(page, per_page, from_dt=None, to_dt=None):
+            listen_dt = datetime.datetime(2019, 2, 3) - datetime.timedelta(days=page)
+            track = ScrobbleTrack('test track', '', listen_dt, 'test artist', '', 'test album', '')
+            return Scrobbles(page=page, perPage=per_page, totalPages=7, tracks=[track])
+
+        mock_download.side_effect = fake_download
+        l = LastFM('test_user', 'test_key')
+        assert l.first_scrobble_dt() == datetime.datetime(2019, 1, 27)
+        assert [c[0][0] for c in mock_download.call_args_list] == [1, 7]
+
+        mock_download.side_effect = None
+        mock_download.return_value = Scrobbles(page=1, perPage=1, totalPages=0, tracks=[])
+        assert l.first_scrobble_dt() is None
+
+    @patch.object(LastFM, 'download_scrobbles')
+    def test_download_pages_stops_early(self, mock_download):
+        mock_download.side_effect = lambda page, per_page, from_dt, to_dt: Scrobbles(
+            page=page, perPage=per_page, totalPages=100, tracks=['track']
+        )
+
+        l = LastFM('test_user', 'test_key')
+        pages = l.download_pages(10, concurrency=2)
+        assert next(pages).page == 1
+        assert next(pages).page == 2
+        pages.close()
+        # Page 1, then at most two pages in flight, plus the one queued when page 2 was handed out
+        assert mock_download.call_count <= 4
+
+    @patch('scrobbledownload.services.lastfm.time.sleep')
+    @patch.object(LastFM, 'download_scrobbles')
+    def test_download_pages_empty_page(self, mock_download, mock_sleep):
+        empty = {3: 1}
+
+        def fake_download(page, per_page, from_dt, to_dt):
+            # Page 3 comes back empty the first time
+            if empty.get(page):
+                empty[page] -= 1
+                return Scrobbles(page=page, perPage=per_page, totalPages=4, tracks=[])
+            return Scrobbles(page=page, perPage=per_page, totalPages=4, tracks=['track'])
+
+        mock_download.side_effect = fake_download
+        l = LastFM('test_user', 'test_key', max_retries=2)
+        assert [s.page for s in l.download_pages(10, concurrency=2)] == [1, 2, 3, 4]
+        assert mock_download.call_count == 5
+
+        # One that stays empty is an error, so the window isn't taken to be done
+        empty[3] = 3
+        with self.assertRaises(LastFMEmptyPageException):
+            list(l.download_pages(10, concurrency=2))
+
+    @patch.object(LastFM, 'download_scrobbles')
+    def test_download_pages_single_page(self, mock_download):
+        mock_download.return_value = Scrobbles(page=1, perPage=10, totalPages=1, tracks=[])
+
+        l = LastFM('test_user', 'test_key')
+        assert len(list(l.download_pages(10, concurrency=4))) == 1
+        mock_download.assert_called_once_with(1, 10, None, None)
+
+    @patch.object(LastFM, '_handle_lastfm_response')
+    @patch('scrobbledownload.services.lastfm.requests')
+    def test_download_scrobbles_window(self, mock_requests, mock_handle):
+        mock_requests.Session.return_value.get.return_value = MagicMock(status_code=200, content=b"{}")
+        mock_handle.return_value = Scrobbles(page=1, perPage=10, totalPages=1, tracks=[])
+
+        l = LastFM('test_user', 'test_key')
+        l.download_scrobbles(1, 10)
+        url = mock_requests.Session.return_value.get.call_args[0][0]
+        assert '&from=' not in url
+        assert '&to=' not in url
+
+        l.download_scrobbles(
+            1, 10, from_dt=datetime.datetime(2020, 2, 16, 17, 17, 32), to_dt=datetime.datetime(2020, 2, 17)
+        )
+        url = mock_requests.Session.return_value.get.call_args[0][0]
+        assert url.endswith('&page=1&from=1581873452&to=1581897600')
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(str(self.status_code))
+
+    def json(self):
+        return sample_scrobble_response
+
+
+class TestLastFmRetries(TestCase):
+    @patch('scrobbledownload.services.lastfm.time.sleep')
+    def test_retries(self, mock_sleep):
+        l = LastFM('test_user', 'test_key', max_retries=3, backoff=1)
+        l._session = MagicMock()
+        l._session.get.side_effect = [
+            requests.ConnectionError('reset'),
+            FakeResponse(503),
+            FakeResponse(429, {'Retry-After': '7'}),
+            FakeResponse(200),
+        ]
+        actual = l._get('url', 1)
+        assert actual.status_code == 200
+        assert l._session.get.call_count == 4
+        delays = [c[0][0] for c in mock_sleep.call_args_list]
+        assert 0 <= delays[0] <= 1
+        assert 0 <= delays[1] <= 2
+        assert delays[2] == 7
+        l._session.get.assert_called_with('url', timeout=(5, 30))
+
+    @patch('scrobbledownload.services.lastfm.time.sleep')
+    def test_retry_after_clamped(self, mock_sleep):
+        l = LastFM('test_user', 'test_key', max_backoff=30)
+        l._session = MagicMock()
+        l._session.get.side_effect = [FakeResponse(429, {'Retry-After': '86400'}), FakeResponse(200)]
+        assert l._get('url', 1).status_code == 200
+        mock_sleep.assert_called_once_with(30)
+
+    @patch('scrobbledownload.services.lastfm.time.sleep')
+    def test_gives_up(self, mock_sleep):
+        l = LastFM('test_user', 'test_key', max_retries=2)
+        l._session = MagicMock()
+        l._session.get.return_value = FakeResponse(502)
+        with self.assertRaises(requests.HTTPError):
+            l._get('url', 1)
+        assert l._session.get.call_count == 3
+
+        l._session.get.return_value = FakeResponse(404)
+        l._session.get.reset_mock()
+        with self.assertRaises(requests.HTTPError):
+            l._get('url', 1)
+        assert l._session.get.call_count == 1
+
+    def test_session(self):
+        l = LastFM('test_user', 'test_key', pool_size=8)
+        assert l._session.get_adapter('http://ws.audioscrobbler.com')._pool_maxsize == 8
+        assert 'gzip' in l._session.headers['Accept-Encoding']
@@ -1,5 +1,7 @@
+import os
 from unittest import TestCase
 from unittest.mock import MagicMock, patch, mock_open, call
+from scrobbledownload.cache import PersistentCache
 from scrobbledownload.services.spotify import Spotify, SpotifyNotFoundExcecption
 from scrobbledownload.models.spotify_models import SpotifyArtist, SpotifyAlbum, SpotifyTrack
 
@@ -7,7 +9,12 @@ from collections import namedtuple
 
 Case = namedtuple('Case', ['input', 'expected'])
 
+REPLACEMENTS_FILE = os.path.join(os.path.dirname(__file__), '..', '..', 'edge_case_replacements.json')
+
 class TestSpotify(TestCase):
+    def setUp(self):
+        Spotify._search_cache.clear()
+
     @patch('scrobbledownload.services.spotify.os')
     @patch('builtins.open')
     def test_set_replacements(self, m_open, mock_os):
@@ -98,6 +105,53 @@ class TestSpotify(TestCase):
         _spotify_api_mock.album.assert_called_with(album_id)
         Spotify._spotify_api = None
 
+    def test_get_artists(self):
+        _spotify_api_mock = MagicMock()
+        artist_ids = [str(i) for i in range(120)]
+        _spotify_api_mock.artists.side_effect = lambda ids: {
+            'artists': [{'id': i, 'name': f'name {i}', 'genres': [], 'popularity': 1} for i in ids]
+        }
+        Spotify._spotify_api = _spotify_api_mock
+        actual = Spotify.get_artists(artist_ids + ['1'])
+        assert [a.spotify_id for a in actual] == artist_ids
+        assert [len(c[0][0]) for c in _spotify_api_mock.artists.call_args_list] == [50, 50, 20]
+        Spotify._spotify_api = None
+
+    def test_get_albums(self):
+        _spotify_api_mock = MagicMock()
+        _spotify_api_mock.albums.side_effect = lambda ids: {
+            'albums': [
+                {
+                    'id': i,
+                    'name': f'name {i}',
+                    'release_date': '2019',
+                    'release_date_precision': 'year',
+                    'genres': [],
+                    'popularity': 1
+                } if i != 'unknown' else None
+                for i in ids
+            ]
+        }
+        Spotify._spotify_api = _spotify_api_mock
+        Spotify.set_response_cache(PersistentCache(':memory:'))
+        Spotify._response_cache.set('album', 'cached', {
+            'id': 'cached',
+            'name': 'cached album',
+            'release_date': '2019',
+            'release_date_precision': 'year',
+            'genres': [],
+            'popularity': 1
+        })
+
+        actual = Spotify.get_albums(['cached', 'unknown'] + [str(i) for i in range(25)])
+        assert len(actual) == 26
+        assert actual[0].name == 'cached album'
+        assert [len(c[0][0]) for c in _spotify_api_mock.albums.call_args_list] == [20, 6]
+        assert Spotify._response_cache.get('album', '24') is not None
+
+        Spotify.set_response_cache(None)
+        Spotify._spotify_api = None
+
     def test_handle_replacements(self):
         test_replacements = {
             'in': 'out',
@@ -133,7 +187,8 @@ class TestSpotify(TestCase):
                         'duration_ms': 12345,
                         'popularity': 12,
                         'album': {
-                            'id': "test_album_id"
+                            'id': "test_album_id",
+                            'name': "testalbum"
                         },
                         'artists': [
                             {
@@ -151,7 +206,9 @@ class TestSpotify(TestCase):
             duration_ms=12345,
             popularity=12,
             album_id='test_album_id',
-            artist_id='test_artist_id'
+            artist_id='test_artist_id',
+            artist_name='testartist',
+            album_name='testalbum',
         )]
         assert expected == Spotify._handle_spotify_track_response(test_response)
 
@@ -160,28 +217,119 @@ class TestSpotify(TestCase):
         _spotify_api_mock = MagicMock()
         Spotify._spotify_api = _spotify_api_mock
         expected_search_string = 'test_name artist:test_artist'
-        Spotify._make_track_query('test_name', 'test_artist')
-        _spotify_api_mock.search.assert_called_with(q=expected_search_string, type='track')
+        Spotify._make_track_query(expected_search_string)
+        _spotify_api_mock.search.assert_called_with(q=expected_search_string, limit=50, type='track')
         mock_respones_handler.assert_called()
         Spotify._spotify_api = None
 
+    def test__make_track_query_cached(self):
+        _spotify_api_mock = MagicMock()
+        _spotify_api_mock.search.return_value = {'tracks': {'items': []}}
+        Spotify._spotify_api = _spotify_api_mock
+
+        assert Spotify._make_track_query('Test  Name artist:test artist') == []
+        assert Spotify._make_track_query('test name artist:Test Artist') == []
+        _spotify_api_mock.search.assert_called_once()
+        assert Spotify.search_cache_stats() == {'hits': 1, 'misses': 1, 'size': 1}
+
+        Spotify._make_track_query('other name artist:test artist')
+        assert _spotify_api_mock.search.call_count == 2
+        Spotify._spotify_api = None
+
+    def test_get_artist_response_cache(self):
+        _spotify_api_mock = MagicMock()
+        _spotify_api_mock.artist.return_value = {'name': 'name', 'genres': ['genre1'], 'popularity': 12}
+        Spotify._spotify_api = _spotify_api_mock
+        Spotify.set_response_cache(PersistentCache(':memory:'))
+
+        first = Spotify.get_artist('1234')
+        second = Spotify.get_artist('1234')
+        assert first == second
+        _spotify_api_mock.artist.assert_called_once_with('1234')
+
+        Spotify.set_response_cache(None)
+        Spotify._spotify_api = None
+
+    def test_track_queries(self):
+        Spotify._replacements = {}
+        test_cases = [
+            Case(('Dreams', 'Fleetwood Mac'), ['Dreams artist:Fleetwood Mac', 'Dreams Fleetwood Mac']),
+            Case(
+                ('Go Your Own Way - 2004 Remaster', 'Fleetwood Mac'),
+                [
+                    'Go Your Own Way artist:Fleetwood Mac',
+                    'Go Your Own Way 2004 Remaster artist:Fleetwood Mac',
+                    'Go Your Own Way Fleetwood Mac',
+                ],
+            ),
+            Case(
+                ('Old Town Road (feat. Billy Ray Cyrus) [Remix]', 'Lil Nas X feat. Billy Ray Cyrus'),
+                [
+                    'Old Town Road Remix artist:Lil Nas X',
+                    'Old Town Road feat Billy Ray Cyrus Remix artist:Lil Nas X',
+                    'Old Town Road Remix Lil Nas X',
+                ],
+            ),
+        ]
+        for case in test_cases:
+            with self.subTest(input=case.input, expected=case.expected):
+                assert list(Spotify._track_queries(*case.input)) == case.expected
+
     @patch.object(Spotify, '_make_track_query')
     def test_get_track(self, mock_make_track_query):
         mock_make_track_query.return_value = []
         Spotify._replacements = {}
 
         with self.assertRaises(SpotifyNotFoundExcecption) as ctx:
-            Spotify.get_track('this is a long track name', 'test artist')
-        expected_calls = [
-            call('this is a long track name', 'test artist'),
-            call('is a long track name', 'test artist'),
-            call('a long track name', 'test artist'),
-            call('long track name', 'test artist'),
-            call('track name', 'test artist'),
-            call('name', 'test artist'),
+            Spotify.get_track('this is a long track name (Remastered 2011)', 'test artist')
+        # A bounded number of searches, however long the name
+        assert mock_make_track_query.mock_calls == [
+            call('this is a long track name artist:test artist'),
+            call('this is a long track name Remastered 2011 artist:test artist'),
+            call('this is a long track name test artist'),
         ]
-        mock_make_track_query.assert_has_calls(expected_calls)
-        assert call('', 'test artist') not in mock_make_track_query.mock_calls
 
-        mock_make_track_query.return_value = ['thing']
-        assert Spotify.get_track('name', 'artist') == 'thing'
\ No newline at end of file
+        wrong = SpotifyTrack('Another Song', 'wrong id', 1000, 1, 'album id', 'artist id', 'Artist', 'Album')
+        right = SpotifyTrack('Song - Remastered', 'right id', 1000, 1, 'album id', 'artist id', 'Artist', 'Album')
+        mock_make_track_query.return_value = [wrong, right]
+        assert Spotify.get_track('Song', 'artist') == right
+
+    @patch.object(Spotify, '_make_track_query')
+    def test_get_track_replaced_artist(self, mock_make_track_query):
+        Spotify.set_replacements(REPLACEMENTS_FILE)
+        ocean = SpotifyTrack('Ocean', 'ocean id', 1000, 1, 'album id', 'artist id', 'Pageninetynine', 'Document #8')
+        mock_make_track_query.return_value = [ocean]
+
+        # Spotify knows them by the replacement we searched with, not the name Last.fm has
+        assert Spotify.get_track('Ocean', 'Pg99') == ocean
+        mock_make_track_query.assert_called_once_with('Ocean artist:Pageninetynine')
+        Spotify._replacements = {}
+
+    @patch('scrobbledownload.services.spotify.metrics')
+    @patch.object(Spotify, '_make_track_query')
+    def test_get_track_metrics(self, mock_make_track_query, mock_metrics):
+        found = SpotifyTrack('a long name', 'id', 1000, 1, 'album id', 'artist id', 'Artist', 'Album')
+        mock_make_track_query.side_effect = [[], [], [found]]
+        Spotify._replacements = {}
+
+        assert Spotify.get_track('a long name (live)', 'artist') == found
+        mock_metrics.incr.assert_has_calls(
+            [
+                call('spotify.search.tracks'),
+                call('spotify.search.attempts', 3),
+                call('spotify.search.fallbacks', 2),
+            ]
+        )
+
+        mock_metrics.reset_mock()
+        mock_make_track_query.side_effect = None
+        mock_make_track_query.return_value = []
+        with self.assertRaises(SpotifyNotFoundExcecption):
+            Spotify.get_track('name', 'artist')
+        mock_metrics.incr.assert_has_calls(
+            [
+                call('spotify.search.tracks'),
+                call('spotify.search.attempts', 2),
+                call('spotify.search.not_found'),
+            ]
+        )
@@ -0,0 +1,138 @@
+import asyncio
+from unittest import TestCase, skipIf
+from scrobbledownload.services.spotify import Spotify, SpotifyNotFoundExcecption
+from scrobbledownload.services.spotify_async import AsyncSpotify, TokenBucket, httpx
+from scrobbledownload.models.spotify_models import SpotifyTrack
+
+
+def search_response(*names):
+    return {
+        'tracks': {
+            'items': [
+                {
+                    'name': name,
+                    'id': f'{name} id',
+                    'duration_ms': 1000,
+                    'popularity': 1,
+                    'album': {'id': 'album id'},
+                    'artists': [{'name': 'artist', 'id': 'artist id'}],
+                }
+                for name in names
+            ]
+        }
+    }
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(TestCase):
+    def test_wait_time(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, capacity=2, clock=clock)
+        assert bucket._wait_time() == 0
+        assert bucket._wait_time() == 0
+        assert bucket._wait_time() == 0.5
+
+        clock.now = 0.5
+        assert bucket._wait_time() == 0
+
+        bucket.pause(3)
+        assert bucket._wait_time() == 3
+        clock.now = 4
+        assert bucket._wait_time() == 0
+
+
+@skipIf(httpx is None, 'httpx is not installed')
+class TestAsyncSpotify(TestCase):
+    def setUp(self):
+        Spotify._search_cache.clear()
+        Spotify._replacements = {}
+        self.requests = []
+
+    def make_client(self, handler):
+        def record(request):
+            self.requests.append(request)
+            if request.url.path == '/api/token':
+                return httpx.Response(200, json={'access_token': 'token', 'expires_in': 3600})
+            return handler(request)
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(record))
+        return AsyncSpotify('id', 'secret', TokenBucket(1000), client=client)
+
+    def test_get_track(self):
+        def handler(request):
+            q = request.url.params['q']
+            if q == 'long name live artist:artist':
+                return httpx.Response(200, json=search_response('other name', 'Long Name - Live'))
+            return httpx.Response(200, json=search_response())
+
+        spotify = self.make_client(handler)
+        actual = asyncio.run(spotify.get_track('long name (live)', 'artist'))
+        assert actual == SpotifyTrack(
+            name='Long Name - Live',
+            spotify_id='Long Name - Live id',
+            duration_ms=1000,
+            popularity=1,
+            album_id='album id',
+            artist_id='artist id',
+            artist_name='artist',
+        )
+        search_requests = [r for r in self.requests if r.url.path == '/v1/search']
+        searches = [r.url.params['q'] for r in search_requests]
+        assert searches == ['long name artist:artist', 'long name live artist:artist']
+        assert all(r.url.params['limit'] == '50' for r in search_requests)
+        assert all(r.headers['Authorization'] == 'Bearer token' for r in search_requests)
+
+        with self.assertRaises(SpotifyNotFoundExcecption):
+            asyncio.run(spotify.get_track('nothing', 'artist'))
+
+    def test_retry_after(self):
+        responses = [
+            httpx.Response(429, headers={'Retry-After': '0'}),
+            httpx.Response(503),
+            httpx.Response(200, json=search_response('name')),
+        ]
+        spotify = self.make_client(lambda request: responses.pop(0))
+        actual = asyncio.run(spotify.make_track_query('name artist:artist'))
+        assert actual[0].name == 'name'
+        assert len([r for r in self.requests if r.url.path == '/v1/search']) == 3
+        assert len([r for r in self.requests if r.url.path == '/api/token']) == 1
+
+    def test_retry_errors(self):
+        responses = [
+            httpx.ConnectError('connection dropped'),
+            httpx.ReadTimeout('timed out'),
+            httpx.Response(200, json=search_response('name')),
+        ]
+
+        def handler(request):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        spotify = self.make_client(handler)
+        actual = asyncio.run(spotify.make_track_query('name artist:artist'))
+        assert actual[0].name == 'name'
+        assert len([r for r in self.requests if r.url.path == '/v1/search']) == 3
+
+    def test_retries_run_out(self):
+        spotify = self.make_client(lambda request: httpx.Response(429, headers={'Retry-After': '0'}))
+        spotify._max_retries = 2
+        with self.assertRaises(httpx.HTTPStatusError):
+            asyncio.run(spotify.make_track_query('name artist:artist'))
+        assert len([r for r in self.requests if r.url.path == '/v1/search']) == 3
+
+        def dropped(request):
+            raise httpx.ConnectError('connection dropped')
+
+        spotify = self.make_client(dropped)
+        spotify._max_retries = 1
+        with self.assertRaises(httpx.ConnectError):
+            asyncio.run(spotify.make_track_query('other artist:artist'))
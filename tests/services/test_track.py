@@ -0,0 +1,51 @@
+from unittest import TestCase
+from scrobbledownload.services.track import Track, TrackIndex
+from scrobbledownload.models import Track as TrackModel
+from scrobbledownload.models import create_all
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+
+
+class TestTrackIndex(TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        create_all(self.engine)
+        self.session = Session(bind=self.engine)
+        self.session.add_all([
+            TrackModel(name='one', generated_id=Track.generate_id('one', 'artist', 'album')),
+            TrackModel(name='two', generated_id=Track.generate_id('two', 'artist', 'album')),
+        ])
+        self.session.commit()
+        self.queries = []
+        event.listen(self.engine, 'before_cursor_execute', lambda *args: self.queries.append(args[2]))
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def test_generate_id(self):
+        t = Track(None, 'one', 'artist', 'album', '')
+        assert t.hash == Track.generate_id('one', 'artist', 'album')
+
+    def test_load(self):
+        index = TrackIndex.load(self.session)
+        assert len(index) == 2
+        self.queries.clear()
+
+        one = Track.generate_id('one', 'artist', 'album')
+        actual = index.resolve([one, 'unknown'], self.session)
+        assert actual == {one: 1}
+        assert self.queries == []
+
+        index.add('unknown', 3)
+        assert index.resolve(['unknown'], self.session) == {'unknown': 3}
+
+    def test_resolve_lazily(self):
+        index = TrackIndex()
+        one = Track.generate_id('one', 'artist', 'album')
+        two = Track.generate_id('two', 'artist', 'album')
+
+        assert index.resolve([one, two, 'unknown'], self.session) == {one: 1, two: 2}
+        assert len(self.queries) == 1
+        assert index.resolve([one, two], self.session) == {one: 1, two: 2}
+        assert len(self.queries) == 1
@@ -0,0 +1,174 @@
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from scrobbledownload import backfill, metrics
+from scrobbledownload.models import Listen, SyncState, Track, create_all
+from scrobbledownload.models.scrobbles import Scrobbles, ScrobbleTrack
+from scrobbledownload.models.spotify_models import SpotifyAlbum, SpotifyArtist, SpotifyTrack
+
+
+def scrobble(name, dt):
+    return ScrobbleTrack(name, '', dt, 'test artist', '', 'test album', '')
+
+
+def fake_get_track(track_name, track_artist, track_album=None):
+    return SpotifyTrack(track_name, f'{track_name} id', 1000, 1, 'album id', 'artist id')
+
+
+class TestRanges(TestCase):
+    def test_split_range(self):
+        ranges = backfill.split_range(datetime(2020, 1, 1), datetime(2020, 1, 4), 3)
+        assert ranges == [
+            (datetime(2020, 1, 1), datetime(2020, 1, 2)),
+            (datetime(2020, 1, 2), datetime(2020, 1, 3)),
+            (datetime(2020, 1, 3), datetime(2020, 1, 4)),
+        ]
+        # Never split finer than a second
+        assert len(backfill.split_range(datetime(2020, 1, 1), datetime(2020, 1, 1, 0, 0, 2), 10)) == 2
+
+    def test_subtract_ranges(self):
+        day = lambda d: datetime(2020, 1, d)  # noqa: E731
+        ranges = [(day(1), day(10)), (day(10), day(20))]
+        covered = [(day(12), day(30)), (day(3), day(5))]
+        assert backfill.subtract_ranges(ranges, covered) == [(day(1), day(3)), (day(5), day(10)), (day(10), day(12))]
+        assert backfill.subtract_ranges(ranges, [(datetime.min, day(25))]) == []
+
+
+class TestBackfill(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.dir.name, 'scrobbles.sqlite')}")
+        create_all(self.engine)
+        self.session = Session(bind=self.engine)
+        self.worker_session = Session(bind=self.engine)
+
+    def tearDown(self):
+        self.session.close()
+        self.worker_session.close()
+        self.engine.dispose()
+        self.dir.cleanup()
+
+    def test_plan_windows(self):
+        self.session.add(Listen(dt=datetime(2020, 1, 20)))
+        self.session.add(
+            SyncState(kind='gap', from_dt=datetime(2020, 1, 4), to_dt=datetime(2020, 1, 6), completed_at=datetime.now())
+        )
+        self.session.commit()
+
+        states = backfill.plan_windows(self.session, datetime(2020, 1, 1), datetime(2020, 2, 1), 2)
+        # Only up to the oldest listen, and around the gap that's been checked
+        assert [(s.kind, s.from_dt, s.to_dt) for s in states] == [
+            ('backfill', datetime(2019, 12, 31, 23, 59, 59), datetime(2020, 1, 4, 0, 0, 1)),
+            ('backfill', datetime(2020, 1, 5, 23, 59, 59), datetime(2020, 1, 10, 12)),
+            ('backfill', datetime(2020, 1, 10, 11, 59, 59), datetime(2020, 1, 20)),
+        ]
+        # Planning again just resumes them, as they're unfinished
+        assert backfill.plan_windows(self.session, datetime(2020, 1, 1), datetime(2020, 2, 1), 2) == states
+
+    @patch('scrobbledownload.download.Spotify')
+    @patch('scrobbledownload.services.track.Spotify')
+    @patch('scrobbledownload.backfill.Spotify')
+    @patch('scrobbledownload.backfill.Secrets')
+    @patch('scrobbledownload.backfill.database')
+    @patch('scrobbledownload.backfill.LastFM')
+    def test_backfill(self, mock_lastfm, mock_database, mock_secrets, _, mock_track_spotify, mock_spotify):
+        mock_database.get_session.return_value = self.worker_session
+        mock_secrets.return_value = MagicMock(scrobbles_per_page=10)
+        mock_track_spotify.get_track.side_effect = fake_get_track
+        mock_spotify.get_artists.return_value = [SpotifyArtist('test artist', 'artist id', [], 1)]
+        mock_spotify.get_albums.return_value = [SpotifyAlbum('test album', 'album id', '2019-02-05', 'day', [], 1)]
+        self.session.add(Listen(dt=datetime(2020, 1, 10)))
+        self.session.commit()
+
+        # The whole history, newest first - one scrobble is exactly on the boundary between the two windows
+        history = [
+            scrobble('three', datetime(2020, 1, 10)),
+            scrobble('two', datetime(2020, 1, 8)),
+            scrobble('one', datetime(2020, 1, 5, 12)),
+            scrobble('one', datetime(2020, 1, 2)),
+        ]
+        fail = {'window': True}
+
+        def download_pages(per_page, concurrency, from_dt, to_dt, start_page):
+            if fail['window'] and to_dt == datetime(2020, 1, 5, 12):
+                raise ConnectionError('Last.fm went away')
+            tracks = [s for s in history if from_dt < s.listen_dt < to_dt]
+            return iter([Scrobbles(page=1, perPage=per_page, totalPages=1, tracks=tracks)])
+
+        mock_lastfm.return_value.download_pages.side_effect = download_pages
+        mock_lastfm.return_value.first_scrobble_dt.return_value = datetime(2020, 1, 1)
+        settings = backfill.WorkerSettings('secrets.yaml', 'replacements.json')
+
+        failed = backfill.backfill(self.session, mock_lastfm.return_value, settings, workers=1, windows=2)
+        assert len(failed) == 1
+        # In this process, the worker uses the engine that's already there
+        mock_database.create_sessionmaker.assert_not_called()
+        assert sorted(dt for dt, in self.session.query(Listen.dt)) == [
+            datetime(2020, 1, 5, 12),
+            datetime(2020, 1, 8),
+            datetime(2020, 1, 10),
+        ]
+        counters = metrics.snapshot()['counters']
+        assert (counters['backfill.windows'], counters['backfill.windows.failed']) == (1, 1)
+
+        # Running it again resumes the window that failed, and nothing else
+        fail['window'] = False
+        mock_lastfm.return_value.download_pages.reset_mock()
+        assert backfill.backfill(self.session, mock_lastfm.return_value, settings, workers=1, windows=2) == []
+        assert mock_lastfm.return_value.download_pages.call_count == 1
+        assert sorted(dt for dt, in self.session.query(Listen.dt))[0] == datetime(2020, 1, 2)
+        assert self.session.query(Listen).count() == 4
+        assert sorted(t.name for t in self.session.query(Track)) == ['one', 'two']
+        assert SyncState.incomplete(self.session) == []
+
+    @patch('scrobbledownload.download.Spotify')
+    @patch('scrobbledownload.services.track.Spotify')
+    @patch('scrobbledownload.backfill.Spotify')
+    @patch('scrobbledownload.backfill.Secrets')
+    @patch('scrobbledownload.backfill.database')
+    @patch('scrobbledownload.backfill.LastFM')
+    def test_backfill_after_failed_write(
+        self, mock_lastfm, mock_database, mock_secrets, _, mock_track_spotify, mock_spotify
+    ):
+        mock_database.get_session.return_value = self.worker_session
+        mock_secrets.return_value = MagicMock(scrobbles_per_page=10)
+        mock_track_spotify.get_track.side_effect = fake_get_track
+        mock_spotify.get_artists.return_value = [SpotifyArtist('test artist', 'artist id', [], 1)]
+        mock_spotify.get_albums.return_value = [SpotifyAlbum('test album', 'album id', '2019-02-05', 'day', [], 1)]
+        self.session.add(Listen(dt=datetime(2020, 1, 10)))
+        self.session.commit()
+
+        # The same track in both windows, and the first window's write fails after the track's been created
+        history = [scrobble('one', datetime(2020, 1, 8)), scrobble('one', datetime(2020, 1, 2))]
+
+        def download_pages(per_page, concurrency, from_dt, to_dt, start_page):
+            tracks = [s for s in history if from_dt < s.listen_dt < to_dt]
+            return iter([Scrobbles(page=1, perPage=per_page, totalPages=1, tracks=tracks)])
+
+        insert_many = Listen.insert_many
+        writes = []
+
+        def failing_insert_many(listens, session):
+            writes.append(listens)
+            if len(writes) == 1:
+                raise ConnectionError('The database went away')
+            return insert_many(listens, session)
+
+        mock_lastfm.return_value.download_pages.side_effect = download_pages
+        settings = backfill.WorkerSettings('secrets.yaml', 'replacements.json')
+
+        with patch.object(Listen, 'insert_many', side_effect=failing_insert_many):
+            failed = backfill.backfill(
+                self.session, mock_lastfm.return_value, settings, since=datetime(2020, 1, 1), workers=1, windows=2
+            )
+        assert len(failed) == 1
+        # The second window created the track again, rather than trusting the id the rollback took away
+        (track,) = self.session.query(Track).all()
+        (listen,) = self.session.query(Listen).filter(Listen.dt == datetime(2020, 1, 8)).all()
+        assert listen.track_id == track.id
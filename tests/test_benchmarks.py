@@ -0,0 +1,31 @@
+from unittest import TestCase
+
+from benchmarks.bench_download import compare, run
+from benchmarks.fake_apis import FakeAPIs, Recording
+
+
+class TestBenchmarks(TestCase):
+    def test_fake_apis(self):
+        recording = Recording.synthetic(scrobbles=25, per_page=10, distinct_tracks=5, miss_rate=0)
+        apis = FakeAPIs(recording)
+        assert recording.scrobbles == 25
+        assert apis.lastfm({'page': '3'})[1]['recenttracks']['@attr']['totalPages'] == '3'
+        assert apis.lastfm({'page': '4'})[1]['recenttracks']['track'] == []
+
+        status, body = apis.spotify('/v1/search', {'q': 'track 1  artist:Artist 1'})
+        assert body['tracks']['items'][0]['id'] == 'track000001'
+        status, body = apis.spotify('/v1/artists/', {'ids': 'artist00001,nope'})
+        assert [a and a['name'] for a in body['artists']] == ['Artist 1', None]
+        status, body = apis.spotify('/v1/albums/nope', {})
+        assert status == 404
+
+    def test_run(self):
+        recording = Recording.synthetic(scrobbles=250, per_page=100, distinct_tracks=40)
+        result = run(recording, latency=0)
+        assert result['scrobbles'] == 250
+        assert result['lastfm_calls_per_scrobble'] == 3 / 250
+        assert 0 < result['db_round_trips_per_scrobble'] < 1
+
+        assert compare({'db': result}, {'db': result}, 0.2) == []
+        worse = dict(result, api_calls_per_scrobble=result['api_calls_per_scrobble'] * 2)
+        assert len(compare({'db': worse}, {'db': result}, 0.2)) == 1
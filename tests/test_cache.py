@@ -0,0 +1,95 @@
+import os
+import tempfile
+from unittest import TestCase
+from scrobbledownload.cache import LRUCache, PersistentCache
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(TestCase):
+    def test_get_set(self):
+        cache = LRUCache(max_size=10, ttl=10)
+        assert cache.get('key') is None
+        cache.set('key', ['value'])
+        assert cache.get('key') == ['value']
+        assert cache.stats() == {'hits': 1, 'misses': 1, 'size': 1}
+
+    def test_eviction(self):
+        cache = LRUCache(max_size=2, ttl=10)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert len(cache) == 2
+
+    def test_ttl(self):
+        clock = FakeClock()
+        cache = LRUCache(max_size=10, ttl=10, negative_ttl=2, clock=clock)
+        cache.set('found', ['track'])
+        cache.set('not found', [])
+
+        clock.now = 1
+        assert cache.get('found') == ['track']
+        assert cache.get('not found') == []
+
+        clock.now = 5
+        assert cache.get('found') == ['track']
+        assert cache.get('not found') is None
+
+        clock.now = 11
+        assert cache.get('found') is None
+        assert len(cache) == 0
+
+    def test_clear(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.get('a')
+        cache.clear()
+        assert cache.stats() == {'hits': 0, 'misses': 0, 'size': 0}
+
+
+class TestPersistentCache(TestCase):
+    def test_get_set(self):
+        clock = FakeClock()
+        cache = PersistentCache(':memory:', ttls={'artist': 10, 'search_miss': 2}, clock=clock)
+        assert cache.get('artist', 'id') is None
+        cache.set('artist', 'id', {'name': 'test artist', 'genres': ['genre1']})
+        assert cache.get('artist', 'id') == {'name': 'test artist', 'genres': ['genre1']}
+        assert cache.get('album', 'id') is None
+        assert cache.stats() == {'hits': 1, 'misses': 2}
+
+        cache.set('search', 'query', {'tracks': {'items': []}}, ttl_kind='search_miss')
+        clock.now = 5
+        assert cache.get('artist', 'id') is not None
+        assert cache.get('search', 'query') is None
+        assert cache.purge_expired() == 1
+
+        clock.now = 11
+        assert cache.get('artist', 'id') is None
+        cache.close()
+
+    def test_unconfigured_kind_not_cached(self):
+        cache = PersistentCache(':memory:', ttls={'artist': 0})
+        cache.set('artist', 'id', {'name': 'test artist'})
+        assert cache.get('artist', 'id') is None
+        cache.close()
+
+    def test_survives_reopen(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cache.sqlite')
+            cache = PersistentCache(path)
+            cache.set('album', 'id', {'name': 'test album'})
+            cache.close()
+
+            cache = PersistentCache(path)
+            assert cache.get('album', 'id') == {'name': 'test album'}
+            cache.close()
@@ -0,0 +1,50 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy.pool import QueuePool
+
+from scrobbledownload import database
+from scrobbledownload.models import Listen
+
+
+class TestDatabase(TestCase):
+    def tearDown(self):
+        database.dispose()
+
+    def test_build_engine(self):
+        with tempfile.TemporaryDirectory() as d:
+            engine = database.build_engine(f"sqlite:///{os.path.join(d, 'db.sqlite')}", {'pool_size': 3})
+            assert isinstance(engine.pool, QueuePool)
+            assert (engine.pool.size(), engine.pool._max_overflow, engine.pool._pre_ping) == (3, 10, True)
+            engine.dispose()
+
+        # An in-memory database can't be sized, but still gets the rest
+        engine = database.build_engine('sqlite://')
+        assert engine.pool._pre_ping
+        engine.dispose()
+
+    @patch('scrobbledownload.database.create_engine')
+    def test_build_engine_psycopg2(self, mock_create_engine):
+        database.build_engine('postgresql+psycopg2://user@host/db')
+        assert mock_create_engine.call_args[1]['executemany_mode'] == 'values_plus_batch'
+        database.build_engine('postgresql+psycopg://user@host/db')
+        assert 'executemany_mode' not in mock_create_engine.call_args[1]
+
+    def test_lifecycle(self):
+        database.dispose()
+        with self.assertRaises(RuntimeError):
+            database.get_session()
+
+        session = database.create_sql_session('sqlite://')
+        first = database.get_engine()
+        assert session.query(Listen).count() == 0
+        session.close()
+
+        # Setting up again replaces the engine
+        database.create_sessionmaker('sqlite://')
+        assert database.get_engine() is not first
+        database.dispose()
+        with self.assertRaises(RuntimeError):
+            database.get_engine()
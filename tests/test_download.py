@@ -0,0 +1,278 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from scrobbledownload import download, metrics
+from scrobbledownload.enrichment import SyncEnrichmentEngine
+from scrobbledownload.models import create_all, Listen, SyncState, Track, UnfoundTracks
+from scrobbledownload.models.scrobbles import Scrobbles, ScrobbleTrack
+from scrobbledownload.models.spotify_models import SpotifyAlbum, SpotifyArtist, SpotifyTrack
+from scrobbledownload.services.spotify import SpotifyNotFoundExcecption
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+
+def scrobble(name, minute):
+    return ScrobbleTrack(
+        track_name=name,
+        track_mbid='',
+        listen_dt=datetime(2020, 2, 16, 17, minute),
+        artist='test artist',
+        artist_mbid='',
+        album='test album',
+        album_mbid='',
+    )
+
+
+def fake_get_track(track_name, track_artist, track_album=None):
+    if track_name == 'missing':
+        raise SpotifyNotFoundExcecption(track_name)
+    return SpotifyTrack(
+        name=track_name,
+        spotify_id=f'{track_name} id',
+        duration_ms=1000,
+        popularity=1,
+        album_id='album id',
+        artist_id='artist id',
+    )
+
+
+class TestDownload(TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        create_all(self.engine)
+        self.session = Session(bind=self.engine)
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def test_group_by_track(self):
+        groups = download.group_by_track([scrobble('one', 1), scrobble('two', 2), scrobble('one', 3)])
+        assert [[s.listen_dt.minute for s in g] for g in groups.values()] == [[1, 3], [2]]
+
+    @patch('scrobbledownload.services.album.Spotify')
+    @patch('scrobbledownload.services.artist.Spotify')
+    @patch('scrobbledownload.services.track.Spotify')
+    def test_process_page(self, mock_track_spotify, mock_artist_spotify, mock_album_spotify):
+        mock_track_spotify.get_track.side_effect = fake_get_track
+        mock_artist_spotify.get_artists.return_value = [
+            SpotifyArtist(name='test artist', spotify_id='artist id', genres=['genre1'], popularity=1)
+        ]
+        mock_album_spotify.get_albums.return_value = [
+            SpotifyAlbum(
+                name='test album',
+                spotify_id='album id',
+                release_date_str='2019-02-05',
+                release_date_precision='day',
+                genres=[],
+                popularity=1,
+            )
+        ]
+
+        download.process_page(
+            [scrobble('one', 1), scrobble('two', 2), scrobble('one', 3), scrobble('missing', 4)], self.session
+        )
+        self.session.commit()
+
+        assert self.session.query(Track).count() == 2
+        assert self.session.query(Listen).count() == 3
+        assert self.session.query(UnfoundTracks).one().track_name == 'missing'
+        listens = self.session.query(Listen).order_by(Listen.dt).all()
+        assert [l.track.name for l in listens] == ['one', 'two', 'one']
+        assert mock_track_spotify.get_track.call_count == 3
+        mock_artist_spotify.get_artists.assert_called_once_with(['artist id'])
+        mock_album_spotify.get_albums.assert_called_once_with(['album id'])
+
+        # A second page only searches for tracks it hasn't seen
+        mock_track_spotify.get_track.reset_mock()
+        download.process_page([scrobble('one', 5)], self.session)
+        self.session.commit()
+        mock_track_spotify.get_track.assert_not_called()
+        assert self.session.query(Listen).count() == 4
+
+    @patch('scrobbledownload.download.LastFM')
+    @patch('scrobbledownload.download.Spotify')
+    @patch('scrobbledownload.services.track.Spotify')
+    def test_download_tracks(self, mock_track_spotify, mock_spotify, mock_lastfm):
+        mock_track_spotify.get_track.side_effect = fake_get_track
+        mock_spotify.get_artists.return_value = [
+            SpotifyArtist(name='test artist', spotify_id='artist id', genres=['genre1'], popularity=1)
+        ]
+        mock_spotify.get_albums.return_value = [
+            SpotifyAlbum(
+                name='test album',
+                spotify_id='album id',
+                release_date_str='2019-02-05',
+                release_date_precision='day',
+                genres=[],
+                popularity=1,
+            )
+        ]
+        pages = [
+            Scrobbles(page=1, perPage=2, totalPages=3, tracks=[scrobble('one', 9), scrobble('two', 8)]),
+            Scrobbles(page=2, perPage=2, totalPages=3, tracks=[scrobble('one', 7), scrobble('missing', 6)]),
+            Scrobbles(page=3, perPage=2, totalPages=3, tracks=[scrobble('three', 5), scrobble('one', 1)]),
+        ]
+        mock_lastfm.return_value.download_pages.return_value = iter(pages)
+        self.session.add(Listen(dt=datetime(2020, 2, 16, 17, 2)))
+        self.session.commit()
+
+        secrets = MagicMock(scrobbles_per_page=2)
+        download.download_tracks(self.session, secrets, engine=SyncEnrichmentEngine(), queue_depth=1)
+
+        assert mock_lastfm.return_value.download_pages.call_args[1]['from_dt'] == datetime(2020, 2, 16, 17, 2)
+        assert sorted(t.name for t in self.session.query(Track)) == ['one', 'three', 'two']
+        # The seeded listen, plus every new scrobble but the unfound one
+        assert self.session.query(Listen).count() == 5
+        assert self.session.query(UnfoundTracks).one().track_name == 'missing'
+        # Artists and albums were fetched once, by the enrichment stage
+        mock_spotify.get_artists.assert_called_once_with(['artist id'])
+        mock_spotify.get_albums.assert_called_once_with(['album id'])
+        assert mock_track_spotify.get_track.call_count == 4
+
+        counters = metrics.snapshot()['counters']
+        assert counters['tracks.created'] == 3
+        assert counters['listens.saved'] == 4
+        assert counters['listens.unfound'] == 1
+        assert metrics.snapshot()['timers']['db.commit']['calls'] == 3
+
+    def mock_spotify(self, mock_spotify):
+        mock_spotify.get_artists.return_value = [
+            SpotifyArtist(name='test artist', spotify_id='artist id', genres=['genre1'], popularity=1)
+        ]
+        mock_spotify.get_albums.return_value = [
+            SpotifyAlbum('test album', 'album id', '2019-02-05', 'day', [], 1)
+        ]
+
+    @patch('scrobbledownload.download.LastFM')
+    @patch('scrobbledownload.download.Spotify')
+    @patch('scrobbledownload.services.track.Spotify')
+    def test_download_tracks_resumes(self, mock_track_spotify, mock_spotify, mock_lastfm):
+        mock_track_spotify.get_track.side_effect = fake_get_track
+        self.mock_spotify(mock_spotify)
+        # A first download that died after writing page 1 of 3, at 2 scrobbles a page
+        window_end = datetime(2020, 2, 17)
+        self.session.add(Listen(dt=datetime(2020, 2, 16, 17, 9)))
+        self.session.add(SyncState(kind='sync', to_dt=window_end, last_page=1, page_size=2, total_pages=3))
+        # A backfill's window, which is the backfill's to resume
+        backfill_window = SyncState(kind='backfill', from_dt=datetime(2019, 1, 1), to_dt=datetime(2019, 2, 1))
+        self.session.add(backfill_window)
+        self.session.commit()
+
+        def download_pages(per_page, concurrency, from_dt, to_dt, start_page):
+            if to_dt == window_end:
+                return iter(
+                    [
+                        Scrobbles(page=2, perPage=2, totalPages=3, tracks=[scrobble('two', 8), scrobble('one', 7)]),
+                        Scrobbles(page=3, perPage=2, totalPages=3, tracks=[scrobble('three', 6)]),
+                    ]
+                )
+            return iter([Scrobbles(page=1, perPage=2, totalPages=1, tracks=[])])
+
+        mock_lastfm.return_value.download_pages.side_effect = download_pages
+        # The page size has changed since
+        download.download_tracks(self.session, MagicMock(scrobbles_per_page=5), engine=SyncEnrichmentEngine())
+
+        resumed, new = mock_lastfm.return_value.download_pages.call_args_list
+        # The resumed window keeps its page size, so its page boundaries stay put
+        assert resumed[0][0] == 2
+        assert resumed[1] == {'from_dt': None, 'to_dt': window_end, 'start_page': 2}
+        assert new[0][0] == 5
+        # The next window starts from the newest listen, which the backfill's first page wrote
+        assert new[1]['from_dt'] == datetime(2020, 2, 16, 17, 9)
+        assert new[1]['start_page'] == 1
+        assert self.session.query(Listen).count() == 4
+        # The two overlapping sync windows are merged into one
+        (state,) = self.session.query(SyncState).filter(SyncState.kind == 'sync').all()
+        assert (state.from_dt, state.to_dt > window_end, state.completed_at is not None) == (None, True, True)
+        assert state.oldest_dt == datetime(2020, 2, 16, 17, 6)
+        assert SyncState.incomplete(self.session) == [backfill_window]
+
+    @patch('scrobbledownload.download.LastFM')
+    @patch('scrobbledownload.download.Spotify')
+    @patch('scrobbledownload.services.track.Spotify')
+    def test_download_tracks_checkpoints(self, mock_track_spotify, mock_spotify, mock_lastfm):
+        mock_track_spotify.get_track.side_effect = fake_get_track
+        self.mock_spotify(mock_spotify)
+
+        mock_lastfm.return_value.download_pages.return_value = iter(
+            [
+                Scrobbles(page=1, perPage=2, totalPages=3, tracks=[scrobble('one', 9), scrobble('two', 8)]),
+                Scrobbles(page=2, perPage=2, totalPages=3, tracks=[scrobble('three', 7), scrobble('one', 6)]),
+            ]
+        )
+        write_page = download.write_page
+
+        def fail_on_page_2(plan, *args):
+            if plan.page == 2:
+                raise ConnectionError('The database went away')
+            write_page(plan, *args)
+
+        with patch('scrobbledownload.download.write_page', fail_on_page_2):
+            with self.assertRaises(ConnectionError):
+                download.download_tracks(
+                    self.session, MagicMock(scrobbles_per_page=2), engine=SyncEnrichmentEngine()
+                )
+        self.session.rollback()
+
+        state = self.session.query(SyncState).one()
+        assert (state.last_page, state.total_pages, state.completed_at) == (1, 3, None)
+        assert state.oldest_dt == datetime(2020, 2, 16, 17, 8)
+        assert self.session.query(Listen).count() == 2
+
+    def test_merge_completed(self):
+        def window(kind, from_day, to_day, completed=True):
+            from_dt = datetime(2020, 1, from_day) if from_day else None
+            completed_at = datetime(2020, 3, to_day) if completed else None
+            return SyncState(kind=kind, from_dt=from_dt, to_dt=datetime(2020, 1, to_day), completed_at=completed_at)
+
+        self.session.add_all(
+            [
+                window('sync', None, 5),
+                window('sync', 4, 10),
+                window('sync', 9, 12),
+                # Only touching isn't overlapping, as neither covers the 12th itself
+                window('sync', 12, 20),
+                window('sync', 19, 25, completed=False),
+                window('gap', 1, 30),
+            ]
+        )
+        self.session.commit()
+
+        assert SyncState.merge_completed(self.session, 'sync') == 2
+        self.session.commit()
+        windows = self.session.query(SyncState.kind, SyncState.from_dt, SyncState.to_dt).order_by(SyncState.id)
+        assert windows.all() == [
+            ('sync', None, datetime(2020, 1, 12)),
+            ('sync', datetime(2020, 1, 12), datetime(2020, 1, 20)),
+            ('sync', datetime(2020, 1, 19), datetime(2020, 1, 25)),
+            ('gap', datetime(2020, 1, 1), datetime(2020, 1, 30)),
+        ]
+        assert SyncState.merge_completed(self.session, 'sync') == 0
+
+    def test_find_gaps(self):
+        for day in (1, 2, 10, 11, 15, 20, 30):
+            self.session.add(Listen(dt=datetime(2020, 1, day)))
+        # The gap from the 20th to the 30th has already been checked
+        checked = SyncState(
+            kind='gap', from_dt=datetime(2020, 1, 20), to_dt=datetime(2020, 1, 30), completed_at=datetime.now()
+        )
+        self.session.add(checked)
+        self.session.commit()
+
+        gaps = download.find_gaps(self.session, timedelta(days=5))
+        assert gaps == [(datetime(2020, 1, 2), datetime(2020, 1, 10))]
+        assert download.find_gaps(self.session, timedelta(days=10)) == []
+
+    def test_fill_gaps(self):
+        self.session.add_all([Listen(dt=datetime(2020, 1, 1)), Listen(dt=datetime(2020, 1, 10))])
+        self.session.commit()
+        downloader = MagicMock()
+        downloader.download.side_effect = lambda state: state.complete()
+
+        download.fill_gaps(self.session, downloader, timedelta(days=5))
+        state = downloader.download.call_args[0][0]
+        assert (state.kind, state.from_dt, state.to_dt) == ('gap', datetime(2020, 1, 1), datetime(2020, 1, 10))
+        self.session.commit()
+        # Once it's been checked, it isn't a gap any more
+        assert download.find_gaps(self.session, timedelta(days=5)) == []
@@ -0,0 +1,58 @@
+import asyncio
+from unittest import TestCase
+from unittest.mock import MagicMock
+from scrobbledownload.enrichment import AsyncEnrichmentEngine, SyncEnrichmentEngine
+from scrobbledownload.services.spotify import SpotifyNotFoundExcecption
+
+
+class TestSyncEnrichmentEngine(TestCase):
+    def test_search_tracks(self):
+        found = MagicMock()
+        found.search.return_value = 'spotify track'
+        missing = MagicMock()
+        missing.search.side_effect = SpotifyNotFoundExcecption('missing')
+
+        actual = SyncEnrichmentEngine().search_tracks({'found': found, 'missing': missing})
+        assert actual == {'found': 'spotify track'}
+
+
+class FakeAsyncSpotify(object):
+    def __init__(self):
+        self.running = 0
+        self.most_running = 0
+        self.closed = False
+
+    async def get_track(self, track_name, track_artist, track_album=None):
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        if track_name == 'missing':
+            raise SpotifyNotFoundExcecption(track_name)
+        if track_name == 'broken':
+            raise ValueError(track_name)
+        return f'{track_name} by {track_artist}'
+
+    async def close(self):
+        self.closed = True
+
+
+class TestAsyncEnrichmentEngine(TestCase):
+    def test_search_tracks(self):
+        spotify = FakeAsyncSpotify()
+        engine = AsyncEnrichmentEngine(spotify, concurrency=3)
+        tracks = {}
+        for name in ['one', 'two', 'three', 'four', 'missing', 'broken']:
+            tracks[name] = MagicMock(track_name=name, track_artist='artist')
+
+        actual = engine.search_tracks(tracks)
+        assert actual == {
+            'one': 'one by artist',
+            'two': 'two by artist',
+            'three': 'three by artist',
+            'four': 'four by artist',
+        }
+        assert spotify.most_running == 3
+
+        engine.close()
+        assert spotify.closed
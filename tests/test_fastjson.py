@@ -0,0 +1,14 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from scrobbledownload import fastjson
+
+
+class TestFastJson(TestCase):
+    def test_loads(self):
+        assert fastjson.loads(b'{"a": [1, "b"]}') == {"a": [1, "b"]}
+        assert fastjson.loads('{"a": null}') == {"a": None}
+
+    @patch("scrobbledownload.fastjson.orjson", None)
+    def test_loads_fallback(self):
+        assert fastjson.loads(b'{"a": [1, "b"]}') == {"a": [1, "b"]}
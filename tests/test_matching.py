@@ -0,0 +1,65 @@
+from collections import namedtuple
+from unittest import TestCase
+
+from scrobbledownload import matching
+from scrobbledownload.models.spotify_models import SpotifyTrack
+
+Case = namedtuple('Case', ['input', 'expected'])
+
+
+def candidate(name, artist='Fleetwood Mac', album='Rumours', duration_ms=200000, spotify_id=None):
+    return SpotifyTrack(name, spotify_id or name, duration_ms, 1, 'album id', 'artist id', artist, album)
+
+
+class TestMatching(TestCase):
+    def test_strip_title(self):
+        test_cases = [
+            Case('Go Your Own Way - 2004 Remaster', 'Go Your Own Way'),
+            Case('Go Your Own Way (Remastered)', 'Go Your Own Way'),
+            Case('Song [feat. Someone Else]', 'Song'),
+            Case('Song feat. Someone Else', 'Song'),
+            Case('Song (Live at Wembley) - 2011 Remaster', 'Song'),
+            Case('Dust in the Wind', 'Dust in the Wind'),
+            Case('Mr. Blue Sky - Edit', 'Mr. Blue Sky'),
+            Case('Jump (For My Love)', 'Jump (For My Love)'),
+            Case('(Live)', '(Live)'),
+            Case('Song (with Someone Else)', 'Song'),
+            Case('Song (Duet With Someone Else)', 'Song (Duet With Someone Else)'),
+            Case('Dancing with Myself', 'Dancing with Myself'),
+        ]
+        for case in test_cases:
+            with self.subTest(input=case.input, expected=case.expected):
+                assert matching.strip_title(case.input) == case.expected
+
+    def test_best_match(self):
+        candidates = [
+            candidate('Go Your Own Way - Live', album='The Dance'),
+            candidate('Go Your Own Way - 2004 Remaster'),
+            candidate('Go Your Own Way', artist='Some Cover Band'),
+        ]
+        actual = matching.best_match(candidates, 'Go Your Own Way', 'Fleetwood Mac', 'Rumours')
+        assert actual == candidates[1]
+
+        # Without the album, the remaster and the live version tie, and Spotify's order wins
+        assert matching.best_match(candidates, 'Go Your Own Way', 'Fleetwood Mac') == candidates[0]
+
+        # A duration that's well off counts against a candidate
+        actual = matching.best_match(candidates, 'Go Your Own Way', 'Fleetwood Mac', duration_ms=260000)
+        assert actual == candidates[0]
+        candidates[0] = candidate('Go Your Own Way - Live', duration_ms=300000)
+        actual = matching.best_match(candidates, 'Go Your Own Way', 'Fleetwood Mac', duration_ms=200000)
+        assert actual == candidates[1]
+
+        assert matching.best_match(candidates, 'Dreams', 'Fleetwood Mac') is None
+        assert matching.best_match([], 'Dreams', 'Fleetwood Mac') is None
+
+    def test_score_artists(self):
+        track = candidate('Under Pressure', artist='Queen')
+        assert matching.score(track, 'Under Pressure', 'Queen & David Bowie') >= matching.MATCH_THRESHOLD
+        assert matching.score(track, 'Under Pressure', 'Vanilla Ice') < matching.MATCH_THRESHOLD
+        # An alias for the artist counts as much as their name
+        track = candidate('Ocean', artist='Pageninetynine')
+        assert matching.score(track, 'Ocean', 'Pg99') < matching.MATCH_THRESHOLD
+        assert matching.score(track, 'Ocean', 'Pg99', artist_alias='Pageninetynine') == 1.0
+        # Without an artist name on the candidate, the artist-filtered search is trusted
+        assert matching.score(candidate('Under Pressure', artist=None), 'Under Pressure', 'Queen') == 1.0
@@ -0,0 +1,79 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from scrobbledownload.metrics import Metrics
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.metrics = Metrics(self.clock)
+
+    def record(self):
+        with self.metrics.timer('lastfm.fetch'):
+            self.clock.now += 2
+        with self.assertRaises(ValueError):
+            with self.metrics.timer('lastfm.fetch'):
+                self.clock.now += 1
+                raise ValueError()
+        self.metrics.observe('db.commit', 0.5)
+        self.metrics.incr('spotify.search.fallbacks', 3)
+        self.metrics.incr('spotify.search.fallbacks')
+
+    def test_snapshot(self):
+        self.record()
+        assert self.metrics.snapshot() == {
+            'timers': {
+                'lastfm.fetch': {'calls': 2, 'seconds': 3.0, 'max': 2.0},
+                'db.commit': {'calls': 1, 'seconds': 0.5, 'max': 0.5},
+            },
+            'counters': {'spotify.search.fallbacks': 4},
+        }
+        self.metrics.reset()
+        assert self.metrics.snapshot() == {'timers': {}, 'counters': {}}
+
+    def test_merge(self):
+        self.record()
+        other = Metrics(self.clock)
+        other.observe('lastfm.fetch', 5)
+        other.incr('listens.saved', 2)
+        self.metrics.merge(other.snapshot())
+        assert self.metrics.snapshot() == {
+            'timers': {
+                'lastfm.fetch': {'calls': 3, 'seconds': 8.0, 'max': 5.0},
+                'db.commit': {'calls': 1, 'seconds': 0.5, 'max': 0.5},
+            },
+            'counters': {'spotify.search.fallbacks': 4, 'listens.saved': 2},
+        }
+
+    def test_summary(self):
+        self.record()
+        lines = self.metrics.summary().splitlines()
+        assert lines[1].split() == ['lastfm.fetch', '2', '3.000', '1500.00', '2000.00']
+        assert lines[2].split()[0] == 'db.commit'
+        assert lines[-1].split() == ['spotify.search.fallbacks', '4']
+
+    def test_write(self):
+        self.record()
+        with tempfile.TemporaryDirectory() as d:
+            self.metrics.write(os.path.join(d, 'metrics.json'))
+            with open(os.path.join(d, 'metrics.json')) as fh:
+                assert json.load(fh) == self.metrics.snapshot()
+
+            self.metrics.write(os.path.join(d, 'metrics.prom'))
+            with open(os.path.join(d, 'metrics.prom')) as fh:
+                prom = fh.read()
+            assert 'scrobbledownload_stage_seconds_total{stage="lastfm.fetch"} 3.0\n' in prom
+            assert 'scrobbledownload_stage_calls_total{stage="db.commit"} 1\n' in prom
+            assert 'scrobbledownload_events_total{event="spotify.search.fallbacks"} 4\n' in prom
+            assert sorted(os.listdir(d)) == ['metrics.json', 'metrics.prom']
@@ -0,0 +1,111 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, event, inspect, text
+
+from scrobbledownload import migrations
+from scrobbledownload.models import create_all
+
+# The schema as older versions created it
+OLD_SCHEMA = [
+    'CREATE TABLE artists (id INTEGER PRIMARY KEY, name VARCHAR(1000), popularity INTEGER, '
+    'spotify_id VARCHAR(100))',
+    'CREATE INDEX ix_artists_spotify_id ON artists (spotify_id)',
+    'CREATE TABLE artist_genres (id INTEGER PRIMARY KEY, artist_id INTEGER NOT NULL, genre VARCHAR(1000))',
+    'CREATE TABLE albums (id INTEGER PRIMARY KEY, name VARCHAR(1000), spotify_id VARCHAR(100), '
+    'release_date DATE, popularity INTEGER)',
+    'CREATE TABLE tracks (id INTEGER PRIMARY KEY, name VARCHAR(1000), spotify_id VARCHAR(100), '
+    'mbid VARCHAR(100), generated_id VARCHAR(100), artist_id INTEGER, album_id INTEGER)',
+    'CREATE INDEX ix_tracks_generated_id ON tracks (generated_id)',
+    'CREATE TABLE listens (id INTEGER PRIMARY KEY, dt DATETIME, track_id INTEGER)',
+    'CREATE TABLE unfoundtracks (id INTEGER PRIMARY KEY, track_name VARCHAR(1000), track_mbid VARCHAR(1000), '
+    'dt DATETIME, artist VARCHAR(1000), artist_mbid VARCHAR(1000), album VARCHAR(1000), '
+    'album_mbid VARCHAR(1000))',
+    'CREATE TABLE sync_state (id INTEGER PRIMARY KEY, kind VARCHAR(20), from_dt DATETIME, to_dt DATETIME, '
+    'last_page INTEGER NOT NULL DEFAULT 0, total_pages INTEGER, oldest_dt DATETIME, started_at DATETIME, '
+    'updated_at DATETIME, completed_at DATETIME)',
+    "INSERT INTO artists (id, name, spotify_id) VALUES (1, 'a', 'artist id'), (2, 'a', 'artist id')",
+    "INSERT INTO artist_genres (artist_id, genre) VALUES (1, 'rock'), (2, 'rock')",
+    "INSERT INTO tracks (id, name, generated_id, artist_id) VALUES (1, 't', 'hash', 1), (2, 't', 'hash', 2)",
+    "INSERT INTO listens (dt, track_id) VALUES ('2020-01-01 00:00:00', 1), ('2020-01-02 00:00:00', 2)",
+    "INSERT INTO unfoundtracks (track_name) VALUES ('missing')",
+]
+
+
+class TestMigrations(TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        with self.engine.begin() as conn:
+            for statement in OLD_SCHEMA:
+                conn.execute(text(statement))
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def indexes(self, table):
+        return {i['name']: bool(i['unique']) for i in inspect(self.engine).get_indexes(table)}
+
+    def test_upgrade(self):
+        create_all(self.engine)
+        done = migrations.upgrade(self.engine)
+
+        assert 'added unfoundtracks.attempts' in done
+        assert 'added sync_state.page_size' in done
+        assert 'merged 1 duplicate artists' in done
+        assert 'rebuilt index ix_tracks_generated_id' in done
+        assert self.indexes('listens') == {'ix_listens_dt': False, 'ix_listens_track_id_dt': False}
+        assert self.indexes('tracks')['ix_tracks_generated_id'] is True
+        assert self.indexes('artists')['ix_artists_spotify_id'] is True
+        assert self.indexes('albums')['ix_albums_spotify_id'] is True
+        with self.engine.connect() as conn:
+            assert conn.execute(text('SELECT id FROM artists')).fetchall() == [(1,)]
+            assert conn.execute(text('SELECT artist_id FROM artist_genres')).fetchall() == [(1,)]
+            assert conn.execute(text('SELECT id, artist_id FROM tracks')).fetchall() == [(1, 1)]
+            assert conn.execute(text('SELECT track_id FROM listens')).fetchall() == [(1,), (1,)]
+            assert conn.execute(text('SELECT attempts, last_attempt FROM unfoundtracks')).fetchall() == [
+                (0, None)
+            ]
+
+        # Running it again has nothing to do
+        assert migrations.upgrade(self.engine) == []
+
+    def test_upgrade_invalid_index(self):
+        create_all(self.engine)
+        migrations.upgrade(self.engine)
+
+        # A unique index that a failed CREATE INDEX CONCURRENTLY left invalid is rebuilt
+        with patch.object(migrations, '_invalid_indexes', return_value={'ix_tracks_generated_id'}):
+            assert migrations.upgrade(self.engine) == ['rebuilt index ix_tracks_generated_id']
+        assert self.indexes('tracks')['ix_tracks_generated_id'] is True
+
+    def test_upgrade_new_database(self):
+        engine = create_engine('sqlite://')
+        create_all(engine)
+        assert migrations.upgrade(engine) == []
+        engine.dispose()
+
+    def test_ensure_schema_old_database(self):
+        assert migrations.current_version(self.engine) is None
+        done = migrations.ensure_schema(self.engine)
+        assert 'added unfoundtracks.attempts' in done
+        assert 'sync_state' in inspect(self.engine).get_table_names()
+        assert migrations.current_version(self.engine) == migrations.SCHEMA_VERSION
+        assert migrations.ensure_schema(self.engine) == []
+
+    def test_ensure_schema_new_database(self):
+        engine = create_engine('sqlite://')
+        assert migrations.ensure_schema(engine) == ['created the schema']
+        assert migrations.current_version(engine) == migrations.SCHEMA_VERSION
+
+        # Once it's up to date, checking is a single query
+        statements = []
+        event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        assert migrations.ensure_schema(engine) == []
+        assert len(statements) == 1
+
+        # And a database from a newer version is left alone
+        with engine.begin() as conn:
+            conn.execute(text('UPDATE schema_version SET version = version + 1'))
+        with self.assertRaises(RuntimeError):
+            migrations.ensure_schema(engine)
+        engine.dispose()
@@ -0,0 +1,69 @@
+from collections import namedtuple
+from unittest import TestCase
+
+from scrobbledownload.normalization import ReplacementIndex, fold, to_alphanum
+
+Case = namedtuple('Case', ['input', 'expected'])
+
+
+class TestNormalization(TestCase):
+    def test_to_alphanum(self):
+        test_cases = [
+            Case('Guns N\' Roses', 'Guns N Roses'),
+            Case('Don’t Stop — Live…', 'Dont Stop  Live'),
+            Case('¡Viva! «La Vida»', 'Viva La Vida'),
+            Case('Beyoncé', 'Beyoncé'),
+        ]
+        for case in test_cases:
+            with self.subTest(input=case.input, expected=case.expected):
+                assert to_alphanum(case.input) == case.expected
+
+    def test_fold(self):
+        test_cases = [
+            Case('Beyoncé', 'beyonce'),
+            Case('Simon & Garfunkel', 'simon and garfunkel'),
+            Case("  Don't Stop -  Live ", 'dont stop live'),
+            Case('Don’t Stop', 'dont stop'),
+            Case('ＡＢＣ', 'abc'),
+            Case('Angel Du$t', 'angel dust'),
+            Case('3OH!3', '3ohi3'),
+            Case('P!nk', 'pink'),
+            Case('A$AP Rocky', 'asap rocky'),
+            Case('Help!', 'help'),
+        ]
+        for case in test_cases:
+            with self.subTest(input=case.input, expected=case.expected):
+                assert fold(case.input) == case.expected
+
+
+class TestReplacementIndex(TestCase):
+    def setUp(self):
+        self.index = ReplacementIndex(
+            {
+                'The AllAmerican Rejects': 'The All American Rejects',
+                'Pg99': 'Pageninetynine',
+                'words': {'Pt': 'Part'},
+                'regex': {r'\s+EP$': ''},
+            }
+        )
+
+    def test_apply_exact(self):
+        assert self.index.apply('The AllAmerican Rejects') == 'The All American Rejects'
+        assert self.index.apply('the allamerican rejects') == 'The All American Rejects'
+        assert self.index.apply('Fleetwood Mac') == 'Fleetwood Mac'
+
+    def test_apply_words(self):
+        assert self.index.apply_words('Document 5 Pt 2') == 'Document 5 Part 2'
+        # Single-word exact rules apply to each word too
+        assert self.index.apply_words('Pg99 Live') == 'Pageninetynine Live'
+        assert self.index.apply_words('pg99 live') == 'Pageninetynine live'
+
+    def test_apply_regex(self):
+        assert self.index.apply('Document EP') == 'Document'
+        assert self.index.apply_words('Document Pt 2 EP') == 'Document Part 2'
+
+    def test_empty(self):
+        for rules in (None, {}):
+            index = ReplacementIndex(rules)
+            assert index.apply('Pg99') == 'Pg99'
+            assert index.apply_words('Pg99 Live') == 'Pg99 Live'
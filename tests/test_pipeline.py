@@ -0,0 +1,74 @@
+import threading
+import time
+from unittest import TestCase
+from scrobbledownload.pipeline import Pipeline, StopPipeline
+
+
+class TestPipeline(TestCase):
+    def test_run(self):
+        results = []
+        stages = [lambda x: x * 2, lambda x: x + 1 if x != 4 else None]
+        Pipeline(queue_depth=2).run(iter(range(10)), stages, results.append)
+        assert results == [1, 3, 7, 9, 11, 13, 15, 17, 19]
+
+    def test_stages_overlap(self):
+        threads = set()
+
+        def stage(x):
+            threads.add(threading.current_thread().name)
+            return x
+
+        results = []
+        def sink(x):
+            threads.add(threading.current_thread().name)
+            results.append(x)
+
+        Pipeline().run(iter(range(3)), [stage], sink)
+        assert results == [0, 1, 2]
+        assert len(threads) == 2
+
+    def test_stop(self):
+        pulled = []
+
+        def source():
+            for i in range(1000):
+                pulled.append(i)
+                yield i
+
+        def stop_at_five(x):
+            if x == 5:
+                raise StopPipeline(x)
+            return x
+
+        results = []
+        Pipeline(queue_depth=2).run(source(), [stop_at_five, lambda x: x], results.append)
+        assert results == [0, 1, 2, 3, 4, 5]
+        assert len(pulled) < 20
+
+    def test_stage_error(self):
+        def explode(x):
+            if x == 3:
+                raise ValueError('boom')
+            return x
+
+        with self.assertRaises(ValueError):
+            Pipeline().run(iter(range(100)), [explode], lambda x: None)
+
+    def test_sink_error(self):
+        closed = []
+
+        def source():
+            try:
+                for i in range(100):
+                    yield i
+            finally:
+                closed.append(True)
+
+        def sink(x):
+            time.sleep(0.001)
+            if x == 2:
+                raise ValueError('boom')
+
+        with self.assertRaises(ValueError):
+            Pipeline().run(source(), [lambda x: x], sink)
+        assert closed == [True]
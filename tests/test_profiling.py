@@ -0,0 +1,64 @@
+import io
+import os
+import pstats
+import tempfile
+import threading
+from unittest import TestCase
+
+from scrobbledownload import cli, profiling
+
+
+def hot_function():
+    return sum(i * i for i in range(200000))
+
+
+def in_a_thread():
+    thread = threading.Thread(target=hot_function)
+    thread.start()
+    thread.join()
+
+
+class TestProfiling(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'out.prof')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_cprofile(self):
+        stream = io.StringIO()
+        with profiling.profile(self.path, 'cprofile', top=5, stream=stream):
+            in_a_thread()
+
+        functions = [f for _, _, f in pstats.Stats(self.path).stats]
+        assert 'in_a_thread' in functions
+        # Run in its own thread, but profiled all the same
+        assert 'hot_function' in functions
+        assert 'hot_function' in stream.getvalue()
+
+    def test_sample(self):
+        stream = io.StringIO()
+        with profiling.profile(self.path, 'sample', top=5, interval=0.001, stream=stream):
+            for _ in range(5):
+                in_a_thread()
+
+        with open(self.path) as fh:
+            stacks = fh.read()
+        assert 'hot_function' in stacks
+        assert stacks.splitlines()[0].rsplit(' ', 1)[1].isdigit()
+        assert 'Top 5 functions by self samples' in stream.getvalue()
+
+    def test_stops_on_error(self):
+        with self.assertRaises(KeyError):
+            with profiling.profile(self.path, 'cprofile', stream=io.StringIO()):
+                raise KeyError()
+        assert os.path.exists(self.path)
+
+        with self.assertRaises(ValueError):
+            with profiling.profile(self.path, 'nope'):
+                pass
+
+    def test_cli_modes(self):
+        # The CLI keeps its own copy, so it doesn't import this module until it's profiling
+        assert cli.PROFILE_MODES == profiling.MODES
@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from scrobbledownload import metrics, retry
+from scrobbledownload.models import Artist, Album, Listen, Track, UnfoundTracks, create_all
+from scrobbledownload.models.spotify_models import SpotifyAlbum, SpotifyArtist, SpotifyTrack
+from scrobbledownload.services.track import Track as TrackService
+
+
+class FakeEngine(object):
+    def __init__(self):
+        self.searched = []
+
+    def search_tracks(self, tracks):
+        found = {}
+        for generated_id, track in tracks.items():
+            self.searched.append(track.track_name)
+            if track.track_name != 'missing':
+                found[generated_id] = SpotifyTrack(
+                    track.track_name, f'{track.track_name} id', 1000, 1, 'album id', 'artist id'
+                )
+        return found
+
+
+def unfound(name, minute, album='test album'):
+    return UnfoundTracks(
+        track_name=name, artist='test artist', album=album, dt=datetime(2020, 2, 16, 17, minute)
+    )
+
+
+class TestRetry(TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        create_all(self.engine)
+        self.session = Session(bind=self.engine)
+        self.now = datetime(2020, 3, 1)
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def test_retry_delay(self):
+        base, most = timedelta(hours=1), timedelta(hours=6)
+        assert retry.retry_delay(0, base, most) == timedelta(0)
+        assert retry.retry_delay(1, base, most) == timedelta(hours=1)
+        assert retry.retry_delay(3, base, most) == timedelta(hours=4)
+        assert retry.retry_delay(4, base, most) == timedelta(hours=6)
+        assert retry.retry_delay(1000, base, most) == timedelta(hours=6)
+
+    @patch('scrobbledownload.services.album.Spotify')
+    @patch('scrobbledownload.services.artist.Spotify')
+    def test_retry_unfound(self, mock_artist_spotify, mock_album_spotify):
+        mock_artist_spotify.get_artists.return_value = [
+            SpotifyArtist(name='test artist', spotify_id='artist id', genres=[], popularity=1)
+        ]
+        mock_album_spotify.get_albums.return_value = [
+            SpotifyAlbum('test album', 'album id', '2019-02-05', 'day', [], 1)
+        ]
+        artist, album = Artist(name='test artist', spotify_id='other artist'), Album(spotify_id='other album')
+        known = Track(
+            name='known',
+            generated_id=TrackService.generate_id('known', 'test artist', 'test album'),
+            artist=artist,
+            album=album,
+        )
+        self.session.add_all(
+            [
+                known,
+                unfound('one', 1),
+                unfound('one', 2),
+                unfound('one', 3, album='another album'),
+                unfound('missing', 4),
+                unfound('missing', 5),
+                unfound('known', 6),
+            ]
+        )
+        self.session.commit()
+
+        engine = FakeEngine()
+        resolved = retry.retry_unfound(
+            self.session, engine, batch_size=1, base_delay=timedelta(days=1), now=self.now
+        )
+
+        # One search per track name and artist, and none for a track we have now
+        assert sorted(engine.searched) == ['missing', 'one']
+        assert resolved == 4
+        assert self.session.query(Listen).count() == 4
+        assert sorted(t.name for t in self.session.query(Track)) == ['known', 'one', 'one']
+        remaining = self.session.query(UnfoundTracks).all()
+        assert [(r.track_name, r.attempts, r.last_attempt) for r in remaining] == [
+            ('missing', 1, self.now),
+            ('missing', 1, self.now),
+        ]
+        counters = metrics.snapshot()['counters']
+        assert counters['retry.tracks'] == 3
+        assert counters['retry.tracks.resolved'] == 2
+
+        # Not due again until the delay's passed, and then the delay doubles
+        engine = FakeEngine()
+        retry.retry_unfound(self.session, engine, now=self.now + timedelta(hours=23))
+        assert engine.searched == []
+        retry.retry_unfound(self.session, engine, now=self.now + timedelta(hours=24))
+        assert engine.searched == ['missing']
+        assert {r.attempts for r in self.session.query(UnfoundTracks)} == {2}
+        groups = retry.due_groups(
+            self.session, self.now + timedelta(days=2), timedelta(days=1), timedelta(days=90)
+        )
+        assert groups == []
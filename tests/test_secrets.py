@@ -62,7 +62,7 @@ class TestSecrets(TestCase):
         actual = s.load()
         assert actual == expected
 
-    @patch('scrobbledownload.secrets.SpotifyClientCredentials')
+    @patch('spotipy.oauth2.SpotifyClientCredentials')
     @patch.object(Secrets, "__init__", lambda x: None)
     def test_spotify_credentials_property(self, mock_creds):
         s = Secrets()
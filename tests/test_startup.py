@@ -0,0 +1,20 @@
+from unittest import TestCase
+
+from benchmarks.bench_startup import STATEMENTS, heavy_imports, measure
+
+# Well above what it takes (about 30ms), but well below the 400ms it took when every command's imports were eager
+BUDGET_MS = 200
+
+
+class TestStartup(TestCase):
+    def test_heavy_imports(self):
+        timings = {'click': (1, 1, 0), 'sqlalchemy': (1, 2, 0), 'sqlalchemy.orm': (1, 1, 1), 'yaml': (1, 1, 0)}
+        assert heavy_imports(timings) == ['sqlalchemy', 'yaml']
+
+    def test_startup(self):
+        for label, statement in STATEMENTS.items():
+            with self.subTest(label):
+                total_ms, timings = measure(statement)
+                assert 'scrobbledownload.cli' in timings
+                assert heavy_imports(timings) == []
+                assert total_ms < BUDGET_MS, f'{label} spent {total_ms:.1f}ms importing'
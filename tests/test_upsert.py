@@ -0,0 +1,66 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+
+from scrobbledownload import upsert
+from scrobbledownload.models import Artist, create_all
+
+
+def row(spotify_id, name='artist'):
+    return {'name': name, 'spotify_id': spotify_id}
+
+
+class TestUpsert(TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        create_all(self.engine)
+        self.session = Session(bind=self.engine)
+        self.session.add(Artist(name='existing', spotify_id='b'))
+        self.session.commit()
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute', lambda *args: self.statements.append(args[2]))
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def check_insert_missing(self):
+        ids, created = upsert.insert_missing(
+            self.session, Artist.__table__, [row('c'), row('b'), row('a'), row('a', 'dupe')], 'spotify_id'
+        )
+        self.session.commit()
+        by_spotify_id = {a.spotify_id: a for a in self.session.query(Artist)}
+        assert ids == {k: a.id for k, a in by_spotify_id.items()}
+        assert created == {'a', 'c'}
+        assert by_spotify_id['b'].name == 'existing'
+        assert by_spotify_id['a'].name == 'artist'
+        assert upsert.insert_missing(self.session, Artist.__table__, [], 'spotify_id') == ({}, set())
+
+    def test_insert_missing(self):
+        assert upsert.supports_on_conflict(self.session)
+        self.check_insert_missing()
+        inserts = [s for s in self.statements if s.startswith('INSERT')]
+        assert len(inserts) == 1
+        assert 'ON CONFLICT (spotify_id) DO NOTHING RETURNING' in inserts[0]
+
+    def test_insert_missing_fallback(self):
+        with patch.object(upsert, 'supports_on_conflict', return_value=False):
+            self.check_insert_missing()
+        assert not any('ON CONFLICT' in s for s in self.statements)
+
+    def test_insert_missing_update(self):
+        ids, created = upsert.insert_missing(
+            self.session, Artist.__table__, [row('b', 'renamed'), row('a')], 'spotify_id', update=['name']
+        )
+        self.session.commit()
+        assert {a.spotify_id: a.name for a in self.session.query(Artist)} == {'a': 'artist', 'b': 'renamed'}
+        assert set(ids) == {'a', 'b'}
+        assert created == set()
+
+    def test_insert_missing_batches(self):
+        rows = [row(f'{i:03}') for i in range(25)]
+        ids, created = upsert.insert_missing(self.session, Artist.__table__, rows, 'spotify_id', batch_size=10)
+        assert len(ids) == len(created) == 25
+        assert len([s for s in self.statements if s.startswith('INSERT')]) == 3